@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+#不用界面的批量局面分析
+#读取fen列表文件(每行一个fen)、棋谱文件(xqf/pgn/cbr)或棋谱目录，多个引擎进程按固定深度/节点数分析每个局面，
+#结果按完成的顺序写入jsonl文件和/或本地分析缓存库(analysis.db)
+#已经分析过的局面(jsonl中已有的，或固定深度分析时分析缓存库中深度足够的)会跳过，中断后用同样的参数再运行就从断点继续
+#
+#   python -m ChessUI.Analyzer -e Engine/pikafish -d 20 -j result.jsonl -s Game/analysis.db Game/棋谱目录
+
+import sys
+import time
+import json
+import queue
+import logging
+import argparse
+import threading
+from pathlib import Path
+
+from cchess import ChessBoard, Game
+
+from .EngineCore import loadAnalysisEngine, makeEvalRecord
+from .LocalDB import AnalysisStore
+
+#-----------------------------------------------------#
+GAME_FILE_TYPES = ['.xqf', '.pgn', '.cbr']
+FEN_FILE_TYPES = ['.fen', '.txt', '.epd']
+
+#fen列表文件：每行一个fen，#开头的行是注释，fen后面可以有用;分开的其他内容
+def readFenFile(file_name):
+    with open(file_name, 'r', encoding = 'utf-8', errors = 'ignore') as f:
+        for line in f:
+            line = line.split(';')[0].strip()
+            if (not line) or line.startswith('#'):
+                continue
+            try:
+                yield ChessBoard(line).to_fen()
+            except Exception:
+                logging.warning(f'{file_name}: fen格式错误 {line}')
+
+#棋谱的所有分支走一遍，包括开始局面
+def readGameFile(file_name):
+    try:
+        game = Game.read_from(file_name)
+    except Exception as e:
+        logging.warning(f'读取棋谱失败：{file_name} {e}')
+        return
+
+    if not game:
+        logging.warning(f'读取棋谱失败：{file_name}')
+        return
+
+    init_fen = game.init_board.to_fen()
+    yield init_fen
+    for moves in game.dump_iccs_moves():
+        board = ChessBoard(init_fen)
+        for iccs in moves:
+            move_it = board.move_iccs(iccs)
+            if not move_it:
+                break
+            board = move_it.board_done
+            yield board.to_fen()
+
+def readFile(file_name):
+    suffix = file_name.suffix.lower()
+    if suffix in GAME_FILE_TYPES:
+        return readGameFile(str(file_name))
+    return readFenFile(file_name)
+
+#按输入顺序返回去重后的局面
+def readPositions(inputs):
+    fens = {}
+    for name in inputs:
+        path = Path(name)
+        if path.is_dir():
+            files = [x for x in sorted(path.rglob('*')) if x.suffix.lower() in GAME_FILE_TYPES + FEN_FILE_TYPES]
+        elif path.is_file():
+            files = [path]
+        else:
+            logging.warning(f'文件不存在：{name}')
+            continue
+
+        for file_name in files:
+            for fen in readFile(file_name):
+                fens.setdefault(fen, None)
+
+    return list(fens)
+
+#-----------------------------------------------------#
+#每个工作线程带一个引擎进程，从任务队列取局面，结果放到结果队列，由主线程统一写出
+class AnalyzeWorker(threading.Thread):
+    def __init__(self, id, analyzer):
+        super().__init__(daemon = True)
+        self.id = id
+        self.analyzer = analyzer
+        self.engine = None
+
+    def loadEngine(self):
+        a = self.analyzer
+        return loadAnalysisEngine(self.id, a.engine_exec, a.engine_type, a.threads, a.hashMB, a.multiPV)
+
+    def run(self):
+        a = self.analyzer
+        while a.isRunning:
+            if self.engine is None:
+                self.engine = self.loadEngine()
+                if self.engine is None:
+                    logging.error(f'Analyzer: Engine[{self.id}] 加载引擎出错 {a.engine_exec}')
+                    break
+
+            try:
+                fen = a.todo.get_nowait()
+            except queue.Empty:
+                break
+
+            start_time = time.monotonic()
+            ret = self.engine.analyse(fen, a.params, timeout = a.timeout)
+            #超时或引擎退出，重新启动引擎，免得上一个局面的输出混到下一个局面
+            if ret is None:
+                self.engine.quit()
+                self.engine = None
+            a.results.put((self.id, fen, ret, time.monotonic() - start_time))
+
+        if self.engine:
+            self.engine.quit()
+        a.results.put((self.id, None, None, 0))
+
+#-----------------------------------------------------#
+class BatchAnalyzer():
+    def __init__(self, engine_exec, engine_type, params, pool = 1, threads = 1, hashMB = 256, multiPV = 1, timeout = 600):
+        self.engine_exec = engine_exec
+        self.engine_type = engine_type
+        self.params = params
+        self.pool = max(1, pool)
+        self.threads = threads
+        self.hashMB = hashMB
+        self.multiPV = multiPV
+        self.timeout = timeout
+
+        self.out = None
+        self.store = None
+        #跳过分析缓存库中已有的局面
+        self.resume = True
+
+        #progress(stats)，在主线程中调用
+        self.progress = None
+        self.progressInterval = 5
+
+        self.todo = queue.Queue()
+        self.results = queue.Queue()
+        self.isRunning = False
+        self.stats = {}
+
+    def stop(self):
+        self.isRunning = False
+
+    #jsonl文件中已有的局面
+    @staticmethod
+    def loadDoneFens(file_name):
+        done = set()
+        if not Path(file_name).is_file():
+            return done
+
+        with open(file_name, 'r', encoding = 'utf-8') as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['fen'])
+                except (ValueError, KeyError):
+                    #中断时写了一半的行
+                    continue
+        return done
+
+    #分析缓存库中已有足够深度的结果
+    #缓存库只记录深度，按节点数或时间分析时无法判断已有结果是否够用，只按jsonl文件跳过
+    def isStored(self, fen):
+        if (not self.store) or (not self.resume) or ('depth' not in self.params):
+            return False
+        info = self.store.getEval(fen, 'engine')
+        if not info:
+            return False
+        return info['depth'] >= self.params['depth']
+
+    def makeRecord(self, fen, ret, seconds):
+        if ret['action'] in ['dead', 'draw']:
+            return {'fen': fen, 'action': ret['action'], 'seconds': round(seconds, 3)}
+
+        record = {'fen': fen}
+        for key in ['iccs', 'score', 'mate', 'depth']:
+            if key in ret:
+                record[key] = ret[key]
+        record['pv'] = ret.get('moves', [])
+        record['actions'] = {iccs: {'score': act.get('score'), 'diff': act.get('diff', 0)} for iccs, act in ret['actions'].items()}
+        record['seconds'] = round(seconds, 3)
+        return record
+
+    def save(self, fen, ret, seconds):
+        if self.out:
+            self.out.write(json.dumps(self.makeRecord(fen, ret, seconds), ensure_ascii = False) + '\n')
+            self.out.flush()
+
+        if self.store and (ret['action'] == 'bestmove'):
+            record = makeEvalRecord(ret)
+            if record:
+                score, depth, moves, best_next = record
+                self.store.saveEval(fen, 'engine', score, depth, moves, best_next)
+
+    #处理工作线程返回的一个结果，返回False表示这个工作线程已经结束
+    def handleResult(self, worker_id, fen, ret, seconds):
+        if fen is None:
+            return False
+
+        if ret is None:
+            logging.warning(f'Analyzer: Engine[{worker_id}] 分析失败 {fen}')
+            self.stats['failed'] += 1
+        else:
+            self.save(fen, ret, seconds)
+            self.stats['done'] += 1
+        return True
+
+    def run(self, fens, skip = set()):
+        self.isRunning = True
+        self.stats = {'positions': len(fens), 'skipped': 0, 'done': 0, 'failed': 0, 'seconds': 0, 'per_sec': 0.0}
+        start_time = time.monotonic()
+
+        for fen in fens:
+            if (fen in skip) or self.isStored(fen):
+                self.stats['skipped'] += 1
+                continue
+            self.todo.put(fen)
+
+        workers = [AnalyzeWorker(i + 1, self) for i in range(min(self.pool, self.todo.qsize()))]
+        for worker in workers:
+            worker.start()
+
+        alive = len(workers)
+        last_report = time.monotonic()
+        try:
+            while alive > 0:
+                try:
+                    result = self.results.get(timeout = 1)
+                except queue.Empty:
+                    pass
+                else:
+                    if not self.handleResult(*result):
+                        alive -= 1
+
+                now = time.monotonic()
+                self.stats['seconds'] = round(now - start_time, 1)
+                self.stats['per_sec'] = round(self.stats['done'] / max(now - start_time, 1e-6), 2)
+                if self.progress and (now - last_report >= self.progressInterval):
+                    last_report = now
+                    self.progress(self.stats)
+        except KeyboardInterrupt:
+            #已经写出的结果保留，下次从断点继续
+            self.stop()
+            logging.warning('Analyzer: 中断，等待正在分析的局面完成')
+            for worker in workers:
+                worker.join()
+            #工作线程结束前完成的局面也写出
+            while True:
+                try:
+                    self.handleResult(*self.results.get_nowait())
+                except queue.Empty:
+                    break
+
+        self.isRunning = False
+        if self.progress:
+            self.progress(self.stats)
+
+        return self.stats
+
+#-----------------------------------------------------#
+def printProgress(stats):
+    done = stats['done'] + stats['skipped'] + stats['failed']
+    print(f"\r{done}/{stats['positions']}  {stats['per_sec']}局面/秒", end = '', file = sys.stderr, flush = True)
+
+def makeParser():
+    parser = argparse.ArgumentParser(prog = 'python -m ChessUI.Analyzer', description = '不用界面的批量局面分析')
+    parser.add_argument('inputs', nargs = '+', help = 'fen列表文件、棋谱文件(xqf/pgn/cbr)或棋谱目录')
+    parser.add_argument('-e', '--engine', required = True, help = '引擎程序')
+    parser.add_argument('-t', '--type', default = 'uci', choices = ['uci', 'ucci'], help = '引擎协议')
+    parser.add_argument('-p', '--pool', type = int, default = 1, help = '引擎进程数')
+    parser.add_argument('--threads', type = int, default = 1, help = '每个引擎的线程数')
+    parser.add_argument('--hash', type = int, default = 256, help = '每个引擎的Hash(MB)')
+    parser.add_argument('--multipv', type = int, default = 1, help = '多分支分析的分支数')
+    group = parser.add_mutually_exclusive_group(required = True)
+    group.add_argument('-d', '--depth', type = int, help = '固定深度')
+    group.add_argument('-n', '--nodes', type = int, help = '固定节点数')
+    group.add_argument('--movetime', type = int, help = '固定时间(毫秒)')
+    parser.add_argument('--timeout', type = int, default = 600, help = '每个局面最长的分析时间(秒)')
+    parser.add_argument('-j', '--jsonl', help = '结果写入的jsonl文件，-为标准输出')
+    parser.add_argument('-s', '--store', help = '结果写入的分析缓存库，如Game/analysis.db')
+    parser.add_argument('--no-resume', action = 'store_true', help = '不跳过已经分析过的局面')
+    parser.add_argument('-v', '--verbose', action = 'store_true')
+    return parser
+
+def main(args):
+    logging.basicConfig(level = logging.INFO if args.verbose else logging.WARNING, format = '%(asctime)s %(message)s')
+
+    if (not args.jsonl) and (not args.store):
+        print('至少要指定 --jsonl 或 --store 中的一个', file = sys.stderr)
+        return -1
+
+    if args.depth:
+        params = {'depth': args.depth}
+    elif args.nodes:
+        params = {'nodes': args.nodes}
+    else:
+        params = {'movetime': args.movetime}
+
+    analyzer = BatchAnalyzer(args.engine, args.type, params, pool = args.pool, threads = args.threads,
+                    hashMB = args.hash, multiPV = args.multipv, timeout = args.timeout)
+    analyzer.progress = printProgress
+
+    analyzer.resume = not args.no_resume
+
+    skip = set()
+    if args.jsonl == '-':
+        analyzer.out = sys.stdout
+    elif args.jsonl:
+        if not args.no_resume:
+            skip = BatchAnalyzer.loadDoneFens(args.jsonl)
+        analyzer.out = open(args.jsonl, 'a', encoding = 'utf-8')
+
+    if args.store:
+        store = AnalysisStore()
+        store.open(args.store)
+        analyzer.store = store
+
+    fens = readPositions(args.inputs)
+    stats = analyzer.run(fens, skip)
+    print(file = sys.stderr)
+    print(stats, file = sys.stderr)
+
+    if analyzer.out and (analyzer.out is not sys.stdout):
+        analyzer.out.close()
+    if args.store:
+        store.close()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(makeParser().parse_args()))
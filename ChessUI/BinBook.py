@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#把勇芳(yfk)、鹏飞(pfbook)、大师库(evbook)、本地库(localbook)导出为二进制开局库，格式见LocalDB.py中的OpenBookBin
+#多个库按命令行顺序合并，同一局面的同一着法以先出现的为准
+
+import sys
+import logging
+from pathlib import Path
+
+from cchess import iccs_mirror
+
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+from .LocalDB import OpenBookDB, BIN_BOOK_MAGIC, BIN_BOOK_VERSION, BIN_BOOK_HEADER, BIN_BOOK_RECORD, BIN_BOOK_NO_SCORE, packIccs
+
+#-----------------------------------------------------#
+CoordMap = dict(zip(OpenBookDB.c90, OpenBookDB.s90))
+
+def clamp(value, low, high):
+    if value is None:
+        return 0
+    return max(low, min(high, value))
+
+#没有分数时写入BIN_BOOK_NO_SCORE，有分数的着法不会用到这个值
+def makeRecord(key, iccs, score, win = 0, draw = 0, loss = 0):
+    score = BIN_BOOK_NO_SCORE if score is None else clamp(score, BIN_BOOK_NO_SCORE + 1, 32767)
+    return (key, packIccs(iccs), score,
+                clamp(win, 0, 65535), clamp(draw, 0, 65535), clamp(loss, 0, 65535))
+
+#-----------------------------------------------------#
+def readYfk(db):
+    for vkey, vmove, vscore, vwin, vdraw, vlost in db.execute_sql(
+            'SELECT vkey, vmove, vscore, vwin, vdraw, vlost FROM bhobk WHERE vvalid = 1'):
+        iccs = CoordMap[vmove & 0xff] + CoordMap[vmove >> 8]
+        yield makeRecord(vkey, iccs, vscore, vwin, vdraw, vlost)
+
+def readPfBook(db):
+    for vkey, vmove, vscore, vwin, vdraw, vlost in db.execute_sql(
+            'SELECT vkey, vmove, vscore, vwin, vdraw, vlost FROM pfBook WHERE vvalid = 1'):
+        iccs = CoordMap[vmove >> 8] + CoordMap[vmove & 0xff]
+        yield makeRecord(vkey, iccs, vscore, vwin, vdraw, vlost)
+
+#evbook和localbook的key为规范局面的zhash，evbook的mirror着法要换算到规范局面方向
+def readEvBook(db):
+    for key, mirror, score, iccs in db.execute_sql('SELECT key, mirror, score, iccs FROM evbook'):
+        if mirror:
+            iccs = iccs_mirror(iccs)
+        yield makeRecord(key, iccs, score)
+
+def readLocalBook(db):
+    for key, iccs, score in db.execute_sql('SELECT key, iccs, score FROM book'):
+        yield makeRecord(key, iccs, score)
+
+BookReaders = {
+    'bhobk': readYfk,
+    'pfBook': readPfBook,
+    'evbook': readEvBook,
+    'book': readLocalBook,
+}
+
+def readBook(file_name):
+    db = SqliteExtDatabase(file_name)
+    tables = db.get_tables()
+    for table, reader in BookReaders.items():
+        if table not in tables:
+            continue
+        if (table == 'book') and ('key' not in [x.name for x in db.get_columns('book')]):
+            raise Exception(f'{file_name} 是旧格式的本地库，请先在程序中打开一次完成转换')
+        records = list(reader(db))
+        db.close()
+        return records
+
+    db.close()
+    raise Exception(f'{file_name} 不是支持的开局库文件')
+
+#-----------------------------------------------------#
+def exportBinBook(out_file, book_files):
+    records = {}
+    for file_name in book_files:
+        count = 0
+        for record in readBook(file_name):
+            if record[:2] in records:
+                continue
+            records[record[:2]] = record
+            count += 1
+        logging.info(f'{file_name}：{count} 条记录')
+
+    #按zhash升序，同一局面按分数降序
+    rows = sorted(records.values(), key = lambda x: (x[0], -x[2]))
+
+    with open(out_file, 'wb') as f:
+        f.write(BIN_BOOK_HEADER.pack(BIN_BOOK_MAGIC, BIN_BOOK_VERSION, BIN_BOOK_RECORD.size, len(rows)))
+        buf = bytearray(BIN_BOOK_RECORD.size * len(rows))
+        for i, row in enumerate(rows):
+            BIN_BOOK_RECORD.pack_into(buf, i * BIN_BOOK_RECORD.size, *row)
+        f.write(buf)
+
+    return len(rows)
+
+#-----------------------------------------------------#
+if __name__ == '__main__':
+
+    logging.basicConfig(level = logging.INFO, format = '%(message)s')
+
+    if len(sys.argv) < 3:
+        print('Usage: python -m ChessUI.BinBook out_file.evb book_file [book_file ...]')
+        sys.exit(-1)
+
+    count = exportBinBook(Path(sys.argv[1]), sys.argv[2:])
+    print(f'导出 {count} 条记录到 {sys.argv[1]}')
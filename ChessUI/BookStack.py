@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from collections import OrderedDict
+
+import cchess
+
+from .LocalDB import BookProbe
+
+#-----------------------------------------------------#
+#多个开局库按优先级合并查询，规范键值和着法的中文/新局面每个局面只计算一次，合并结果按局面缓存
+#score_rule：
+#   first  取优先级最高的库中的分数
+#   max    取各库中(走子方)最高的分数
+#   avg    取各库分数的平均值
+#合并前各库的分数都换算为红方得分(与云库结果一致)，diff和排序按走子方得分
+SCORE_RULES = ['first', 'max', 'avg']
+
+class BookStack():
+    def __init__(self, scoreRule = 'first', cacheSize = 4096):
+        self.books = []
+        self.scoreRule = scoreRule if scoreRule in SCORE_RULES else 'first'
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()
+
+    #priority越大越优先，mark不为空时，该库中的着法加上此标记
+    def addBook(self, name, book, priority = 0, mark = None):
+        self.books.append({'name': name, 'book': book, 'priority': priority, 'mark': mark})
+        self.books.sort(key = lambda x: x['priority'], reverse = True)
+        self.clearCache()
+
+    def removeBook(self, name):
+        self.books = [x for x in self.books if x['name'] != name]
+        self.clearCache()
+
+    def getBookNames(self):
+        return [x['name'] for x in self.books]
+
+    def close(self):
+        for it in self.books:
+            it['book'].close()
+        self.books = []
+        self.clearCache()
+
+    #库的内容改变后(保存或导入棋谱)要清空缓存
+    def clearCache(self):
+        self.cache.clear()
+
+    #-----------------------------------------------------#
+    #返回的结果调用方可以修改，缓存中保存的是一份拷贝
+    def getMoves(self, fen):
+        if fen in self.cache:
+            self.cache.move_to_end(fen)
+        else:
+            self.cache[fen] = self.probe(fen)
+            if len(self.cache) > self.cacheSize:
+                self.cache.popitem(last = False)
+
+        ret = self.cache[fen]
+        return {
+            'fen': ret['fen'],
+            'score': ret['score'],
+            'actions': OrderedDict((iccs, act.copy()) for iccs, act in ret['actions'].items())
+        }
+
+    def probe(self, fen):
+        probe = BookProbe(fen)
+        sign = -1 if probe.board.get_move_color() == cchess.BLACK else 1
+
+        actions = OrderedDict()
+        scores = {}
+        for it in self.books:
+            try:
+                query = it['book'].getMoves(probe)
+            except Exception as e:
+                logging.error(f"{it['name']} getMoves error: {e}")
+                continue
+
+            if not query:
+                continue
+
+            for iccs, act in query['actions'].items():
+                if iccs not in actions:
+                    actions[iccs] = act.copy()
+                else:
+                    #高优先级库中已有的字段不覆盖
+                    actions[iccs].merge(act)
+                if it['mark']:
+                    actions[iccs]['mark'] = it['mark']
+                if act.get('score') is not None:
+                    score = act['score'] if getattr(it['book'], 'scoreIsRed', False) else act['score'] * sign
+                    scores.setdefault(iccs, []).append(score)
+
+        for iccs, act in actions.items():
+            if iccs not in scores:
+                continue
+            act['score'] = self.combineScore(scores[iccs], sign)
+
+        #有分数的着法按走子方得分排在前面，其余保持库的优先级顺序
+        scored = sorted([x for x in actions.items() if x[0] in scores], 
+                            key = lambda x: x[1]['score'] * sign, reverse = True)
+        unscored = [x for x in actions.items() if x[0] not in scores]
+
+        score_best = scored[0][1]['score'] if scored else None
+        for iccs, act in scored:
+            act['diff'] = (act['score'] - score_best) * sign
+
+        return {
+            'fen': fen,
+            'score': score_best,
+            'actions': OrderedDict(scored + unscored)
+        }
+
+    #scores为红方得分，sign为走子方的符号
+    def combineScore(self, scores, sign = 1):
+        if self.scoreRule == 'max':
+            return max(scores, key = lambda x: x * sign)
+        if self.scoreRule == 'avg':
+            return int(sum(scores) / len(scores))
+        return scores[0]
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import logging
+from functools import lru_cache
+from collections import OrderedDict
+
+from cchess import ChessBoard
+
+#-----------------------------------------------------#
+#fen串到zhash的换算需要完整解析一次棋盘，这里缓存最近用到的结果
+@lru_cache(maxsize = 8192)
+def fenKey(fen):
+    return ChessBoard(fen).zhash()
+
+def toKey(fen_or_key):
+    if isinstance(fen_or_key, int):
+        return fen_or_key
+    return fenKey(fen_or_key)
+
+#估算一个局面信息字典所占内存(字节)，actions等嵌套的字典和列表逐层计入
+def sizeOfInfo(info):
+    size = sys.getsizeof(info)
+    if isinstance(info, dict):
+        for k, v in info.items():
+            size += sys.getsizeof(k) + sizeOfInfo(v)
+    elif isinstance(info, (list, tuple, set)):
+        size += sum(sizeOfInfo(x) for x in info)
+    return size
+
+#-----------------------------------------------------#
+#局面缓存，以zhash为键，按LRU规则淘汰，当前棋谱中的局面不会被淘汰
+class PositionCache():
+    def __init__(self, maxEntries = 200000, maxBytes = 256 * 1024 * 1024, maxMissed = 20000):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.maxMissed = maxMissed
+
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.dirty = set()
+        self.pinned = set()
+        self.bytesUsed = 0
+        
+        #未命中时调用loader(fen)从持久缓存中加载，返回None表示没有数据
+        self.loader = None
+        #loader中也没有的局面，不再重复查询；持久缓存写入新数据时调用resetMissed清空
+        self.missed = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+
+    def setLimits(self, maxEntries, maxBytes):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self._evict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, fen):
+        key = toKey(fen)
+        if key in self.entries:
+            self.hits += 1
+            return True
+        self.misses += 1
+        
+        if self.loader and isinstance(fen, str) and (key not in self.missed):
+            info = self.loader(fen)
+            if info:
+                self.loads += 1
+                self[fen] = info
+                return True
+            if len(self.missed) >= self.maxMissed:
+                self.missed.clear()
+            self.missed.add(key)
+        return False
+
+    def __getitem__(self, fen):
+        key = toKey(fen)
+        info = self.entries[key]
+        self.entries.move_to_end(key)
+        #调用方会直接修改返回的字典，淘汰前再重新计算大小
+        self.dirty.add(key)
+        return info
+
+    def __setitem__(self, fen, info):
+        key = toKey(fen)
+        self._remove(key)
+        self.missed.discard(key)
+        self.entries[key] = info
+        self.sizes[key] = sizeOfInfo(info)
+        self.bytesUsed += self.sizes[key]
+        self._evict()
+
+    def __delitem__(self, fen):
+        key = toKey(fen)
+        if key not in self.entries:
+            raise KeyError(fen)
+        self._remove(key)
+
+    def get(self, fen, default = None):
+        if fen in self:
+            return self[fen]
+        return default
+
+    def setdefault(self, fen, default):
+        if fen in self:
+            return self[fen]
+        self[fen] = default
+        return default
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.dirty.clear()
+        self.missed.clear()
+        self.bytesUsed = 0
+
+    def resetMissed(self):
+        self.missed.clear()
+
+    #-----------------------------------------------------#
+    #锁定的局面（当前棋谱中的局面）不参与淘汰
+    def pin(self, fen):
+        self.pinned.add(toKey(fen))
+
+    def unpin(self, fen):
+        self.pinned.discard(toKey(fen))
+
+    def setPinned(self, fens):
+        self.pinned = set(toKey(x) for x in fens)
+        self._evict()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytesUsed,
+            'pinned': len(self.pinned),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'loads': self.loads,
+            'hit_rate': (self.hits / total) if total > 0 else 0.0,
+        }
+
+    def logStats(self):
+        logging.info(f'FenCache: {self.stats()}')
+
+    #-----------------------------------------------------#
+    def _remove(self, key):
+        if key not in self.entries:
+            return
+        del self.entries[key]
+        self.bytesUsed -= self.sizes.pop(key)
+        self.dirty.discard(key)
+
+    def _refreshDirty(self):
+        for key in self.dirty:
+            if key not in self.entries:
+                continue
+            size = sizeOfInfo(self.entries[key])
+            self.bytesUsed += size - self.sizes[key]
+            self.sizes[key] = size
+        self.dirty.clear()
+
+    def _isOverLimit(self):
+        return (len(self.entries) > self.maxEntries) or (self.bytesUsed > self.maxBytes)
+
+    def _evict(self):
+        if not self._isOverLimit():
+            return
+
+        self._refreshDirty()
+
+        #从最久未使用的一端开始淘汰，锁定的局面移到队尾继续保留
+        skipped = 0
+        while self._isOverLimit() and (skipped < len(self.entries)):
+            key = next(iter(self.entries))
+            if key in self.pinned:
+                self.entries.move_to_end(key)
+                skipped += 1
+                continue
+            self._remove(key)
+            self.evictions += 1
+
+#-----------------------------------------------------#
+#引擎主变的中文着法缓存
+#同一局面引擎每次输出的主变大多是上一次的延伸，按着法前缀缓存每一步的中文和走完后的棋盘，
+#局面改变时整个清空
+class PvTextCache():
+    def __init__(self, maxSteps = 20000):
+        self.maxSteps = maxSteps
+        self.fen = None
+        self.board = None
+        self.steps = {}
+
+    def getBoard(self, fen):
+        if fen != self.fen:
+            self.fen = fen
+            self.board = ChessBoard(fen)
+            self.steps = {}
+        return self.board
+
+    def isValidMove(self, fen, iccs):
+        return self.getBoard(fen).is_valid_iccs_move(iccs)
+
+    #返回(ok, 中文着法列表)，有不能走的着法时ok为False
+    def getStepsText(self, fen, moves):
+        board = self.getBoard(fen)
+        if len(self.steps) > self.maxSteps:
+            self.steps = {}
+
+        texts = []
+        key = ''
+        for iccs in moves:
+            key += iccs
+            step = self.steps.get(key)
+            if step is None:
+                move_it = board.copy().move_iccs(iccs)
+                if move_it is None:
+                    return (False, texts + [iccs])
+                step = (move_it.to_text(), move_it.board_done)
+                self.steps[key] = step
+            text, board = step
+            texts.append(text)
+
+        return (True, texts)
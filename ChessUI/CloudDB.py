@@ -1,18 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import time
+import heapq
 import logging
-import threading
 from pathlib import Path
 from collections import OrderedDict
 
-import cchess
 from cchess import ChessBoard
 
-from PySide6.QtCore import QObject, Signal, QUrl, QUrlQuery
-from PySide6.QtNetwork import QNetworkRequest, QNetworkAccessManager
+from PySide6.QtCore import QObject, Signal, QUrl, QUrlQuery, QTimer
+from PySide6.QtNetwork import QNetworkRequest, QNetworkReply, QNetworkAccessManager
 
 from . import Globl
+from .Utils import CLOUD_DB_URL
+from .CloudParser import parseQueryAll, toRedMoves, fromRedMoves, makeResult
 
 #------------------------------------------------------------------------------
 def updateCache(qResult):
@@ -28,6 +29,8 @@ def updateCache(qResult):
             best_moves.append(act['iccs'])
         m = {'score': act['score'], 'diff': act['diff']}
         new_fen = act['new_fen']
+        if not new_fen:
+            continue
         if new_fen not in Globl.fenCache:
             Globl.fenCache[new_fen] = m
         else:
@@ -39,142 +42,322 @@ def updateCache(qResult):
         
 
 #------------------------------------------------------------------------------
+#查询优先级，数字小的先查
+PRIORITY_CURRENT = 0
+PRIORITY_REVIEW = 1
+PRIORITY_PREFETCH = 2
+
+#------------------------------------------------------------------------------
+#云库查询队列：同时在途的请求数有上限，同一个fen只查一次，结果分发给所有等待者，
+#失败后用定时器按指数退避重试，不阻塞界面线程
 class CloudDB(QObject):
     query_result_signal = Signal(dict)
     
-    def __init__(self, parent):
+    def __init__(self, parent, maxInFlight = 4, maxTry = 5, retryDelay = 1000):
         super().__init__(parent)
-        self.url = 'http://www.chessdb.cn/chessdb.php'
+        self.url = CLOUD_DB_URL
         self.net_mgr = QNetworkAccessManager()
         
-        self.reply = None
-        self.fen = None
-        self.board = ChessBoard()
-        self.tryCount = 0
+        self.maxInFlight = maxInFlight
+        self.maxTry = maxTry
+        self.retryDelay = retryDelay
+
+        self.seq = 0
+        self.pending = []
+        self.priority = {}
+        self.waiters = {}
+        self.inFlight = {}
+        self.tryCount = {}
         
+        #fen -> [CloudMove, ...]，分数为走子方得分
         self.move_cache = {}
         
-    def startQuery(self, position, score_limit = 90):
+        #预取：当前局面结果返回后，低优先级查询前几个着法和引擎主变后的局面
+        #按令牌桶限速(每秒prefetchRate个)，整个会话最多发出prefetchBudget个预取请求
+        self.prefetchCount = 3
+        self.prefetchDepth = 4
+        self.prefetchRate = 2.0
+        self.prefetchBudget = 500
+        self.tokens = 1.0
+        self.tokenTime = time.monotonic()
+        self.isTokenWaiting = False
+        self.prefetched = set()
+        self.prefetchSent = 0
+        self.prefetchHits = 0
+        self.prefetchLateHits = 0
+        self.queryMisses = 0
+    
+    def setPrefetch(self, count, depth, rate, budget):
+        self.prefetchCount = count
+        self.prefetchDepth = depth
+        self.prefetchRate = rate
+        self.prefetchBudget = budget
+
+    #callback为None时结果通过query_result_signal发出
+    def startQuery(self, position, score_limit = 90, priority = PRIORITY_CURRENT, callback = None):
 
         fen = position['fen']
+        waiter = (position['index'], score_limit, callback)
         
-        logging.info(f"Cloud Query: {fen}")
+        if priority != PRIORITY_PREFETCH:
+            self.countPrefetchHit(fen)
+        
+        #换了局面，还没发出的旧预取就没用了
+        if priority == PRIORITY_CURRENT:
+            self.cancelQueries(PRIORITY_PREFETCH)
 
         if fen in self.move_cache:
-            ret = self.move_cache[fen]
-            self.query_result_signal.emit(ret)
+            self.deliver(fen, [waiter])
+            if priority == PRIORITY_CURRENT:
+                self.prefetchResult(makeResult(fen, self.move_cache[fen]))
             return 
-             
-        if (self.reply is not None) and (not self.reply.isFinished()):
-            self.reply.abort()
         
-        self.index = position['index']
-        self.fen = fen
-        self.board.from_fen(fen)
-        self.score_limit = score_limit    
+        #本地分析缓存库中已有云库结果，不再联网查询
+        if Globl.analysisStore:
+            info = Globl.analysisStore.getEval(fen, 'cloud')
+            if info and info['moves']:
+                self.move_cache[fen] = fromRedMoves(fen, info['moves'].items())
+                ret = makeResult(fen, self.move_cache[fen])
+                updateCache(ret)
+                self.deliver(fen, [waiter], ret)
+                if priority == PRIORITY_CURRENT:
+                    self.prefetchResult(ret)
+                elif priority == PRIORITY_PREFETCH:
+                    self.prefetched.add(fen)
+                return
         
+        #已经在查询中的fen只增加等待者
+        if fen in self.waiters:
+            self.waiters[fen].append(waiter)
+            if priority < self.priority[fen]:
+                self.priority[fen] = priority
+                self.push(fen)
+            self.pump()
+            return
+
+        logging.info(f"Cloud Query: {fen}")
+        
+        self.waiters[fen] = [waiter]
+        self.priority[fen] = priority
+        self.tryCount[fen] = 0
+        self.push(fen)
+        self.pump()
+    
+    #取消某个优先级及更低优先级中还没有发出的查询
+    def cancelQueries(self, priority):
+        for fen in list(self.waiters.keys()):
+            if (fen not in self.inFlight) and (self.priority[fen] >= priority):
+                self.removeQuery(fen)
+    
+    def pendingCount(self):
+        return len(self.waiters)
+
+    #-----------------------------------------------------#
+    #当前局面的查询后来的先查(快速翻动棋谱时最后停留的局面最先返回)，其他按先来后到
+    def push(self, fen):
+        self.seq += 1
+        priority = self.priority[fen]
+        order = -self.seq if priority == PRIORITY_CURRENT else self.seq
+        heapq.heappush(self.pending, (priority, order, fen))
+
+    def pump(self):
+        while self.pending and (len(self.inFlight) < self.maxInFlight):
+            priority, order, fen = self.pending[0]
+            #已经取消、已经发出或者优先级已提升的旧条目
+            if (fen not in self.waiters) or (fen in self.inFlight) or (priority != self.priority[fen]):
+                heapq.heappop(self.pending)
+                continue
+            
+            if priority == PRIORITY_PREFETCH:
+                if self.prefetchSent >= self.prefetchBudget:
+                    self.cancelQueries(PRIORITY_PREFETCH)
+                    continue
+                if not self.takeToken():
+                    self.waitToken()
+                    return
+                self.prefetchSent += 1
+
+            heapq.heappop(self.pending)
+            self.sendQuery(fen)
+    
+    def sendQuery(self, fen):
         url = QUrl(self.url)
         query = QUrlQuery()
         query.addQueryItem('board', fen)
         query.addQueryItem("action", 'queryall')
         url.setQuery(query)
         
-        self.tryCount = 1
-        self.req = QNetworkRequest(url)
-        self.reply = self.net_mgr.get(self.req)
-        self.reply.finished.connect(self.onQueryFinished)
-        self.reply.errorOccurred.connect(self.onQueryError)
+        self.tryCount[fen] += 1
+        reply = self.net_mgr.get(QNetworkRequest(url))
+        reply.finished.connect(lambda: self.onQueryFinished(fen, reply))
+        self.inFlight[fen] = reply
+    
+    def removeQuery(self, fen):
+        self.waiters.pop(fen, None)
+        self.priority.pop(fen, None)
+        self.tryCount.pop(fen, None)
+        self.inFlight.pop(fen, None)
+
+    def onQueryFinished(self, fen, reply):
         
-    def onQueryFinished(self):
+        self.inFlight.pop(fen, None)
+        reply.deleteLater()
         
-        if not self.reply:
+        if reply.error() != QNetworkReply.NoError:
+            self.onQueryError(fen, reply.errorString())
+            self.pump()
             return
-        
-        resp = self.reply.readAll().data().decode().rstrip('\0')
+
+        resp = reply.readAll().data().decode().rstrip('\0')
         #logging.info(f"Cloud Query Result: {resp}")
+        
+        moves = parseQueryAll(resp)
+        waiters = self.waiters.get(fen, [])
+        priority = self.priority.get(fen)
+        self.removeQuery(fen)
+        self.pump()
+        
+        #云库中没有这个局面
+        if not moves: 
+            self.deliverEmpty(waiters)
+            return
+        
+        self.move_cache[fen] = moves
+        
+        ret = makeResult(fen, moves)
+        updateCache(ret)
+        
+        if Globl.analysisStore:
+            best_next = [iccs for iccs, act in ret['actions'].items() if act['diff'] == 0]
+            Globl.analysisStore.saveEval(fen, 'cloud', ret['score'], 0, dict(toRedMoves(fen, moves)), best_next)
+
+        self.deliver(fen, waiters, ret)
+
+        if priority == PRIORITY_CURRENT:
+            self.prefetchResult(ret)
+        elif priority == PRIORITY_PREFETCH:
+            self.prefetched.add(fen)
     
-        if resp.lower() in ['', 'unknown']:
-            return {}
+    def onQueryError(self, fen, error):
+        if fen not in self.waiters:
+            return
 
-        move_color = self.board.get_move_color()    
-        moves = []
+        if self.tryCount[fen] < self.maxTry:
+            delay = self.retryDelay * (2 ** (self.tryCount[fen] - 1))
+            logging.warning(f'Query From CloudDB Error: {error}, retry {self.tryCount[fen]} after {delay}ms')
+            QTimer.singleShot(delay, lambda: self.onRetry(fen))
+        else:
+            waiters = self.waiters[fen]
+            self.removeQuery(fen)
+            self.deliverEmpty(waiters)
     
-        #数据分割
-        try:
-            steps = resp.split('|')
-            for index, it in enumerate(steps):
-                segs = it.strip().split(',')
-                items =[x.split(':') for x in segs]
-                it_dict = {}
-                for name, value in items:
-                    if name == 'score':
-                        it_dict['score'] = value
-                    elif name == 'move':
-                        it_dict['iccs'] = value
-                #if index > 3:
-                #    break        
-                moves.append(it_dict)
-        except Exception as e:
-            logging.error(f"云库查询数据解析错误：{e} {resp}")
-            
-        if not moves: 
+    def onRetry(self, fen):
+        if fen not in self.waiters:
             return
+        self.push(fen)
+        self.pump()
+        
+    #-----------------------------------------------------#
+    def prefetch(self, fen):
+        if (fen in self.move_cache) or (fen in self.waiters):
+            return
+        if self.prefetchSent >= self.prefetchBudget:
+            return
+        self.startQuery({'fen': fen, 'index': None}, 0, PRIORITY_PREFETCH)
 
-        score_best = int(moves[0]['score'])
-        for act in moves:
-            move_it = self.board.copy().move_iccs(act['iccs'])
-            if move_it:
-                act['text'] = move_it.to_text()
-            act['score'] = int(act['score']) 
-            act['diff'] =  act['score'] - score_best
-            if move_color == cchess.BLACK:
-                act['score'] = -act['score']
-            act['new_fen'] = move_it.board_done.to_fen()
+    #当前局面分数最好的几个着法之后的局面
+    def prefetchResult(self, ret):
+        for act in list(ret['actions'].values())[:self.prefetchCount]:
+            if act['new_fen']:
+                self.prefetch(act['new_fen'])
 
-            
-        #moves = filter(lambda x : is_odd, moves)        
+    #引擎主变上的局面
+    def prefetchLine(self, fen, moves):
+        board = ChessBoard(fen)
+        for iccs in moves[:self.prefetchDepth]:
+            move_it = board.move_iccs(iccs)
+            if move_it is None:
+                break
+            board = move_it.board_done
+            self.prefetch(board.to_fen())
 
-        #for it in moves:
-        #   if self. score_limit > 0 and abs(it['diff']) >  self.score_limit:
-        #           continue
-        
-        moves =  sorted(moves, key = lambda x:x['diff'], reverse = True) 
-        
-        moves_clean = OrderedDict()
-        score_best = moves[0]['score']
-        for it in moves:
-            it['diff'] =  it['score'] - score_best
-            if move_color == cchess.BLACK :
-                it['diff'] = -it['diff']
-            if self.score_limit > 0 and abs(it['diff']) >  self.score_limit:
-                    continue
-                    
-            moves_clean[it['iccs']] = it
-            
-        ret = {}
-        
-        ret['index'] = self.index
-        ret['fen'] = self.fen
-        ret['score'] = score_best
-        ret['actions'] = moves_clean
-            
-        self.move_cache[self.fen]  = ret
-        
-        updateCache(ret)
+    def takeToken(self):
+        now = time.monotonic()
+        self.tokens = min(max(self.prefetchRate, 1.0), self.tokens + (now - self.tokenTime) * self.prefetchRate)
+        self.tokenTime = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
 
-        self.reply = None
-        self.query_result_signal.emit(ret)
-        
-    def onQueryError(self, error):
-        self.reply = None
-        
-        self.tryCount += 1
-        if self.tryCount < 5:
-            logging.warning(f'Query From CloudDB Error, retry { self.tryCount}')
-            time.sleep(2)
-            self.reply = self.net_mgr.get(self.req)
-            self.reply.finished.connect(self.onQueryFinished)
-            self.reply.errorOccurred.connect(self.onQueryError)
+    def waitToken(self):
+        if self.isTokenWaiting or (self.prefetchRate <= 0):
+            return
+        self.isTokenWaiting = True
+        delay = int((1.0 - self.tokens) / self.prefetchRate * 1000) + 1
+        QTimer.singleShot(delay, self.onTokenReady)
+
+    def onTokenReady(self):
+        self.isTokenWaiting = False
+        self.pump()
+
+    def countPrefetchHit(self, fen):
+        if fen in self.prefetched:
+            self.prefetched.discard(fen)
+            self.prefetchHits += 1
+        elif (fen in self.waiters) and (self.priority[fen] == PRIORITY_PREFETCH):
+            #预取已发出但还没返回
+            self.prefetchLateHits += 1
         else:
-            self.query_result_signal.emit({})
+            self.queryMisses += 1
+
+    def prefetchStats(self):
+        total = self.prefetchHits + self.prefetchLateHits + self.queryMisses
+        return {
+            'sent': self.prefetchSent,
+            'hits': self.prefetchHits,
+            'late_hits': self.prefetchLateHits,
+            'misses': self.queryMisses,
+            'hit_rate': (self.prefetchHits / total) if total > 0 else 0.0,
+        }
+
+    def logStats(self):
+        logging.info(f'CloudDB prefetch: {self.prefetchStats()}')
+
+    #-----------------------------------------------------#
+    def deliver(self, fen, waiters, ret = None):
+        if ret is None:
+            ret = makeResult(fen, self.move_cache[fen])
+        for index, score_limit, callback in waiters:
+            #预取的等待者不需要结果
+            if index is None:
+                continue
+            it = self.filterResult(ret, index, score_limit)
+            if callback:
+                callback(it)
+            else:
+                self.query_result_signal.emit(it)
+
+    def deliverEmpty(self, waiters):
+        for index, score_limit, callback in waiters:
+            if index is None:
+                continue
+            if callback:
+                callback({})
+            else:
+                self.query_result_signal.emit({})
+
+    #每个等待者的局面序号和分差限制不同，各自生成一份结果
+    def filterResult(self, ret, index, score_limit):
+        actions = OrderedDict()
+        for iccs, act in ret['actions'].items():
+            if score_limit > 0 and abs(act['diff']) > score_limit:
+                continue
+            actions[iccs] = act.copy()
         
+        return {
+            'index': index,
+            'fen': ret['fen'],
+            'score': ret['score'],
+            'actions': actions
+        }
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#云库(chessdb.cn) queryall 应答的解析，界面和Tools下的脚本共用
+#应答格式：move:h2e2,score:1,rank:2,note:! (12-00),winrate:50.09|move:...
+#分数是走子方得分，云库已按分数从高到低排列
+
+import re
+import logging
+from collections import namedtuple, OrderedDict
+
+import cchess
+
+from .LocalDB import BookProbe
+
+#-----------------------------------------------------#
+#score为走子方得分，winrate为浮点数，没有的字段为None
+CloudMove = namedtuple('CloudMove', ['move', 'score', 'rank', 'winrate', 'note'])
+
+#云库固定的字段顺序，整个应答用一次findall解析
+CloudItemRe = re.compile(
+    r'move:([a-i]\d[a-i]\d),score:(-?\d+),rank:(\d+),note:([^,|]*),winrate:(\d+(?:\.\d+)?)(?:\||$)')
+
+#没有着法的应答：unknown、invalid board、checkmate、stalemate等
+def isEmptyResp(text):
+    return not text.startswith('move:')
+
+def parseQueryAll(text):
+    text = text.rstrip('\0').strip()
+    if isEmptyResp(text):
+        return []
+
+    items = CloudItemRe.findall(text)
+    if len(items) == text.count('|') + 1:
+        return [CloudMove(move, int(score), int(rank), float(winrate), note)
+                    for move, score, rank, note, winrate in items]
+
+    return parseItems(text)
+
+#字段顺序不固定或有多余字段时的逐项解析，没有着法或分数不是整数(如??)的项丢弃
+def parseItems(text):
+    moves = []
+    for it in text.split('|'):
+        fields = dict(x.partition(':')[::2] for x in it.strip().split(','))
+        try:
+            score = int(fields['score'])
+        except (KeyError, ValueError):
+            score = None
+        if (score is None) or (not fields.get('move')):
+            logging.warning(f'云库应答着法解析错误：{it}')
+            continue
+        rank = fields.get('rank')
+        winrate = fields.get('winrate')
+        moves.append(CloudMove(fields.get('move'), score,
+                        int(rank) if rank and rank.isdigit() else None,
+                        float(winrate) if winrate else None,
+                        fields.get('note')))
+
+    moves.sort(key = lambda x: x.score, reverse = True)
+    return moves
+
+#-----------------------------------------------------#
+#走子方得分换算为红方得分的系数
+def scoreSign(fen):
+    return -1 if cchess.get_move_color(fen) == cchess.BLACK else 1
+
+def toRedMoves(fen, moves):
+    sign = scoreSign(fen)
+    return [(m.move, m.score * sign) for m in moves]
+
+#(iccs, 红方得分)列表(本地分析缓存中保存的格式)还原为CloudMove列表
+def fromRedMoves(fen, red_moves):
+    sign = scoreSign(fen)
+    moves = [CloudMove(iccs, score * sign, None, None, None) for iccs, score in red_moves]
+    moves.sort(key = lambda x: x.score, reverse = True)
+    return moves
+
+#生成界面使用的查询结果：score为红方得分，diff为与最好着法的差(走子方角度，<=0)
+def makeResult(fen, moves, score_limit = 0, probe = None):
+    sign = scoreSign(fen)
+    if probe is None:
+        probe = BookProbe(fen)
+
+    score_best = moves[0].score if moves else None
+    actions = OrderedDict()
+    for m in moves:
+        diff = m.score - score_best
+        if (score_limit > 0) and (-diff > score_limit):
+            continue
+        act = probe.makeMove(m.move)
+        act['score'] = m.score * sign
+        act['diff'] = diff
+        act['rank'] = m.rank
+        act['winrate'] = m.winrate
+        act['note'] = m.note
+        actions[m.move] = act
+
+    return {
+        'fen': fen,
+        'score': score_best * sign if moves else None,
+        'actions': actions
+    }
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+#不依赖Qt的引擎部分：事件驱动的引擎输出读取和bestmove结果的生成
+#界面中的Manager.EngineManager和命令行批量分析Analyzer共用
+
+import time
+import logging
+import threading
+import subprocess
+from collections import OrderedDict
+
+import cchess
+from cchess import ChessBoard, UcciEngine, UciEngine
+from cchess.exception import EngineErrorException
+
+#-----------------------------------------------------#
+#引擎的读取线程每读到一行输出就通知处理线程，处理线程不再每0.1秒轮询一次
+class EventEngineMixIn():
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.outEvent = threading.Event()
+        #最后一次读到bestmove的时间，用来统计到界面收到结果的延迟
+        self.bestMoveTime = None
+
+    #先设置好局面状态再发go命令，否则读取线程可能在状态更新前就处理了新局面的输出
+    def go_from(self, fen, params={}):
+        param_list = [f"{key} {value}" for key, value in params.items()]
+        go_cmd = "go " + ' '.join(param_list)
+
+        self.last_fen = fen
+        self.last_go = go_cmd
+        self.score_dict = {}
+
+        self._send_cmd(f'position fen {fen}')
+        return self._send_cmd(go_cmd)
+
+    def run_once(self):
+        #readline 会阻塞
+        output = self.pout.readline()
+
+        #管道关闭，引擎已退出
+        if output == '':
+            self.running = False
+            self.engine_out_queque.put('bye')
+            self.outEvent.set()
+            return
+
+        output = output.strip()
+        if len(output) > 0:
+            if output.startswith('bestmove'):
+                self.bestMoveTime = time.perf_counter()
+            self.engine_out_queque.put(output)
+            self.outEvent.set()
+
+class EventUcciEngine(EventEngineMixIn, UcciEngine):
+    pass
+
+class EventUciEngine(EventEngineMixIn, UciEngine):
+    pass
+
+def createEngine(engine_type):
+    if engine_type == 'uci':
+        return EventUciEngine('')
+    elif engine_type == 'ucci':
+        return EventUcciEngine('')
+    raise Exception('目前只支持[uci, ucci]类型的引擎。')
+
+#-----------------------------------------------------#
+#引擎的bestmove换算成界面使用的结果，分数为红方得分，着法在board上不能走时返回None
+def makeBestResult(board, action, depth):
+    move_color = board.get_move_color()
+    ret = {}
+    ret.update(action)
+    ret['depth'] = depth
+    iccs = ret['iccs'] = ret.pop('move')
+    m = board.copy().move_iccs(iccs)
+
+    #引擎有时会输出以前的局面的着法，这里预先验证一下能不能走，不能走的着法都忽略掉
+    if m is None:
+        return None
+
+    #分数换算到红方得分
+    if move_color == cchess.BLACK:
+        for key in ['score', 'mate'] :
+            if key in ret:
+                ret[key] = - ret[key]
+
+    #再处理出现mate时，score没分的情况
+    if 'score' not in ret:
+        mate_flag = 1 if ret['mate'] > 0 else -1
+        ret['score'] = 29999 * mate_flag
+
+    new_fen = m.board_done.to_fen()
+    iccs_dict = {'iccs': iccs, 'diff': 0, 'new_fen': new_fen}
+    for key in ['score', 'mate']:
+        if key in ret:
+          iccs_dict[key] = ret[key]
+
+    ret['actions'] = {iccs: iccs_dict}
+    return ret
+
+#多分支时每个分支的第一个着法都是候选着法，score为红方得分，diff为与最好着法的分差(走子方角度)
+def makePVActions(board, pvLines, best_dict):
+    move_color = board.get_move_color()
+    sign = -1 if move_color == cchess.BLACK else 1
+
+    acts = {}
+    for line in pvLines:
+        if not line:
+            continue
+        iccs = line['moves'][0]
+        if iccs in acts:
+            continue
+
+        #引擎输出的上一局面的分支，不能走
+        m = board.copy().move_iccs(iccs)
+        if m is None:
+            continue
+
+        if 'score' in line:
+            score = line['score']
+        elif 'mate' in line:
+            score = 29999 if line['mate'] > 0 else -29999
+        else:
+            continue
+
+        act = {'iccs': iccs, 'score': score * sign, 'new_fen': m.board_done.to_fen(), 'moves': line['moves']}
+        if 'mate' in line:
+            act['mate'] = line['mate'] * sign
+        acts[iccs] = act
+
+    #bestmove总在候选着法中
+    if best_dict['iccs'] not in acts:
+        acts[best_dict['iccs']] = dict(best_dict)
+
+    score_best = max(x['score'] * sign for x in acts.values())
+    for act in acts.values():
+        act['diff'] = act['score'] * sign - score_best
+
+    return OrderedDict((x['iccs'], x) for x in sorted(acts.values(), key = lambda x: x['diff'], reverse = True))
+
+#引擎结果保存到本地分析缓存库的格式：(红方得分, 深度, {iccs: 红方得分}, best_next)
+#多分支分析时所有候选着法的分数一起保存，与最好着法相差5分以内的都算最佳着法
+def makeEvalRecord(fenInfo):
+    iccs = fenInfo.get('iccs', None)
+    score = fenInfo.get('score', None)
+    if (not iccs) or (score is None):
+        return None
+
+    actions = fenInfo.get('actions', {})
+    moves = {x: act['score'] for x, act in actions.items() if act.get('score') is not None}
+    moves[iccs] = score
+    best_next = [iccs] + [x for x, act in actions.items() if (x != iccs) and (act.get('diff', -100) >= -5)]
+
+    return (score, fenInfo.get('depth', 0), moves, best_next)
+
+#-----------------------------------------------------#
+#同步调用的引擎：发出go后在当前线程等待bestmove，用于没有界面的批量分析
+class EngineCore():
+    def __init__(self, id = 0):
+        self.id = id
+        self.engine = None
+        self.name = ''
+        self.multiPV = 1
+
+    def loadEngine(self, engine_path, engine_type, timeout = 30):
+        engine = createEngine(engine_type)
+        if not engine.load(engine_path):
+            return False
+        self.engine = engine
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            action = self.nextAction(deadline - time.monotonic())
+            if action and action['action'] == 'ready':
+                self.name = engine.ids.get('name', '')
+                return True
+        return False
+
+    def setOption(self, name, value):
+        logging.info(f'Engine[{self.id}] setOption: {name} = {value}')
+        self.engine.set_option(name, value)
+        if name == 'MultiPV':
+            self.multiPV = max(1, int(value))
+
+    #引擎已经退出时不再发quit，没响应的引擎直接结束进程
+    def quit(self):
+        engine, self.engine = self.engine, None
+        if (not engine) or (engine.process.poll() is not None):
+            return
+        try:
+            engine.quit()
+            engine.process.wait(timeout = 2)
+        except (EngineErrorException, subprocess.TimeoutExpired):
+            engine.process.kill()
+
+    def nextAction(self, timeout):
+        action = self.engine.get_action()
+        while action is None:
+            if (timeout <= 0) or (not self.engine.running):
+                return None
+            start = time.monotonic()
+            if self.engine.outEvent.wait(min(timeout, 0.5)):
+                self.engine.outEvent.clear()
+            timeout -= time.monotonic() - start
+            action = self.engine.get_action()
+        return action
+
+    #分析一个局面，返回与EngineManager.moveBestSignal相同格式的结果，
+    #引擎认输/被将死时返回{'action': 'dead'/'draw'}，超时或引擎退出返回None
+    def analyse(self, fen, params, fen_engine = None, timeout = 600):
+        board = ChessBoard(fen)
+        pvLines = [None] * self.multiPV
+        depth = 0
+
+        try:
+            self.engine.go_from(fen_engine if fen_engine else fen, params)
+        except EngineErrorException as e:
+            logging.error(f'Engine[{self.id}] {e}')
+            return None
+
+        deadline = time.monotonic() + timeout
+        while True:
+            action = self.nextAction(deadline - time.monotonic())
+            if action is None:
+                return None
+
+            act_id = action['action']
+            if act_id == 'info_move':
+                if 'depth' in action:
+                    depth = action['depth']
+                slot = action.get('multipv', 1)
+                if ('moves' in action) and (1 <= slot <= len(pvLines)):
+                    pvLines[slot - 1] = action
+            elif act_id in ['dead', 'draw']:
+                return {'fen': fen, 'action': act_id}
+            elif act_id == 'bestmove':
+                ret = makeBestResult(board, action, depth)
+                if ret is None:
+                    return None
+                ret['fen'] = fen
+                if self.multiPV > 1:
+                    ret['actions'] = makePVActions(board, pvLines, ret['actions'][ret['iccs']])
+                return ret
+
+#加载引擎并设置分析用的选项，加载失败返回None
+def loadAnalysisEngine(id, engine_path, engine_type, threads = 1, hashMB = 256, multiPV = 1):
+    engine = EngineCore(id)
+    if not engine.loadEngine(engine_path, engine_type):
+        engine.quit()
+        return None
+
+    engine.setOption('ScoreType', 'PawnValueNormalized')
+    engine.setOption('Threads', threads)
+    engine.setOption('Hash', hashMB)
+    if multiPV > 1:
+        engine.setOption('MultiPV', multiPV)
+    return engine
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+
+from PySide6.QtCore import QObject, Signal
+
+from .Manager import EngineManager
+
+#-----------------------------------------------------#
+#引擎进程池：启动多个引擎进程，每个进程Threads = cpu核数 / 进程数，整盘复盘时把局面分给空闲的引擎，
+#结果按完成的顺序返回
+class EnginePool(QObject):
+
+    #fenInfo中带有复盘局面的index和复盘的review_id，被将死或困毙的局面action为dead/draw，没有着法
+    resultSignal = Signal(dict)
+
+    def __init__(self, parent, engine_exec, engine_type, size = 2, hashMB = 256, threads = 0):
+        super().__init__()
+
+        self.parent = parent
+        self.engine_exec = engine_exec
+        self.engine_type = engine_type
+        self.size = max(1, size)
+        self.hashMB = hashMB
+        self.threads = threads if threads > 0 else max(1, (os.cpu_count() or 1) // self.size)
+
+        self.engines = {}
+        self.ready = set()
+        #engine_id -> (position, 开始时间)
+        self.busy = {}
+        self.todo = []
+        self.params = {}
+        self.reviewId = 0
+        self.stats = {}
+        self.startTime = time.monotonic()
+
+    def start(self):
+        for i in range(self.size):
+            engine_id = 100 + i
+            engine = EngineManager(self, id = engine_id)
+            if not engine.loadEngine(self.engine_exec, self.engine_type):
+                logging.error(f'EnginePool: 加载引擎出错 {self.engine_exec}')
+                continue
+            engine.readySignal.connect(self.onEngineReady)
+            engine.moveBestSignal.connect(self.onEngineMoveBest)
+            #被将死或困毙的局面引擎不给出着法，也要作为完成的局面返回，否则引擎一直占着
+            engine.checkmateSignal.connect(self.onEngineNoMove)
+            engine.drawSignal.connect(self.onEngineNoMove)
+            engine.start()
+            self.engines[engine_id] = engine
+            self.stats[engine_id] = {'positions': 0, 'seconds': 0.0}
+
+        return len(self.engines) > 0
+
+    def quit(self):
+        self.cancel()
+        for engine in self.engines.values():
+            engine.quit()
+        self.engines = {}
+        self.ready = set()
+
+    def isIdle(self):
+        return (not self.todo) and (not self.busy)
+
+    #-----------------------------------------------------#
+    #positions为复盘的局面列表，params为引擎go参数，review_id原样带回结果中，调用方用来丢弃以前的复盘的结果
+    def review(self, positions, params, review_id = 0):
+        self.todo = list(positions)
+        self.params = dict(params)
+        self.reviewId = review_id
+        for engine_id in self.stats:
+            self.stats[engine_id] = {'positions': 0, 'seconds': 0.0}
+        self.startTime = time.monotonic()
+        self.dispatch()
+
+    def cancel(self):
+        self.todo = []
+        for engine_id in list(self.busy):
+            self.engines[engine_id].stopThinking()
+        self.busy = {}
+
+    def dispatch(self):
+        for engine_id in sorted(self.ready):
+            if not self.todo:
+                return
+            if engine_id in self.busy:
+                continue
+
+            position = self.todo.pop(0)
+            fen = position['fen']
+            fen_engine = position['move'].to_engine_fen() if 'move' in position else fen
+
+            if self.engines[engine_id].goFrom(fen_engine, fen, self.params):
+                self.busy[engine_id] = (position, time.monotonic())
+            else:
+                logging.error(f'EnginePool: Engine[{engine_id}] goFrom {fen} 出错')
+                self.todo.insert(0, position)
+
+    #-----------------------------------------------------#
+    def onEngineReady(self, engine_id, name, engine_options):
+        engine = self.engines[engine_id]
+        engine.setOption('ScoreType','PawnValueNormalized')
+        engine.setOption('Threads', self.threads)
+        engine.setOption('Hash', self.hashMB)
+        logging.info(f'EnginePool: Engine[{engine_id}] {name} Ready, Threads {self.threads}, Hash {self.hashMB}MB')
+
+        self.ready.add(engine_id)
+        self.dispatch()
+
+    def onEngineMoveBest(self, engine_id, fenInfo):
+        if engine_id not in self.busy:
+            return
+
+        position, start_time = self.busy[engine_id]
+        #引擎输出的上一个局面的结果
+        if fenInfo.get('fen') != position['fen']:
+            return
+
+        self.finishPosition(engine_id, fenInfo)
+
+    def onEngineNoMove(self, engine_id, action):
+        if engine_id not in self.busy:
+            return
+
+        position = self.busy[engine_id][0]
+        self.finishPosition(engine_id, {'fen': position['fen'], 'action': action['action']})
+
+    def finishPosition(self, engine_id, fenInfo):
+        position, start_time = self.busy.pop(engine_id)
+        self.stats[engine_id]['positions'] += 1
+        self.stats[engine_id]['seconds'] += time.monotonic() - start_time
+
+        fenInfo['index'] = position['index']
+        fenInfo['engine_id'] = engine_id
+        fenInfo['review_id'] = self.reviewId
+
+        self.dispatch()
+        self.resultSignal.emit(fenInfo)
+
+    #每个引擎完成的局面数和每分钟局面数
+    def throughput(self):
+        ret = {}
+        for engine_id, it in self.stats.items():
+            per_min = it['positions'] * 60 / it['seconds'] if it['seconds'] > 0 else 0.0
+            ret[engine_id] = {'positions': it['positions'], 'per_min': round(per_min, 1)}
+        return ret
+
+    def logStats(self):
+        used = time.monotonic() - self.startTime
+        total = sum(x['positions'] for x in self.stats.values())
+        logging.info(f'EnginePool: {total} 个局面，用时 {used:.1f}秒，各引擎：{self.throughput()}')
@@ -0,0 +1,622 @@
+# -*- coding: utf-8 -*-
+#棋谱局面索引：把棋谱目录中的所有对局走一遍，记录每个局面出现在哪些对局中
+#   game_position表：(规范键值, 对局, 下一着) -> 步数、结果，WITHOUT ROWID按键值聚簇存放，查一个局面只需一次范围扫描
+#   indexed_game表：对局的文件名、标题、红黑方、结果
+#多个进程并行读取棋谱，由一个写入方按批次在事务中写入；索引过的文件按内容hash记录，再次索引时跳过
+#着法统计(开局浏览)：每个局面每个着法的对局数、红胜/和/黑胜和平均步数，预先汇总后按列存放在gameindex.stats中
+#
+#   python -m ChessUI.GameIndex game_folder [gameindex_db_file]
+
+import os
+import sys
+import time
+import mmap
+import array
+import struct
+import heapq
+import bisect
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cchess
+from cchess import Game, iccs_mirror
+
+from peewee import Proxy, Model, CharField, IntegerField, BigIntegerField, CompositeKey, OperationalError
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+from .LocalDB import getBoardKey, getFenKey, getProbe, packIccs, unpackIccs
+from .Importer import IMPORT_FILE_TYPES, fileDigest
+
+#-----------------------------------------------------#
+INDEX_FILE_TYPES = IMPORT_FILE_TYPES + ['.cbl']
+
+#对局结果，与xqf文件中的编码一致
+RESULT_UNKNOWN = 0
+RESULT_RED_WIN = 1
+RESULT_BLACK_WIN = 2
+RESULT_DRAW = 3
+
+ResultCodes = {'1-0': RESULT_RED_WIN, '0-1': RESULT_BLACK_WIN, '1/2-1/2': RESULT_DRAW}
+ResultTexts = {RESULT_UNKNOWN: '*', RESULT_RED_WIN: '1-0', RESULT_BLACK_WIN: '0-1', RESULT_DRAW: '1/2-1/2'}
+
+#对局在这个局面结束(没有下一着)时，着法记为0
+MOVE_END = 0
+
+#-----------------------------------------------------#
+game_index_db = Proxy()
+
+class IndexedGame(Model):
+    digest = CharField(index=True)
+    name  = CharField()
+    lib_index = IntegerField(default=-1)
+    title = CharField(null=True)
+    red   = CharField(null=True)
+    black = CharField(null=True)
+    result = IntegerField(default=RESULT_UNKNOWN)
+    plies = IntegerField(default=0)
+
+    class Meta:
+        database = game_index_db
+        table_name = 'indexed_game'
+
+#key为规范键值，move为规范局面方向的着法(packIccs编码)，同一对局的多个分支经过同一局面时只记一次
+class GamePosition(Model):
+    key  = BigIntegerField()
+    game = IntegerField()
+    move = IntegerField()
+    ply  = IntegerField()
+    result = IntegerField()
+
+    class Meta:
+        database = game_index_db
+        table_name = 'game_position'
+        primary_key = CompositeKey('key', 'game', 'move')
+        without_rowid = True
+
+class IndexedFile(Model):
+    digest = CharField(unique=True)
+    name  = CharField()
+    games = IntegerField(default=0)
+    indexed = IntegerField(default=0)
+
+    class Meta:
+        database = game_index_db
+        table_name = 'indexed_file'
+
+#-----------------------------------------------------#
+#对局的所有分支走一遍，返回[(key, move, ply), ...]，同一局面同一着法保留最小步数
+#读取棋谱时每一步的局面已经生成，不再重新走子；分支共用的前面几步只处理一次
+def indexGameMoves(game):
+    positions = {}
+    visited = set()
+    plies = 0
+    for line in game.dump_moves():
+        moves = line['moves']
+        for ply, move in enumerate(moves):
+            if id(move) in visited:
+                continue
+            visited.add(id(move))
+            key, is_mirror = getBoardKey(move.board)
+            iccs = str(move)
+            it = (key, packIccs(iccs_mirror(iccs) if is_mirror else iccs))
+            positions[it] = min(ply, positions.get(it, ply))
+        board = moves[-1].board_done if moves else game.init_board
+        key, is_mirror = getBoardKey(board)
+        positions[(key, MOVE_END)] = min(len(moves), positions.get((key, MOVE_END), len(moves)))
+        plies = max(plies, len(moves))
+
+    if not visited:
+        key, is_mirror = getBoardKey(game.init_board)
+        positions[(key, MOVE_END)] = 0
+
+    return ([(key, move, ply) for (key, move), ply in positions.items()], plies)
+
+def makeGameInfo(game, lib_index = -1):
+    info = game.info
+    return {
+        'lib_index': lib_index,
+        'title': info.get('title'),
+        'red': info.get('red'),
+        'black': info.get('black'),
+        'result': ResultCodes.get(info.get('result'), RESULT_UNKNOWN),
+    }
+
+#在工作进程中运行：读取棋谱(或棋库)，返回(文件名, [(对局信息, 局面记录), ...], 错误信息)
+def indexGameFile(file_name):
+    try:
+        if Path(file_name).suffix.lower() == '.cbl':
+            games = Game.read_from_lib(file_name)['games']
+            items = [(makeGameInfo(game, index), game) for index, game in enumerate(games)]
+        else:
+            game = Game.read_from(file_name)
+            items = [(makeGameInfo(game), game)] if game else []
+    except Exception as e:
+        return (file_name, None, str(e))
+
+    if not items:
+        return (file_name, None, '读取棋谱文件错误')
+
+    results = []
+    for info, game in items:
+        records, info['plies'] = indexGameMoves(game)
+        results.append((info, records))
+
+    return (file_name, results, None)
+
+#-----------------------------------------------------#
+#着法统计文件
+#文件头：magic(4) version(H) 列数(H) 记录数(Q) 已统计的最大对局id(Q)
+#各列依次连续存放，记录按(key, move)升序排列，查询时在key列上二分查找；8字节的列放在最前面，保证各列对齐
+MOVE_STATS_MAGIC = b'CCGS'
+MOVE_STATS_VERSION = 1
+MOVE_STATS_HEADER = struct.Struct('<4sHHQQ')
+MOVE_STATS_COLUMNS = [('q', 'key'), ('I', 'count'), ('I', 'red_win'), ('I', 'draw'), ('I', 'black_win'), ('I', 'ply_sum'), ('H', 'move')]
+
+#统计中result对应的列
+ResultColumns = {RESULT_RED_WIN: 1, RESULT_DRAW: 2, RESULT_BLACK_WIN: 3}
+
+class GameMoveStats():
+    def __init__(self):
+        self.fileName = None
+        self.file = None
+        self.buf = None
+        self.columns = {}
+        self.count = 0
+        self.lastGame = 0
+
+        #文件保存以后新加入的对局：key -> {move: [count, red_win, draw, black_win, ply_sum]}
+        self.delta = {}
+        self.lock = threading.Lock()
+
+    #统计文件与索引库不一致时(没有统计文件、程序异常退出或库被替换)从索引库重新汇总
+    def open(self, fileName, db):
+        self.fileName = Path(fileName)
+        last_game = db.execute_sql('SELECT MAX(id) FROM indexed_game').fetchone()[0] or 0
+
+        if (not self.load()) or (self.lastGame != last_game):
+            logging.info(f'重新汇总着法统计：{self.fileName}')
+            self.rebuild(db)
+
+        return True
+
+    def close(self):
+        with self.lock:
+            if self.delta:
+                self.saveMerged()
+            self.unload()
+
+    def load(self):
+        if not self.fileName.is_file():
+            return False
+
+        self.file = open(self.fileName, 'rb')
+        try:
+            self.buf = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+            magic, version, column_count, count, last_game = MOVE_STATS_HEADER.unpack_from(self.buf, 0)
+            if (magic != MOVE_STATS_MAGIC) or (version != MOVE_STATS_VERSION) or (column_count != len(MOVE_STATS_COLUMNS)):
+                raise Exception(f'{self.fileName} 不是着法统计文件')
+
+            #各列直接在映射的文件上按类型解释，不复制数据
+            with memoryview(self.buf) as view:
+                offset = MOVE_STATS_HEADER.size
+                for typecode, name in MOVE_STATS_COLUMNS:
+                    size = count * struct.calcsize(typecode)
+                    if len(self.buf) < offset + size:
+                        raise Exception(f'{self.fileName} 文件不完整')
+                    self.columns[name] = view[offset: offset + size].cast(typecode)
+                    offset += size
+        except Exception as e:
+            logging.error(str(e))
+            self.unload()
+            return False
+
+        self.count = count
+        self.lastGame = last_game
+        return True
+
+    def unload(self):
+        #映射上的memoryview全部释放后才能关闭文件
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        self.count = 0
+        if self.buf:
+            self.buf.close()
+        if self.file:
+            self.file.close()
+        self.buf = None
+        self.file = None
+
+    #rows为按(key, move)升序排列、列顺序与MOVE_STATS_COLUMNS一致的记录，先写临时文件再替换
+    def write(self, rows, last_game):
+        self.unload()
+
+        columns = list(zip(*rows)) if rows else [[] for x in MOVE_STATS_COLUMNS]
+        tmp_file = self.fileName.with_suffix('.tmp')
+        with open(tmp_file, 'wb') as f:
+            f.write(MOVE_STATS_HEADER.pack(MOVE_STATS_MAGIC, MOVE_STATS_VERSION, len(MOVE_STATS_COLUMNS), len(rows), last_game))
+            for (typecode, name), values in zip(MOVE_STATS_COLUMNS, columns):
+                f.write(array.array(typecode, values).tobytes())
+        os.replace(tmp_file, self.fileName)
+
+        self.delta = {}
+        self.load()
+
+    def rebuild(self, db):
+        with self.lock:
+            last_game = db.execute_sql('SELECT MAX(id) FROM indexed_game').fetchone()[0] or 0
+            rows = db.execute_sql('SELECT key, COUNT(*), SUM(result = 1), SUM(result = 3), SUM(result = 2), SUM(ply), move '
+                                  'FROM game_position WHERE move != 0 GROUP BY key, move ORDER BY key, move').fetchall()
+            self.write(rows, last_game)
+
+    #文件中的记录与新加入的对局按(key, move)顺序合并
+    def saveMerged(self):
+        base = zip(*[self.columns[name] for typecode, name in MOVE_STATS_COLUMNS]) if self.count else []
+        sort_key = lambda x: (x[0], x[-1])
+        delta = sorted(((key, *values, move) for key, moves in self.delta.items() for move, values in moves.items()), key = sort_key)
+
+        rows = []
+        for row in heapq.merge(base, delta, key = sort_key):
+            if rows and (rows[-1][0] == row[0]) and (rows[-1][-1] == row[-1]):
+                last = rows[-1]
+                rows[-1] = (last[0], *[a + b for a, b in zip(last[1:-1], row[1:-1])], last[-1])
+            else:
+                rows.append(row)
+
+        #删除对局后对局数为0的着法不再保存
+        self.write([x for x in rows if x[1] > 0], self.lastGame)
+
+    def save(self):
+        with self.lock:
+            if self.delta:
+                self.saveMerged()
+
+    #-----------------------------------------------------#
+    #records为indexGameMoves返回的[(key, move, ply), ...]，sign为-1时从统计中减去(删除对局)
+    def addGame(self, game_id, records, result, sign = 1):
+        column = ResultColumns.get(result)
+        with self.lock:
+            for key, move, ply in records:
+                if move == MOVE_END:
+                    continue
+                values = self.delta.setdefault(key, {}).setdefault(move, [0, 0, 0, 0, 0])
+                values[0] += sign
+                if column:
+                    values[column] += sign
+                values[4] += ply * sign
+            if sign > 0:
+                self.lastGame = max(self.lastGame, game_id)
+
+    def removeGame(self, game_id, records, result):
+        self.addGame(game_id, records, result, -1)
+
+    #返回规范局面的{move: [count, red_win, draw, black_win, ply_sum]}
+    def getRecords(self, key):
+        records = {}
+        with self.lock:
+            if self.count:
+                keys = self.columns['key']
+                index = bisect.bisect_left(keys, key)
+                while (index < self.count) and (keys[index] == key):
+                    records[self.columns['move'][index]] = [self.columns[name][index] for name in ['count', 'red_win', 'draw', 'black_win', 'ply_sum']]
+                    index += 1
+
+            for move, values in self.delta.get(key, {}).items():
+                old = records.get(move, [0, 0, 0, 0, 0])
+                records[move] = [a + b for a, b in zip(old, values)]
+
+        return {move: values for move, values in records.items() if values[0] > 0}
+
+    #与开局库相同的返回格式，统计信息放在着法的games字段中，按对局数降序
+    def getMoves(self, fen):
+        probe = getProbe(fen)
+        records = self.getRecords(probe.key)
+        if not records:
+            return None
+
+        actions = OrderedDict()
+        for move, (count, red_win, draw, black_win, ply_sum) in sorted(records.items(), key = lambda x: x[1][0], reverse = True):
+            iccs = unpackIccs(move)
+            if probe.is_mirror:
+                iccs = iccs_mirror(iccs)
+            m = probe.makeMove(iccs)
+            m['games'] = {
+                'count': count,
+                'red_win': red_win,
+                'draw': draw,
+                'black_win': black_win,
+                'avg_ply': round(ply_sum / count, 1),
+            }
+            actions[iccs] = m
+
+        return {'fen': probe.fen, 'score': None, 'actions': actions}
+
+#-----------------------------------------------------#
+class GameIndex():
+    def __init__(self):
+        self.db = None
+        self.moveStats = GameMoveStats()
+
+    def open(self, fileName):
+        self.db = SqliteExtDatabase(fileName, pragmas=(
+            ('cache_size', -1024 * 32),
+            ('journal_mode', 'wal'),
+            ('synchronous', 1)))
+        game_index_db.initialize(self.db)
+        game_index_db.create_tables([IndexedGame, GamePosition, IndexedFile], safe = True)
+
+        self.moveStats.open(Path(fileName).with_suffix('.stats'), self.db)
+
+        return True
+
+    def close(self):
+        if self.db:
+            self.moveStats.close()
+            self.db.close()
+        self.db = None
+
+    def getIndexedDigests(self):
+        return set(x.digest for x in IndexedFile.select(IndexedFile.digest))
+
+    def getGameCount(self):
+        return IndexedGame.select().count()
+
+    #一个文件的所有对局在调用方的事务中写入，返回[(对局id, 局面记录, 结果), ...]，事务提交后再计入着法统计
+    def saveFile(self, digest, file_name, games):
+        added = []
+        for info, records in games:
+            game_id = IndexedGame.insert(digest = digest, name = file_name, **info).execute()
+            rows = [(key, game_id, move, ply, info['result']) for key, move, ply in records]
+            for i in range(0, len(rows), 5000):
+                GamePosition.insert_many(rows[i:i + 5000], fields = [GamePosition.key, GamePosition.game,
+                                    GamePosition.move, GamePosition.ply, GamePosition.result]).execute()
+            added.append((game_id, records, info['result']))
+
+        IndexedFile.insert(digest = digest, name = file_name, games = len(games),
+                           indexed = int(time.time())).on_conflict_ignore().execute()
+
+        return added
+
+    #删除以前按同一文件名索引的对局(文件被重新保存)，在调用方的事务中执行，返回值与saveFile相同
+    def removeFile(self, file_name):
+        removed = []
+        for it in IndexedGame.select(IndexedGame.id, IndexedGame.result).where(IndexedGame.name == file_name):
+            records = list(GamePosition.select(GamePosition.key, GamePosition.move, GamePosition.ply)
+                                .where(GamePosition.game == it.id).tuples())
+            GamePosition.delete().where(GamePosition.game == it.id).execute()
+            removed.append((it.id, records, it.result))
+
+        IndexedGame.delete().where(IndexedGame.name == file_name).execute()
+        IndexedFile.delete().where(IndexedFile.name == file_name).execute()
+
+        return removed
+
+    #单个棋谱文件(如刚保存的对局)加入索引，内容没变的文件跳过，内容变了的替换原来的记录
+    #在界面线程中调用，索引线程正在写入时库被锁住，这次先不加入，下次索引目录时会补上
+    def addFile(self, file_name):
+        if not self.db:
+            return False
+
+        file_name = str(file_name)
+        digest = fileDigest(file_name)
+        if IndexedFile.get_or_none(IndexedFile.digest == digest):
+            return False
+
+        file_name, games, error = indexGameFile(file_name)
+        if games is None:
+            logging.warning(f'索引棋谱失败：{file_name} {error}')
+            return False
+
+        try:
+            with self.db.atomic():
+                removed = self.removeFile(file_name)
+                added = self.saveFile(digest, file_name, games)
+        except OperationalError as e:
+            logging.warning(f'索引棋谱失败：{file_name} {e}')
+            return False
+
+        for game_id, records, result in removed:
+            self.moveStats.removeGame(game_id, records, result)
+        for game_id, records, result in added:
+            self.moveStats.addGame(game_id, records, result)
+
+        return True
+
+    #-----------------------------------------------------#
+    #经过局面的对局，按索引的顺序取前limit局，同一对局只列一次；next_iccs为当前局面方向的下一着
+    def findGames(self, fen, limit = 200):
+        if not self.db:
+            return []
+
+        key, is_mirror = getFenKey(fen)
+        #sqlite中与MIN()一起查询的列取自最小值所在的行，即最早经过局面的那一步的下一着
+        #按主键顺序分组不用排序，取够limit局就停止扫描
+        sql = ('SELECT game, MIN(ply), move FROM game_position WHERE key = ? '
+               'GROUP BY game ORDER BY game LIMIT ?')
+
+        found = OrderedDict()
+        for game_id, ply, move in self.db.execute_sql(sql, (key, limit)):
+            found[game_id] = (ply, move)
+
+        games = []
+        rows = {x.id: x for x in IndexedGame.select().where(IndexedGame.id.in_(list(found)))}
+        for game_id, (ply, move) in found.items():
+            it = rows.get(game_id)
+            if not it:
+                continue
+            next_iccs = None
+            if move != MOVE_END:
+                next_iccs = unpackIccs(move)
+                if is_mirror:
+                    next_iccs = iccs_mirror(next_iccs)
+            games.append({
+                'id': game_id,
+                'name': it.name,
+                'lib_index': it.lib_index,
+                'title': it.title,
+                'red': it.red,
+                'black': it.black,
+                'result': ResultTexts[it.result],
+                'plies': it.plies,
+                'ply': ply,
+                'next_iccs': next_iccs,
+            })
+
+        return games
+
+    #局面的着法统计：{iccs: {'count', 'red_win', 'draw', 'black_win', 'avg_ply'}}，按对局数降序
+    def getMoveStats(self, fen):
+        ret = self.moveStats.getMoves(fen)
+        if not ret:
+            return OrderedDict()
+        return OrderedDict((iccs, act['games']) for iccs, act in ret['actions'].items())
+
+    #经过局面的对局数和红胜/和/黑胜局数
+    def getResultStats(self, fen):
+        stats = {'games': 0, 'red_win': 0, 'draw': 0, 'black_win': 0, 'unknown': 0}
+        if not self.db:
+            return stats
+
+        key, is_mirror = getFenKey(fen)
+        names = {RESULT_UNKNOWN: 'unknown', RESULT_RED_WIN: 'red_win', RESULT_DRAW: 'draw', RESULT_BLACK_WIN: 'black_win'}
+        sql = ('SELECT result, COUNT(*) FROM (SELECT game, result FROM game_position WHERE key = ? GROUP BY game) '
+               'GROUP BY result')
+        for result, count in self.db.execute_sql(sql, (key,)):
+            stats[names.get(result, 'unknown')] += count
+            stats['games'] += count
+        return stats
+
+    def query(self, fen, limit = 200):
+        return {
+            'fen': fen,
+            'stats': self.getResultStats(fen),
+            'moves': self.getMoveStats(fen),
+            'games': self.findGames(fen, limit),
+        }
+
+#-----------------------------------------------------#
+class GameIndexer():
+    def __init__(self, index, folder, workers = None, batchSize = 200000):
+        self.index = index
+        self.folder = Path(folder)
+        self.workers = workers
+        self.batchSize = batchSize
+
+        #progress(done, total, file_name)，finished(stats)，都在索引线程中调用
+        self.progress = None
+        self.finished = None
+
+        self.isRunning = False
+        self.stats = {}
+
+    def stop(self):
+        self.isRunning = False
+
+    def scanFiles(self):
+        files = [x for x in sorted(self.folder.rglob('*')) if x.suffix.lower() in INDEX_FILE_TYPES]
+
+        indexed = self.index.getIndexedDigests()
+        todo = {}
+        for file_name in files:
+            digest = fileDigest(file_name)
+            if (digest in indexed) or (digest in todo):
+                self.stats['skipped'] += 1
+                continue
+            todo[digest] = file_name
+
+        return todo
+
+    def run(self):
+        self.isRunning = True
+        self.stats = {'files': 0, 'games': 0, 'positions': 0, 'skipped': 0, 'failed': 0, 'seconds': 0}
+        start_time = time.time()
+
+        todo = self.scanFiles()
+        total = len(todo)
+
+        files = []
+        count = 0
+        done = 0
+        with ProcessPoolExecutor(max_workers = self.workers) as pool:
+            futures = { pool.submit(indexGameFile, str(file_name)): digest for digest, file_name in todo.items() }
+            for future in as_completed(futures):
+                if not self.isRunning:
+                    pool.shutdown(cancel_futures = True)
+                    break
+
+                file_name, games, error = future.result()
+                done += 1
+                if games is None:
+                    logging.warning(f'索引棋谱失败：{file_name} {error}')
+                    self.stats['failed'] += 1
+                else:
+                    files.append((futures[future], file_name, games))
+                    count += sum(len(records) for info, records in games)
+                    self.stats['files'] += 1
+                    self.stats['games'] += len(games)
+
+                if count >= self.batchSize:
+                    self.flush(files)
+                    files = []
+                    count = 0
+
+                if self.progress:
+                    self.progress(done, total, file_name)
+
+        self.flush(files)
+        #新对局的着法统计合并到统计文件
+        self.index.moveStats.save()
+
+        self.stats['seconds'] = round(time.time() - start_time, 1)
+        self.isRunning = False
+
+        logging.info(f'索引棋谱完成：{self.stats}')
+        if self.finished:
+            self.finished(self.stats)
+
+        return self.stats
+
+    #对局、局面和文件记录在同一个事务里写入，中途退出时未写入的文件下次会重新索引
+    def flush(self, files):
+        if not files:
+            return
+        added = []
+        with self.index.db.atomic():
+            for digest, file_name, games in files:
+                added.extend(self.index.saveFile(digest, file_name, games))
+                self.stats['positions'] += sum(len(records) for info, records in games)
+
+        for game_id, records, result in added:
+            self.index.moveStats.addGame(game_id, records, result)
+
+#-----------------------------------------------------#
+def printProgress(done, total, file_name):
+    if (done % 50 == 0) or (done == total):
+        print(f'\r{done}/{total}', end = '', flush = True)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) not in [2, 3]:
+        print('Usage: python -m ChessUI.GameIndex game_folder [gameindex_db_file]')
+        sys.exit(-1)
+
+    db_file = sys.argv[2] if len(sys.argv) == 3 else Path('Game', 'gameindex.db')
+
+    index = GameIndex()
+    index.open(db_file)
+
+    indexer = GameIndexer(index, sys.argv[1])
+    indexer.progress = printProgress
+    stats = indexer.run()
+    print()
+    print(stats)
+
+    start = time.perf_counter()
+    ret = index.query(cchess.FULL_INIT_FEN)
+    used = (time.perf_counter() - start) * 1000
+    print(f"开局局面：{ret['stats']}，{len(ret['moves'])} 种着法，查询用时 {used:.1f} 毫秒")
+
+    index.close()
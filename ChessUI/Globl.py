@@ -1,2 +1,8 @@
 
-fenCache = {}
+from .Cache import PositionCache, PvTextCache
+
+fenCache = PositionCache()
+pvTextCache = PvTextCache()
+analysisStore = None
+gameIndex = None
+bookStack = None
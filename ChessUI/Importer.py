@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#棋谱目录批量导入本地库
+#多个进程并行读取棋谱并换算成规范着法(key, iccs)，由一个写入方按批次在事务中写入localbook.db
+#导入过的文件按内容hash记录在imported_file表中，再次导入时跳过
+
+import sys
+import time
+import hashlib
+import logging
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cchess import ChessBoard, Game, iccs_mirror
+
+from .LocalDB import LocalBook, getBoardKey
+
+#-----------------------------------------------------#
+IMPORT_FILE_TYPES = ['.xqf', '.pgn', '.cbr']
+
+def fileDigest(file_name):
+    with open(file_name, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+#在工作进程中运行：读取棋谱，按所有分支走一遍，返回(文件名, [(key, iccs), ...], 对局结果, 错误信息)
+def readGameFile(file_name):
+    try:
+        game = Game.read_from(file_name)
+    except Exception as e:
+        return (file_name, None, None, str(e))
+
+    if not game:
+        return (file_name, None, None, '读取棋谱文件错误')
+
+    init_fen = game.init_board.to_fen()
+    result = game.info.get('result')
+
+    records = []
+    for moves in game.dump_iccs_moves():
+        board = ChessBoard(init_fen)
+        for iccs in moves:
+            key, is_mirror = getBoardKey(board)
+            move_it = board.move_iccs(iccs)
+            if not move_it:
+                break
+            records.append((key, iccs_mirror(iccs) if is_mirror else iccs))
+            board = move_it.board_done
+
+    return (file_name, records, result, None)
+
+#-----------------------------------------------------#
+class GameImporter():
+    def __init__(self, book, folder, workers = None, batchSize = 50000):
+        self.book = book
+        self.folder = Path(folder)
+        self.workers = workers
+        self.batchSize = batchSize
+
+        #progress(done, total, file_name)，finished(stats)，都在导入线程中调用
+        self.progress = None
+        self.finished = None
+
+        self.isRunning = False
+        self.stats = {}
+
+    def stop(self):
+        self.isRunning = False
+
+    def scanFiles(self):
+        files = [x for x in sorted(self.folder.rglob('*')) if x.suffix.lower() in IMPORT_FILE_TYPES]
+
+        imported = self.book.getImportedDigests()
+        todo = {}
+        for file_name in files:
+            digest = fileDigest(file_name)
+            if (digest in imported) or (digest in todo):
+                self.stats['skipped'] += 1
+                continue
+            todo[digest] = file_name
+
+        return todo
+
+    def run(self):
+        self.isRunning = True
+        self.stats = {'files': 0, 'skipped': 0, 'failed': 0, 'moves': 0, 'new_moves': 0, 'seconds': 0}
+        start_time = time.time()
+
+        todo = self.scanFiles()
+        total = len(todo)
+
+        records = []
+        files = []
+        done = 0
+        with ProcessPoolExecutor(max_workers = self.workers) as pool:
+            futures = { pool.submit(readGameFile, str(file_name)): digest for digest, file_name in todo.items() }
+            for future in as_completed(futures):
+                if not self.isRunning:
+                    pool.shutdown(cancel_futures = True)
+                    break
+
+                file_name, moves, result, error = future.result()
+                done += 1
+                if moves is None:
+                    logging.warning(f'导入棋谱失败：{file_name} {error}')
+                    self.stats['failed'] += 1
+                else:
+                    #imported_file表中按结果记录对局数
+                    results = {result: 1} if result else {}
+                    records.extend(moves)
+                    files.append((futures[future], file_name, 1, len(moves), results))
+                    self.stats['files'] += 1
+                    self.stats['moves'] += len(moves)
+
+                if len(records) >= self.batchSize:
+                    self.flush(records, files)
+                    records = []
+                    files = []
+
+                if self.progress:
+                    self.progress(done, total, file_name)
+
+        self.flush(records, files)
+
+        self.stats['seconds'] = round(time.time() - start_time, 1)
+        self.isRunning = False
+
+        logging.info(f'导入棋谱完成：{self.stats}')
+        if self.finished:
+            self.finished(self.stats)
+
+        return self.stats
+
+    #着法和文件记录在同一个事务里写入，中途退出时未写入的文件下次会重新导入
+    def flush(self, records, files):
+        if not files:
+            return
+        with self.book.db_local.atomic():
+            self.stats['new_moves'] += self.book.saveRecords(records)
+            for digest, file_name, games, moves, results in files:
+                self.book.saveImportedFile(digest, file_name, games, moves, results)
+
+#-----------------------------------------------------#
+def printProgress(done, total, file_name):
+    if (done % 50 == 0) or (done == total):
+        print(f'\r{done}/{total}', end = '', flush = True)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) not in [2, 3]:
+        print('Usage: python -m ChessUI.Importer game_folder [localbook_db_file]')
+        sys.exit(-1)
+
+    db_file = sys.argv[2] if len(sys.argv) == 3 else Path('Game', 'localbook.db')
+
+    book = LocalBook()
+    book.open(db_file)
+
+    importer = GameImporter(book, sys.argv[1])
+    importer.progress = printProgress
+    stats = importer.run()
+    print()
+    print(stats)
+
+    book.close()
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import time
+import mmap
+import struct
+import bisect
 import logging
 import threading
 from pathlib import Path
@@ -9,12 +12,137 @@ from collections import OrderedDict
 import cchess
 from cchess import ChessBoard
 
-from peewee import Proxy, Model, CharField, IntegerField, BigIntegerField, TextField, BlobField
+from peewee import chunked, Proxy, Model, CharField, IntegerField, BigIntegerField, BooleanField, TextField, BlobField
 from playhouse.sqlite_ext import SqliteExtDatabase, JSONField
 from playhouse.shortcuts import model_to_dict, dict_to_model
 
 from . import Globl
         
+#----------------------------------------------------------------
+#局面的规范键值：局面与其镜像局面的zhash取较小者，同时返回当前局面是否为镜像
+def getBoardKey(board):
+    zhash = board.zhash()
+    zhash_mirror = board.mirror().zhash()
+    if zhash_mirror < zhash:
+        return (zhash_mirror, True)
+    return (zhash, False)
+
+def getFenKey(fen):
+    return getBoardKey(ChessBoard(fen))
+
+#一次查询用到的局面信息，多个库共用，只计算一次zhash和着法的中文/新局面
+class BookProbe():
+    def __init__(self, fen):
+        self.fen = fen
+        self.board = ChessBoard(fen)
+        self.zhash = self.board.zhash()
+        self.zhash_mirror = self.board.mirror().zhash()
+        self.is_mirror = (self.zhash_mirror < self.zhash)
+        self.key = self.zhash_mirror if self.is_mirror else self.zhash
+        self.moves = {}
+
+    #返回(text, new_fen)，着法不合法时返回None
+    def getMove(self, iccs):
+        if iccs not in self.moves:
+            move_it = self.board.copy().move_iccs(iccs)
+            if move_it is None:
+                self.moves[iccs] = None
+            else:
+                self.moves[iccs] = (move_it.to_text(), move_it.board_done.to_fen())
+        return self.moves[iccs]
+
+    #book getMoves返回的着法，中文和新局面在第一次用到时才计算
+    def makeMove(self, iccs):
+        return BookMove(self, iccs)
+
+#book getMoves返回的着法记录，text和new_fen在第一次读取时才由BookProbe计算，着法不合法时new_fen为None
+#遍历、复制为普通字典(dict()、**、update、items/values)时先计算；库之间合并同一着法的字段用merge，不触发计算
+BOOK_MOVE_LAZY_KEYS = ('text', 'new_fen')
+
+class BookMove(dict):
+    __slots__ = ('probe',)
+
+    def __init__(self, probe, iccs):
+        super().__init__(iccs = iccs)
+        self.probe = probe
+
+    def decorate(self):
+        probe, self.probe = self.probe, None
+        if probe is None:
+            return
+
+        iccs = dict.__getitem__(self, 'iccs')
+        move_it = probe.getMove(iccs)
+        if move_it is not None:
+            text, new_fen = move_it
+        else:
+            text, new_fen = f'err:{iccs}', None
+            logging.error(f"{probe.fen} move {iccs} error")
+        dict.setdefault(self, 'text', text)
+        dict.setdefault(self, 'new_fen', new_fen)
+
+    def __missing__(self, key):
+        if (key in BOOK_MOVE_LAZY_KEYS) and self.probe:
+            self.decorate()
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if (key in BOOK_MOVE_LAZY_KEYS) and self.probe:
+            self.decorate()
+        return dict.__contains__(self, key)
+
+    def get(self, key, default = None):
+        if (key in BOOK_MOVE_LAZY_KEYS) and self.probe:
+            self.decorate()
+        return dict.get(self, key, default)
+
+    def pop(self, key, *args):
+        if (key in BOOK_MOVE_LAZY_KEYS) and self.probe:
+            self.decorate()
+        return dict.pop(self, key, *args)
+
+    #定义了__iter__，dict()、**和update也会通过keys()读取，不会绕过计算
+    def __iter__(self):
+        self.decorate()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self.decorate()
+        return dict.keys(self)
+
+    def items(self):
+        self.decorate()
+        return dict.items(self)
+
+    def values(self):
+        self.decorate()
+        return dict.values(self)
+
+    #复制的记录与原记录共用BookProbe，都还没有计算
+    def copy(self):
+        m = BookMove(self.probe, None)
+        dict.update(m, dict.items(self))
+        return m
+
+    #合并其他库中同一着法的字段，已有的字段不覆盖
+    def merge(self, other):
+        fields = dict.items(other) if isinstance(other, BookMove) else other.items()
+        for k, v in fields:
+            dict.setdefault(self, k, v)
+
+def getProbe(fen):
+    if isinstance(fen, BookProbe):
+        return fen
+    return BookProbe(fen)
+
+#着法换算到规范局面的方向
+def getMoveKey(fen, iccs):
+    key, is_mirror = getFenKey(fen)
+    if is_mirror:
+        iccs = cchess.iccs_mirror(iccs)
+    return (key, iccs)
+
 #----------------------------------------------------------------
 #python -m pwiz -e sqlite path/to/sqlite_database.db > 要生成的python文件名称.py
 
@@ -47,9 +175,12 @@ class PosMove(Model):
 master_book_db = Proxy()
 
 #------------------------------------------------------------------------------
+#key为规范键值(局面与镜像局面zhash的较小者)，mirror标记iccs是否为规范局面的镜像方向
+#旧格式的evbook表(key为保存时局面的zhash)请先用Tools/migrate_evbook.py转换
 class MasterEvBook(Model):
     #fen = CharField(unique=True, index=True)
     key   = BigIntegerField()
+    mirror = BooleanField(default=False)
     step  = IntegerField()
     score = IntegerField(null=True)
     iccs  = CharField()
@@ -59,6 +190,9 @@ class MasterEvBook(Model):
     class Meta:
         database = master_book_db
         table_name = 'evbook'
+        indexes = (
+            (('key', 'score', 'iccs', 'mirror', 'mark'), False),
+        )
 
 #------------------------------------------------------------------------------
 #本地库
@@ -71,14 +205,40 @@ class LocalModel(Model):
     
 #------------------------------------------------------------------------------
 
+#key为规范键值，iccs为规范局面方向的着法，(key, iccs)唯一，查询只需一次整数索引查找
 class Book(LocalModel):
-    fen = CharField(index=True)
+    key   = BigIntegerField()
     iccs  = CharField()
     score = IntegerField(null=True)
     memo  = JSONField(null=True)
     
     class Meta:
         table_name = 'book'
+        indexes = (
+            (('key', 'iccs'), True),
+        )
+
+#旧格式的book表(按fen字符串查询)，打开时改名为book_legacy，后台线程逐批转换到新表
+class BookLegacy(LocalModel):
+    fen = CharField(index=True)
+    iccs  = CharField()
+    score = IntegerField(null=True)
+    memo  = JSONField(null=True)
+    
+    class Meta:
+        table_name = 'book_legacy'
+
+#已导入的棋谱文件，按文件内容的hash判断是否导入过
+class ImportedFile(LocalModel):
+    digest = CharField(unique=True)
+    name  = CharField()
+    games = IntegerField(default=0)
+    moves = IntegerField(default=0)
+    results = JSONField(null=True)
+    imported = IntegerField(default=0)
+    
+    class Meta:
+        table_name = 'imported_file'
 
 #------------------------------------------------------------------------------
 class Bookmark(LocalModel):
@@ -92,35 +252,33 @@ class Bookmark(LocalModel):
 #------------------------------------------------------------------------------
 
 class MoveBookMixIn():
+    #getMoves返回的score为红方得分，其他库为走子方得分
+    scoreIsRed = True
+
     #def __init__(self):
     #    self.book_cls = book_cls
         
     def getMoves(self, fen):
         
-        query = self.getRecord(fen)
+        probe = getProbe(fen)
+        query = self.getRecord(probe)
         if not query:
             return {}
 
-        records, record_state = query    
+        records, is_mirror = query    
         actions = OrderedDict()    
         score_best = None
-        board = ChessBoard(fen)
-        move_color = board.get_move_color()        
+        move_color = probe.board.get_move_color()        
         
         for item in records:
-            ics = item.iccs
+            iccs = self.recordIccs(item, is_mirror)
+            if iccs in actions:
+                continue
+            
             score = item.score
-            if record_state == 'mirror':
-                iccs = cchess.iccs_mirror(ics)
-            else:
-                iccs = ics
-
-            m = {}  
+            
+            m = probe.makeMove(iccs)
             m['mark'] = item.mark
-            m['iccs'] = iccs
-            move_it = board.copy().move_iccs(iccs)
-            m['text'] = move_it.to_text()
-            m['new_fen'] = move_it.board_done.to_fen()
             
             if score is not None:
                 if score_best is  None:
@@ -136,8 +294,8 @@ class MoveBookMixIn():
             actions[iccs] = m
             
         ret = {}
-        ret['fen'] = fen
-        ret['mirror'] = (record_state == 'mirror')
+        ret['fen'] = probe.fen
+        ret['mirror'] = is_mirror
         
         if score_best is not None:
             ret['score'] = score_best 
@@ -153,12 +311,13 @@ class MoveBookMixIn():
         if query is None:
             return False
 
-        record, record_state = query
-        if record_state == 'mirror':
-            new_iccs = cchess.iccs_mirror(iccs)
-        else:
-            ne_iccs = iccs
+        records, is_mirror = query
+        for item in records:
+            if self.recordIccs(item, is_mirror) == iccs:
+                item.delete_instance()
+                return True
 
+        return False
         
     def savePositionList(self, positionList):
         for position in positionList[1:]:
@@ -167,49 +326,42 @@ class MoveBookMixIn():
             score = None
             self.saveRecord(fen, step, score, position['iccs'])        
     
-    def getRecord(self, fen, iccs = None):
-        board = ChessBoard(fen)
-        for b, b_state in [(board, ''), (board.mirror(), 'mirror')]:
-            if iccs :
-                query = self.book_cls.select().where(self.book_cls.key == b.zhash(), self.book_cls.iccs == iccs).order_by(-self.book_cls.score)
-            else:
-                query = self.book_cls.select().where(self.book_cls.key == b.zhash()).order_by(-self.book_cls.score)
-            
-            query.execute()
-            #print(query.count(), b_state) 
-            if query.count() > 0:
-                break
-            
-        if query.count() == 0:
+    #记录中的着法换算到查询局面的方向
+    def recordIccs(self, item, is_mirror):
+        if item.mirror != is_mirror:
+            return cchess.iccs_mirror(item.iccs)
+        return item.iccs
+        
+    #一次索引查询取得局面及其镜像局面的全部着法，已按分数排序
+    def getRecord(self, fen):
+        probe = getProbe(fen)
+        key, is_mirror = probe.key, probe.is_mirror
+        
+        book = self.book_cls
+        records = list(book.select(book.id, book.score, book.iccs, book.mirror, book.mark)\
+                    .where(book.key == key)\
+                    .order_by(-book.score))
+        
+        if len(records) == 0:
             return None
     
-        return (query, b_state)
+        return (records, is_mirror)
     
     def saveRecord(self, fen, step, score, iccs):
-        item = self.getRecord(fen)
-        board = ChessBoard(fen)
-        if item is None:
-            #没查到数据，直接保存
-            new_record = self.book_cls(board.zhash(), step, score, iccs)
-            new_record.save()
-        else:
-            #查到数据了，要进行合并
-            record, record_state = item
-            
-            if record_state == 'mirror':
-                #查到的数据与本次保存的相比是镜像移动，本次移动镜像化
-                new_iccs = cchess.iccs_mirror(iccs)
-                board = board.mirror()
-            else:
-                new_iccs = iccs
-
+        
+        query = self.getRecord(fen)
+        if query is not None:
+            records, is_mirror = query
             #存在相同数据，不重复保存
-            if new_iccs == iccs:
-                return True
-
-            保存数据
-            new_record = self.book_cls(board.zhash, step, new_score, new_iccs)
-            new_record.save()
+            for item in records:
+                if self.recordIccs(item, is_mirror) == iccs:
+                    return True
+        
+        key, is_mirror = getFenKey(fen)
+        new_record = self.book_cls(key = key, mirror = is_mirror, step = step, score = score, iccs = iccs)
+        new_record.save()
+        
+        return True
                     
     
 #------------------------------------------------------------------------------
@@ -228,6 +380,12 @@ class MasterBook(MoveBookMixIn):
 
         self.db_master = SqliteExtDatabase(fileName)
         master_book_db.initialize(self.db_master)
+        
+        columns = [x.name for x in self.db_master.get_columns(MasterEvBook._meta.table_name)]
+        if 'mirror' not in columns:
+            logging.error(f'{fileName} 是旧格式的evbook库，请先用 Tools/migrate_evbook.py 转换。')
+            self.close()
+            return False
 
         return True
     
@@ -425,26 +583,92 @@ class MasterBook(MoveBookMixIn):
 class LocalBook():
     def __init__(self):
         self.db_local = None
+        self.isMigrating = False
+        self.stopMigrate = False
+        self.migrateThread = None
 
     def open(self, fileName):
         global local_book_db
 
-        isInit = False
-        if not Path(fileName).is_file():
-            isInit = True
-
-        self.db_local = SqliteExtDatabase(fileName)
+        self.db_local = SqliteExtDatabase(fileName, pragmas=(
+            ('journal_mode', 'wal'),))
         local_book_db.initialize(self.db_local)
-        if isInit:
-            local_book_db.create_tables([Book, Bookmark])
+        
+        #旧格式的book表没有key列，改名后建新表，数据在后台转换
+        if self.db_local.table_exists('book'):
+            columns = [x.name for x in self.db_local.get_columns('book')]
+            if 'key' not in columns:
+                self.db_local.execute_sql('ALTER TABLE book RENAME TO book_legacy')
+        local_book_db.create_tables([Book, Bookmark, ImportedFile], safe = True)
+
+        if self.db_local.table_exists('book_legacy'):
+            self.startMigrate()
 
         return True
     
     def close(self):
+        if self.migrateThread:
+            self.stopMigrate = True
+            self.migrateThread.join()
+            self.migrateThread = None
         if self.db_local:
             self.db_local.close()
         self.db_local = None
     
+    #-----------------------------------------------------#
+    def startMigrate(self):
+        self.isMigrating = True
+        self.stopMigrate = False
+        self.migrateThread = threading.Thread(target = self.migrateLegacy, daemon = True)
+        self.migrateThread.start()
+
+    def migrateLegacy(self, batchSize = 2000):
+        count = 0
+        try:
+            while not self.stopMigrate:
+                rows = list(BookLegacy.select().order_by(BookLegacy.id).limit(batchSize))
+                if len(rows) == 0:
+                    break
+
+                records = []
+                for it in rows:
+                    try:
+                        key, iccs = getMoveKey(it.fen, it.iccs)
+                    except Exception as e:
+                        logging.warning(f'LocalBook 转换失败：{it.fen} {it.iccs} {e}')
+                        continue
+                    records.append({'key': key, 'iccs': iccs, 'score': it.score, 'memo': it.memo})
+                
+                #插入新表和删除旧记录在同一个事务里，中途退出下次打开时可以继续转换
+                with self.db_local.atomic():
+                    if records:
+                        Book.insert_many(records).on_conflict_ignore().execute()
+                    BookLegacy.delete().where(BookLegacy.id <= rows[-1].id).execute()
+                count += len(rows)
+            else:
+                logging.info(f'LocalBook 转换暂停，已转换 {count} 条')
+                return
+
+            self.isMigrating = False
+            self.db_local.execute_sql('DROP TABLE book_legacy')
+            logging.info(f'LocalBook 转换完成，共转换 {count} 条')
+        finally:
+            #关闭本线程的数据库连接
+            self.db_local.close()
+
+    #转换期间旧表中还没转换的记录
+    def getLegacyRecords(self, fen):
+        f_mirror = cchess.fen_mirror(fen)
+        query = BookLegacy.select().where((BookLegacy.fen == fen) | (BookLegacy.fen == f_mirror))
+        records = []
+        for it in query:
+            iccs = it.iccs
+            if it.fen == f_mirror:
+                iccs = cchess.iccs_mirror(iccs)
+            records.append((iccs, it.score))
+        return records
+
+    #-----------------------------------------------------#
     def getAllBookmarks(self):
         
         q = Bookmark.select().execute()
@@ -475,79 +699,100 @@ class LocalBook():
         query = Bookmark.update(name = new_name).where(Bookmark.name == old_name).execute()
         return True
 
-    def saveBook(self, fen, moves):
-        book = Book(fen = fen, moves = moves)
-        book.save()
-        return True
-
     def savePositionList(self, positionList):
         #TODO: 更新分数
-        for position in positionList[1:]:
-            fen = position['fen_prev']
-            iccs = position['iccs']
-            score = None
-            self.saveRecord(fen, iccs, score)
+        records = [getMoveKey(position['fen_prev'], position['iccs']) for position in positionList[1:]]
+        return self.saveRecords(records)
+
+    #批量导入棋谱，games为(init_fen, [iccs, ...])的列表
+    def saveGames(self, games):
+        records = []
+        for init_fen, moves in games:
+            board = ChessBoard(init_fen)
+            for iccs in moves:
+                key, is_mirror = getBoardKey(board)
+                move_it = board.move_iccs(iccs)
+                if not move_it:
+                    logging.warning(f'LocalBook 非法着法：{init_fen} {iccs}')
+                    break
+                records.append((key, cchess.iccs_mirror(iccs) if is_mirror else iccs))
+                board = move_it.board_done
+        return self.saveRecords(records)
+
+    def getImportedDigests(self):
+        return set(x.digest for x in ImportedFile.select(ImportedFile.digest))
+
+    def saveImportedFile(self, digest, name, games, moves, results):
+        ImportedFile.insert(digest = digest, name = name, games = games, moves = moves,
+                            results = results, imported = int(time.time())).on_conflict_ignore().execute()
+
+    #records为(key, iccs)列表，iccs已换算到规范局面方向
+    #先用一次IN查询去掉库中已有的着法，剩下的在一个事务里批量插入
+    def saveRecords(self, records):
+        records = list(OrderedDict.fromkeys(records))
+        if len(records) == 0:
+            return 0
+
+        exists = set()
+        keys = list(set(key for key, iccs in records))
+        for batch in chunked(keys, 500):
+            query = Book.select(Book.key, Book.iccs).where(Book.key.in_(batch)).tuples()
+            exists.update(query)
+        
+        new_records = [{'key': key, 'iccs': iccs} for key, iccs in records if (key, iccs) not in exists]
+        with self.db_local.atomic():
+            for batch in chunked(new_records, 400):
+                Book.insert_many(batch).on_conflict_ignore().execute()
+        
+        return len(new_records)
 
     def saveRecord(self, fen, iccs, score):
-
-        ret_len, is_mirror = self.getRecord(fen, iccs)
         
-        if ret_len == 0:
-            new_record = Book(fen = fen, iccs = iccs, score = score)
-            new_record.save()
+        key, iccs = getMoveKey(fen, iccs)
+        
+        query = Book.insert(key = key, iccs = iccs, score = score)
+        if score is None:
+            query = query.on_conflict_ignore()
         else:
-            #TODO 更新score
-            pass
+            query = query.on_conflict(conflict_target = [Book.key, Book.iccs], update = {Book.score: score})
+        query.execute()
         
         return True
             
     def getRecord(self, fen, iccs):
 
-        f_mirror = cchess.fen_mirror(fen)
-        i_mirror = cchess.iccs_mirror(iccs)
+        key, is_mirror = getFenKey(fen)
+        if is_mirror:
+            iccs = cchess.iccs_mirror(iccs)
 
-        query = Book.select().where(  ((Book.fen == fen) & (Book.iccs == iccs)) 
-                                        | ((Book.fen == f_mirror) & (Book.iccs == i_mirror)) )
-        query.execute()
-            
-        if len(query) == 0:
-            return (0, False)
+        count = Book.select().where((Book.key == key) & (Book.iccs == iccs)).count()
         
-        if len(query) > 1:
-            raise Exception(f"Local Storage Multi Record Error:{fen}, {iccs}")
-        
-        is_mirror = False
-        if query[0].fen == f_mirror:
-            True
-
-        return (1, is_mirror)
+        return (count, is_mirror)
     
     def getMoves(self, fen):
 
-        board = ChessBoard(fen)
-        f_mirror = cchess.fen_mirror(fen)
-        query = Book.select().where((Book.fen == fen) | (Book.fen == f_mirror)).execute()
+        probe = getProbe(fen)
+        fen = probe.fen
+        query = Book.select(Book.iccs, Book.score).where(Book.key == probe.key)
         
-        actions = OrderedDict() 
+        records = []
         for it in query:
-            
-            iccs = it.iccs
-            if it.fen == f_mirror:
-                iccs = cchess.iccs_mirror(iccs)
-            
-            m = {}
-            m['iccs'] = iccs
-            if it.score:
-                m['score'] = it.score
+            iccs = cchess.iccs_mirror(it.iccs) if probe.is_mirror else it.iccs
+            records.append((iccs, it.score))
+        
+        if self.isMigrating:
+            records.extend(self.getLegacyRecords(fen))
+
+        actions = OrderedDict() 
+        for iccs, score in records:
+            if iccs in actions:
+                continue
+
+            m = probe.makeMove(iccs)
+            if score:
+                m['score'] = score
                 #m['diff'] =  0
             
-            move_it = board.copy().move_iccs(iccs)
-            if move_it:
-                m['text'] = move_it.to_text()
-                m['new_fen'] = move_it.board_done.to_fen()
-            else:
-                m['text'] = 'move error'
-            
             actions[iccs] = m
 
         ret = {}
@@ -557,6 +802,118 @@ class LocalBook():
 
         return ret
         
+#------------------------------------------------------------------------------
+#局面分析缓存库，持久保存云库、引擎、开局库的分析结果
+#
+analysis_db = Proxy()
+
+class PositionEval(Model):
+    key = BigIntegerField()
+    source = CharField()
+    score = IntegerField(null=True)
+    depth = IntegerField(default=0)
+    best_next = JSONField(null=True)
+    moves = JSONField(null=True)
+    updated = IntegerField(default=0)
+    
+    class Meta:
+        database = analysis_db
+        table_name = 'position_eval'
+        indexes = (
+            (('key', 'source'), True),
+        )
+
+#------------------------------------------------------------------------------
+class AnalysisStore():
+    def __init__(self):
+        self.db = None
+        #写入新结果后调用evalSaved(fen)
+        self.evalSaved = None
+
+    def open(self, fileName):
+        self.db = SqliteExtDatabase(fileName, pragmas=(
+            ('cache_size', -1024 * 16),
+            ('journal_mode', 'wal'),
+            ('synchronous', 1)))
+        analysis_db.initialize(self.db)
+        analysis_db.create_tables([PositionEval], safe = True)
+
+        return True
+
+    def close(self):
+        if self.db:
+            self.db.close()
+        self.db = None
+    
+    #查询局面的分析结果，着法换算回当前局面的方向
+    def getEval(self, fen, source = None):
+        
+        if not self.db:
+            return None
+
+        key, is_mirror = getFenKey(fen)
+        query = PositionEval.select().where(PositionEval.key == key)
+        if source:
+            query = query.where(PositionEval.source == source)
+        records = list(query.order_by(-PositionEval.updated).limit(1))
+        if not records:
+            return None
+
+        it = records[0]
+        best_next = it.best_next or []
+        moves = it.moves or {}
+        if is_mirror:
+            best_next = [cchess.iccs_mirror(x) for x in best_next]
+            moves = {cchess.iccs_mirror(iccs): v for iccs, v in moves.items()}
+
+        return {
+            'fen': fen,
+            'source': it.source,
+            'score': it.score,
+            'depth': it.depth,
+            'best_next': best_next,
+            'moves': moves,
+        }
+
+    #保存局面的分析结果，深度更浅的结果不会覆盖已有结果
+    def saveEval(self, fen, source, score, depth = 0, moves = None, best_next = None):
+        
+        if not self.db:
+            return False
+        
+        key, is_mirror = getFenKey(fen)
+        
+        moves = moves or {}
+        best_next = best_next or []
+        if is_mirror:
+            best_next = [cchess.iccs_mirror(x) for x in best_next]
+            moves = {cchess.iccs_mirror(iccs): v for iccs, v in moves.items()}
+        
+        old = PositionEval.get_or_none((PositionEval.key == key) & (PositionEval.source == source))
+        if old and (old.depth > depth):
+            return False
+
+        PositionEval.insert(key = key, source = source, score = score, depth = depth,
+                            best_next = best_next, moves = moves, updated = int(time.time()))\
+                    .on_conflict_replace().execute()
+        if self.evalSaved:
+            self.evalSaved(fen)
+        return True
+    
+    #fenCache未命中时按需加载
+    def loadFenInfo(self, fen):
+        info = self.getEval(fen)
+        if not info:
+            return None
+        
+        fenInfo = {}
+        if info['score'] is not None:
+            fenInfo['score'] = info['score']
+        if info['best_next']:
+            fenInfo['best_next'] = info['best_next']
+        
+        return fenInfo
+
 #------------------------------------------------------------------------------
 #勇芳格式开局库
 openBookYfk = Proxy()
@@ -691,7 +1048,7 @@ class OpenBookYfk(OpenBookDB):
         self.name = '勇芳'
 
     def open(self, fileName, useScore = False):
-        super().open(fileName, openBookYfk, useScore)
+        return super().open(fileName, openBookYfk, useScore)
         
     #鹏飞库与勇芳库的高低位是反的，其他数据一样
     def vmove2iccs(self, vmove):
@@ -704,9 +1061,10 @@ class OpenBookYfk(OpenBookDB):
         if not self.isBookOpened:
             return None
 
-        board = ChessBoard(fen)
-        zhash = board.zhash()
-        zhash_mirror = board.mirror().zhash()
+        probe = getProbe(fen)
+        fen = probe.fen
+        zhash = probe.zhash
+        zhash_mirror = probe.zhash_mirror
         
         query = Bhobk.select().where(((Bhobk.vkey == zhash) | (Bhobk.vkey == zhash_mirror)) & (Bhobk.vvalid == 1))\
                                     .order_by(-Bhobk.vscore).execute()
@@ -727,20 +1085,10 @@ class OpenBookYfk(OpenBookDB):
             if it.vkey == zhash_mirror:
                 iccs = cchess.iccs_mirror(iccs)
                 
-            m = {}  
-            m['iccs'] = iccs
+            m = probe.makeMove(iccs)
             m['score'] = score
             m['diff'] =  score - score_best
-            
-            bd = board.copy()
-            move_it = bd.move_iccs(iccs)
-            if move_it is not None:
-                m['text'] = move_it.to_text()
-                m['new_fen'] = move_it.board_done.to_fen()
-            else:
-                m['text'] = f'err:{iccs}'
-                logging.error(f"{bd.to_fen()} move {iccs} error")
-            
+                        
             actions[iccs] = m
         
         ret = {}
@@ -760,7 +1108,7 @@ class OpenBookPF(OpenBookDB):
         self.isUseScore = False
     
     def open(self, fileName, useScore = False):
-        super().open(fileName, openBookPF, useScore)
+        return super().open(fileName, openBookPF, useScore)
         
     #鹏飞库与勇芳库的高低位是反的，其他数据一样
     def vmove2iccs(self, vmove):
@@ -773,9 +1121,10 @@ class OpenBookPF(OpenBookDB):
         if not self.isBookOpened:
             return {}
 
-        board = ChessBoard(fen)
-        zhash = board.zhash()
-        zhash_mirror = board.mirror().zhash()
+        probe = getProbe(fen)
+        fen = probe.fen
+        zhash = probe.zhash
+        zhash_mirror = probe.zhash_mirror
         
         query = PfBook.select().where(((PfBook.vkey == zhash) | (PfBook.vkey == zhash_mirror)) & (PfBook.vvalid == 1))\
                                     .order_by(-PfBook.vscore).execute()
@@ -800,8 +1149,7 @@ class OpenBookPF(OpenBookDB):
             if iccs in actions:
                 continue
 
-            m = {}  
-            m['iccs'] = iccs
+            m = probe.makeMove(iccs)
                 
             if isinstance(it.vmemo, str):
                 m['memo'] = it.vmemo
@@ -812,14 +1160,147 @@ class OpenBookPF(OpenBookDB):
             
             m['score'] = score
             m['diff'] =  score - score_best
+                    
+            actions[iccs] = m
         
-            move_it = board.copy().move_iccs(iccs)
-            if move_it is not None:
-                m['text'] = move_it.to_text()
-                m['new_fen'] = move_it.board_done.to_fen()
-            else:
-                m['text'] = f'err:{iccs}'
-                logging.error(f"{bd.to_fen()} move {iccs} error")
+        ret = {}
+        ret['fen'] = fen
+        ret['score'] = score_best 
+        ret['actions'] = actions
+
+        return ret
+        
+
+#------------------------------------------------------------------------------
+#二进制开局库，由BinBook.py从其他格式的库导出
+#文件头：magic(4) version(H) 记录长度(H) 记录数(Q)
+#记录：zhash(q) 着法(H) 分数(h) 胜(H) 和(H) 负(H)，按zhash升序、同一局面按分数降序排列
+#zhash为着法所在方向局面的zhash，查询时分别查局面与镜像局面
+BIN_BOOK_MAGIC = b'CCBK'
+BIN_BOOK_VERSION = 1
+BIN_BOOK_HEADER = struct.Struct('<4sHHQ')
+BIN_BOOK_RECORD = struct.Struct('<qHhHHH')
+#没有分数的着法(本地库、大师库中score为NULL)，排在有分数的着法之后
+BIN_BOOK_NO_SCORE = -32768
+
+#着法编码：起点<<8|终点，位置编码为 行*9+列
+def packIccs(iccs):
+    pos_from = (ord(iccs[1]) - 48) * 9 + ord(iccs[0]) - 97
+    pos_to = (ord(iccs[3]) - 48) * 9 + ord(iccs[2]) - 97
+    return (pos_from << 8) | pos_to
+
+def unpackIccs(move):
+    pos_from = move >> 8
+    pos_to = move & 0xff
+    return f'{chr(pos_from % 9 + 97)}{pos_from // 9}{chr(pos_to % 9 + 97)}{pos_to // 9}'
+
+#不生成记录对象，直接在映射的文件上取第i条记录的zhash，供bisect使用
+class BinBookKeys():
+    def __init__(self, buf, count):
+        self.buf = buf
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return struct.unpack_from('<q', self.buf, BIN_BOOK_HEADER.size + index * BIN_BOOK_RECORD.size)[0]
+
+class OpenBookBin(OpenBookDB):
+    
+    def __init__(self):
+        super().__init__()
+        self.name = '二进制'
+        self.file = None
+        self.buf = None
+        self.keys = None
+
+    def open(self, fileName, useScore = False):
+        
+        if self.isBookOpened:
+            return False
+
+        if not Path(fileName).is_file():
+            return False
+        
+        self.file = open(fileName, 'rb')
+        try:
+            #只读映射，多个进程打开同一个库时共享页面
+            self.buf = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+            magic, version, record_size, count = BIN_BOOK_HEADER.unpack_from(self.buf, 0)
+            if (magic != BIN_BOOK_MAGIC) or (version != BIN_BOOK_VERSION) or (record_size != BIN_BOOK_RECORD.size):
+                raise Exception(f'{fileName} 不是二进制开局库文件')
+            if len(self.buf) < BIN_BOOK_HEADER.size + count * record_size:
+                raise Exception(f'{fileName} 文件不完整')
+        except Exception as e:
+            logging.error(str(e))
+            self.close()
+            return False
+
+        self.keys = BinBookKeys(self.buf, count)
+        self.isBookOpened = True
+        self.isUseScore = useScore
+
+        return True
+
+    def close(self):
+        if self.buf:
+            self.buf.close()
+        if self.file:
+            self.file.close()
+        self.buf = None
+        self.file = None
+        self.keys = None
+        self.isBookOpened = False
+    
+    #返回zhash对应的全部记录(move, score, win, draw, loss)
+    def getRecords(self, zhash):
+        index = bisect.bisect_left(self.keys, zhash)
+        records = []
+        while index < len(self.keys):
+            key, move, score, win, draw, loss = BIN_BOOK_RECORD.unpack_from(self.buf, 
+                                    BIN_BOOK_HEADER.size + index * BIN_BOOK_RECORD.size)
+            if key != zhash:
+                break
+            records.append((move, score, win, draw, loss))
+            index += 1
+        return records
+
+    def getMoves(self, fen):
+
+        if not self.isBookOpened:
+            return None
+
+        probe = getProbe(fen)
+        fen = probe.fen
+        zhash = probe.zhash
+        zhash_mirror = probe.zhash_mirror
+        
+        records = [(unpackIccs(move), score, win, draw, loss) for move, score, win, draw, loss in self.getRecords(zhash)]
+        if zhash_mirror != zhash:
+            records.extend([(cchess.iccs_mirror(unpackIccs(move)), score, win, draw, loss) 
+                                for move, score, win, draw, loss in self.getRecords(zhash_mirror)])
+        
+        if len(records) == 0:
+            return None
+        
+        records.sort(key = lambda x: x[1], reverse = True)
+
+        actions = OrderedDict() 
+        score_best = records[0][1] if records[0][1] != BIN_BOOK_NO_SCORE else None
+        
+        for iccs, score, win, draw, loss in records:
+            if iccs in actions:
+                continue
+
+            m = probe.makeMove(iccs)
+            if score != BIN_BOOK_NO_SCORE:
+                m['score'] = score
+                m['diff'] =  score - score_best
+            if win + draw + loss > 0:
+                m['win'] = win
+                m['draw'] = draw
+                m['loss'] = loss
             
             actions[iccs] = m
         
@@ -829,4 +1310,3 @@ class OpenBookPF(OpenBookDB):
         ret['actions'] = actions
 
         return ret
-        
@@ -9,14 +9,14 @@ import platform
 import threading
 from enum import Enum, auto
 from pathlib import Path
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from configparser import ConfigParser
 
 #from PySide6 import 
-from PySide6.QtCore import Qt, Signal, QByteArray, QSettings, QUrl
+from PySide6.QtCore import Qt, Signal, QByteArray, QSettings, QUrl, QTimer
 from PySide6.QtGui import QActionGroup, QIcon, QAction
 from PySide6.QtWidgets import QApplication,QMainWindow, QStyle, QSizePolicy, QMessageBox, QWidget, QCheckBox, QRadioButton, \
-                            QFileDialog, QButtonGroup
+                            QFileDialog, QButtonGroup, QLabel
 from PySide6.QtMultimedia import QMediaPlayer, QAudioOutput
 
 import cchess
@@ -25,15 +25,20 @@ from cchess import ChessBoard, Game
 from .Version import release_version
 from .Resource import qt_resource_data
 from .Manager import EngineManager
+from .EngineCore import makeEvalRecord
+from .EnginePool import EnginePool
 
 from .Storage import EndBookStore
-from .CloudDB import CloudDB
-from .LocalDB import OpenBookYfk, OpenBookPF, MasterBook, LocalBook
+from .CloudDB import CloudDB, PRIORITY_REVIEW
+from .LocalDB import OpenBookYfk, OpenBookPF, OpenBookBin, MasterBook, LocalBook, AnalysisStore, getBoardKey, getFenKey
+from .Importer import GameImporter
+from .GameIndex import GameIndex, GameIndexer
+from .BookStack import BookStack
 
-from .Utils import GameMode, ReviewMode, TimerMessageBox, getTitle, getStepsFromFenMoves, trim_fen
+from .Utils import GameMode, ReviewMode, TimerMessageBox, ThreadRunner, getTitle, getStepsFromFenMoves, trim_fen
 from .BoardWidgets import ChessBoardWidget, DEFAULT_SKIN
 from .Widgets import EngineWidget, BookmarkWidget, \
-                    BoardActionsWidget, EndBookWidget, DockHistoryWidget, GameLibWidget
+                    BoardActionsWidget, EndBookWidget, DockHistoryWidget, GameLibWidget, GameSearchWidget
 from .Dialogs import PositionEditDialog, PositionHistDialog, ImageToBoardDialog, EngineConfigDialog
 
 from .SnippingWidget import SnippingWidget
@@ -70,6 +75,13 @@ GAME_FILE_TYPES = ['.xqf','.pgn', '.cbr']
 GAME_LIB_TYPES = ['.cbl']
 GAME_TYPES_ALL = GAME_FILE_TYPES + GAME_LIB_TYPES
 
+BOOK_TYPES = {
+    '.evb': OpenBookBin,
+    '.yfk': OpenBookYfk,
+    '.pfbook': OpenBookPF,
+    '.edb': MasterBook,
+}
+
 class MainWindow(QMainWindow):
     initGameSignal = Signal(str)
     newBoardSignal = Signal()
@@ -77,6 +89,10 @@ class MainWindow(QMainWindow):
     moveEndSignal = Signal()
     #newPositionSignal = Signal()
     changePositionSignal = Signal(bool, bool)
+    importProgressSignal = Signal(int, int, str)
+    importFinishedSignal = Signal(dict)
+    indexProgressSignal = Signal(int, int, str)
+    indexFinishedSignal = Signal(dict)
 
     def __init__(self):
         super().__init__()
@@ -93,38 +109,40 @@ class MainWindow(QMainWindow):
                 myappid)
 
         self.readConfig()
+        self.initFenCache()
         
         gamePath = Path('Game')
         gamePath.mkdir(exist_ok=True)
                 
-        #self.openBook = MasterBook()
-        #self.openBook.open(Path('Game', 'openbook.edb'))
-        
-        book_file = Path('Game', 'openbook.yfk')
-        if book_file.is_file():
-            self.openBook = OpenBookYfk()
-            self.openBook.open(book_file)
-            logging.info(f'加载开局库：{book_file}')
-        else:
-            book_file = Path('Game', 'openbook.pfbook')
-            if book_file.is_file():
-                self.openBook = OpenBookPF()
-                self.openBook.open(book_file)
-                logging.info(f'加载开局库：{book_file}')
-            else:
-                self.openBook = OpenBookPF()
-                logging.info('没有开局库被加载')
-
         Globl.endbookStore = EndBookStore(Path(gamePath, 'endbooks.json'))
         #Globl.localbookStore = LocalBookStore(Path(gamePath, 'localbooks.json'))
        
         Globl.localBook = LocalBook()
         Globl.localBook.open(Path(gamePath, 'localbook.db'))
         
+        self.initBookStack(gamePath)
+        
+        Globl.analysisStore = AnalysisStore()
+        Globl.analysisStore.open(Path(gamePath, 'analysis.db'))
+        Globl.fenCache.loader = Globl.analysisStore.loadFenInfo
+        Globl.analysisStore.evalSaved = lambda fen: Globl.fenCache.resetMissed()
+        
+        Globl.gameIndex = GameIndex()
+        Globl.gameIndex.open(Path(gamePath, 'gameindex.db'))
+        
         Globl.engineManager = EngineManager(self, id = 1)
+        self.enginePool = None
+        self.engineReviewId = 0
         
         self.board = ChessBoard()
         self.changePositionSignal.connect(self.onChangePosition)
+        self.cloudReviewId = 0
+        self.importProgressSignal.connect(self.onImportProgress)
+        self.importFinishedSignal.connect(self.onImportFinished)
+        self.gameImporter = None
+        self.indexProgressSignal.connect(self.onIndexProgress)
+        self.indexFinishedSignal.connect(self.onIndexFinished)
+        self.gameIndexer = None
 
         self.boardView = ChessBoardWidget(self.board)
         self.setCentralWidget(self.boardView)
@@ -133,6 +151,16 @@ class MainWindow(QMainWindow):
         #全局可访问
         Globl.boardView = self.boardView
 
+        #调试模式下在棋盘左上角显示引擎bestmove到界面的延迟
+        self.engineLatency = deque(maxlen = 50)
+        self.latencyLabel = None
+        if getattr(QApplication.instance(), 'isDebug', False):
+            self.latencyLabel = QLabel(self.boardView)
+            self.latencyLabel.setStyleSheet('background-color: rgba(0, 0, 0, 128); color: white; padding: 2px;')
+            self.latencyLabel.setAttribute(Qt.WA_TransparentForMouseEvents)
+            self.latencyLabel.move(8, 8)
+            self.latencyLabel.hide()
+
         self.historyView = DockHistoryWidget(self)
         self.historyView.inner.positionSelSignal.connect(
             self.onSelectHistoryPosition)
@@ -153,6 +181,11 @@ class MainWindow(QMainWindow):
         self.bookmarkView.setVisible(False)
         self.gamelibView = GameLibWidget(self)
         self.gamelibView.setVisible(False)
+        self.gameSearchView = GameSearchWidget(self)
+        self.gameSearchView.setVisible(False)
+        self.gameSearchView.selectMoveSignal.connect(self.onTryBookMove)
+        self.gameSearchView.openGameSignal.connect(self.onOpenIndexedGame)
+        self.gameSearchView.visibilityChanged.connect(self.onGameSearchVisible)
                 
         self.engineView = EngineWidget(self, Globl.engineManager)
         
@@ -163,6 +196,7 @@ class MainWindow(QMainWindow):
         self.addDockWidget(Qt.RightDockWidgetArea, self.historyView)
         self.addDockWidget(Qt.RightDockWidgetArea, self.bookmarkView)
         self.addDockWidget(Qt.LeftDockWidgetArea, self.gamelibView)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.gameSearchView)
         self.addDockWidget(Qt.BottomDockWidgetArea, self.engineView)
         
         self.snippingWidget = SnippingWidget()
@@ -214,6 +248,7 @@ class MainWindow(QMainWindow):
         #self.bookmarkView.addQuickBooks(self.quickBooks)
         self.cloudQuery = CloudDB(self)
         self.cloudQuery.query_result_signal.connect(self.onCloudQueryResult)
+        self.initCloudDB()
         
         self.switchGameMode(GameMode.NoEngine)
         
@@ -246,7 +281,84 @@ class MainWindow(QMainWindow):
         except Exception as e:
             QMessageBox.critical(self, f'{getTitle()}', f'打开配置文件[{self.config_file}]出错：{e}')
             return False
+    
+    def initFenCache(self):
+        if not hasattr(self, 'config'):
+            return
+        
+        max_entries = self.config.getint('FenCache', 'max_entries', fallback = 200000)
+        max_mem_mb = self.config.getint('FenCache', 'max_mem_mb', fallback = 256)
+        Globl.fenCache.setLimits(max_entries, max_mem_mb * 1024 * 1024)
+        
+    def initCloudDB(self):
+        if not hasattr(self, 'config'):
+            return
+
+        self.cloudQuery.url = self.config.get('CloudDB', 'url', fallback = self.cloudQuery.url)
+        self.cloudQuery.maxInFlight = self.config.getint('CloudDB', 'max_in_flight', fallback = 6)
+        
+        count = self.config.getint('CloudDB', 'prefetch_count', fallback = 3)
+        depth = self.config.getint('CloudDB', 'prefetch_depth', fallback = 4)
+        rate = self.config.getfloat('CloudDB', 'prefetch_rate', fallback = 2.0)
+        budget = self.config.getint('CloudDB', 'prefetch_budget', fallback = 500)
+        self.cloudQuery.setPrefetch(count, depth, rate, budget)
+
+    #引擎复盘用的引擎进程池，size小于2时使用主引擎逐个局面复盘
+    def initEnginePool(self):
+        if self.enginePool:
+            return True
+
+        size = self.config.getint('EnginePool', 'size', fallback = 0)
+        if size < 2:
+            return False
         
+        hashMB = self.config.getint('EnginePool', 'hash', fallback = 256)
+        threads = self.config.getint('EnginePool', 'threads', fallback = 0)
+        engine_type = self.config['MainEngine']['engine_type'].lower()
+        engine_exec = Path(self.config['MainEngine']['engine_exec'])
+        
+        pool = EnginePool(self, engine_exec, engine_type, size, hashMB, threads)
+        if not pool.start():
+            return False
+        pool.resultSignal.connect(self.onEnginePoolResult)
+        self.enginePool = pool
+        
+        return True
+
+    #按配置的顺序加载开局库，排在前面的优先级高
+    def initBookStack(self, gamePath):
+        books = 'openbook.evb, openbook.yfk, openbook.pfbook, localbook.db'
+        score_rule = 'first'
+        cache_size = 4096
+        if hasattr(self, 'config'):
+            books = self.config.get('BookStack', 'books', fallback = books)
+            score_rule = self.config.get('BookStack', 'score_rule', fallback = score_rule)
+            cache_size = self.config.getint('BookStack', 'cache_size', fallback = cache_size)
+
+        Globl.bookStack = BookStack(score_rule, cache_size)
+        
+        names = [x.strip() for x in books.split(',') if x.strip()]
+        for i, name in enumerate(names):
+            priority = len(names) - i
+            if name == 'localbook.db':
+                Globl.bookStack.addBook(name, Globl.localBook, priority, mark = '*')
+                continue
+            
+            book_file = Path(gamePath, name)
+            book_cls = BOOK_TYPES.get(book_file.suffix.lower())
+            if (book_cls is None) or (not book_file.is_file()):
+                continue
+            
+            book = book_cls()
+            if book.open(book_file):
+                Globl.bookStack.addBook(name, book, priority)
+                logging.info(f'加载开局库：{book_file}')
+            else:
+                logging.error(f'加载开局库出错：{book_file}')
+
+        if Globl.bookStack.getBookNames() == ['localbook.db']:
+            logging.info('没有开局库被加载')
+
     def initEngine(self):
         try:
             engine_type = self.config['MainEngine']['engine_type'].lower()
@@ -277,9 +389,19 @@ class MainWindow(QMainWindow):
         '''
 
     def loadOpenBook(self, file_name):
-        self.openBook.close()
-        if self.openBook.open(file_name):
-            self.openBookFile = Path(file_name)
+        file_name = Path(file_name)
+        book_cls = BOOK_TYPES.get(file_name.suffix.lower(), OpenBookYfk)
+        
+        #yfk、pfbook同一时间只能打开一个，先关闭同类型的库
+        for it in Globl.bookStack.books:
+            if isinstance(it['book'], book_cls):
+                it['book'].close()
+                Globl.bookStack.removeBook(it['name'])
+        
+        book = book_cls()
+        if book.open(file_name):
+            Globl.bookStack.addBook(file_name.name, book, len(Globl.bookStack.books) + 1)
+            self.openBookFile = file_name
    
     def loadSkins(self):
         
@@ -362,6 +484,7 @@ class MainWindow(QMainWindow):
 
     def saveGameToDB(self):
         Globl.localBook.savePositionList(self.positionList)
+        Globl.bookStack.clearCache()
         self.isNeedSave = False
     
     #-----------------------------------------------------------------------
@@ -514,6 +637,7 @@ class MainWindow(QMainWindow):
             self.positionList.append(position)
             self.currPosition = position   
         
+        Globl.fenCache.setPinned([self.init_fen])
         self.changePositionSignal.emit(True, False)
         
     def updateEcco(self):
@@ -577,9 +701,8 @@ class MainWindow(QMainWindow):
             self.isNeedSave = True
 
         #在fenCach中把招法连起来
-        if new_fen not in Globl.fenCache:
-            Globl.fenCache[new_fen] = {}
-        Globl.fenCache[new_fen].update({ 'fen_prev': position['fen_prev'] })
+        Globl.fenCache.setdefault(new_fen, {}).update({ 'fen_prev': position['fen_prev'] })
+        Globl.fenCache.pin(new_fen)
 
         self.changePositionSignal.emit(True, quickMode)
         
@@ -625,6 +748,7 @@ class MainWindow(QMainWindow):
         else:
             if not quickMode:
                 self.localSearch(position)
+                self.searchGames(position)
                 if (self.queryMode == QueryMode.CloudFirst) or (self.reviewMode == ReviewMode.ByCloud):
                     self.cloudQuery.startQuery(position)
                 
@@ -687,6 +811,8 @@ class MainWindow(QMainWindow):
         #本着法的其他更好的招法    
         for act in actions.values():
             new_fen = act['new_fen']
+            if not new_fen:
+                continue
 
             info = { 'score': act['score'], 'diff':act['diff'] }
             if (act['diff'] < -50) and best_next:
@@ -700,10 +826,17 @@ class MainWindow(QMainWindow):
         if best_next:
             Globl.fenCache[fen]['best_next'] = best_next 
 
-        # 如果这一步的fen不在上个步骤的预测走法里面，需要根据fen_prev的分数建立此步骤的alter_best   
+        self.updatePrevDiff(fen)
+        
+        for pos in self.positionList:
+            if pos['fen'] == fen:
+                self.historyView.inner.onUpdatePosition(pos)
+        
+    # 如果这一步的fen不在上个步骤的预测走法里面，需要根据fen_prev的分数建立此步骤的alter_best   
+    def updatePrevDiff(self, fen):
         fenInfo = Globl.fenCache[fen]
         
-        if ('diff' not in fenInfo) and ('fen_prev' in fenInfo):
+        if ('diff' not in fenInfo) and ('fen_prev' in fenInfo) and ('score' in fenInfo):
             move_color = cchess.get_move_color(fen)    
             fen_prev = fenInfo['fen_prev']
             if fen_prev in Globl.fenCache :
@@ -716,10 +849,6 @@ class MainWindow(QMainWindow):
                     if (diff < -40) and ('best_next' in prevInfo):
                         fenInfo['alter_best'] = prevInfo['best_next']
         
-        for pos in self.positionList:
-            if pos['fen'] == fen:
-                self.historyView.inner.onUpdatePosition(pos)
-        
     #------------------------------------------------------------------------------
     #None UI Events
     def clearAllScore(self):
@@ -741,34 +870,18 @@ class MainWindow(QMainWindow):
         
         fen = position['fen']
         
-        #开局库        
-        query = self.openBook.getMoves(fen)    
-        if query:
-            openbook_actions = query['actions']
-        else:
-            openbook_actions = OrderedDict()
-
-        #本地库库        
-        query = Globl.localBook.getMoves(fen)
-        if query:
-            local_actions = query['actions']
-        else:
-            local_actions = OrderedDict()
-
-        for iccs, act in local_actions.items():
-            if iccs in openbook_actions:
-                act['score'] = openbook_actions[iccs]['score']
-            act['mark'] = "*"
-            
-        #合并最终的输出  
-        final_actions = openbook_actions.copy()
-        #合并本地库与开局库
-        for iccs, l_act in local_actions.items():
-            if iccs in final_actions:
-                f_act = final_actions[iccs]
-                f_act.update(l_act)
-            else:
-                final_actions[iccs] = l_act
+        #开局库和本地库按优先级合并的结果
+        query = Globl.bookStack.getMoves(fen)
+        final_actions = query['actions']
+        
+        #实战着法统计，库中没有的着法排在后面
+        stats = Globl.gameIndex.moveStats.getMoves(fen)
+        if stats:
+            for iccs, act in stats['actions'].items():
+                if iccs in final_actions:
+                    final_actions[iccs]['games'] = act['games']
+                else:
+                    final_actions[iccs] = act
             
         '''        
         #更新分数 
@@ -837,9 +950,6 @@ class MainWindow(QMainWindow):
         self.boardActions = x     
         self.actionsView.updateActions(self.boardActions)
 
-        if self.reviewMode == ReviewMode.ByCloud:
-            self.onReviewGameStep()
-
     def showBestHint(self, fenInfo):
         best = []
         
@@ -860,6 +970,10 @@ class MainWindow(QMainWindow):
         
         self.isRunEngine = False
         
+        bestmove_time = fenInfo.pop('bestmove_time', None)
+        if bestmove_time is not None:
+            self.showEngineLatency((time.perf_counter() - bestmove_time) * 1000)
+
         fen = trim_fen(fenInfo['fen'])
         logging.debug(f'Engine[{engine_id}] BestMove {fenInfo}' )
         
@@ -867,6 +981,12 @@ class MainWindow(QMainWindow):
             and ((self.queryMode == QueryMode.EngineFirst) \
                  or (self.reviewMode == ReviewMode.ByEngine)):
             self.updateFenCache(fenInfo)
+            if not fenInfo.get('cached', False):
+                self.saveEngineEval(fenInfo)
+        
+        #云库优先时，预取引擎主变上的局面
+        if (self.queryMode == QueryMode.CloudFirst) and fenInfo.get('moves'):
+            self.cloudQuery.prefetchLine(fen, fenInfo['moves'])
 
         if self.reviewMode == ReviewMode.ByEngine:
             self.onReviewGameStep()
@@ -881,6 +1001,82 @@ class MainWindow(QMainWindow):
             if (self.queryMode == QueryMode.EngineFirst):
                 self.showBestHint(fenInfo)
             
+    def showEngineLatency(self, latency):
+        self.engineLatency.append(latency)
+        logging.debug(f'Engine bestmove latency: {latency:.1f}ms')
+        
+        if not self.latencyLabel:
+            return
+        avg = sum(self.engineLatency) / len(self.engineLatency)
+        self.latencyLabel.setText(f'bestmove→界面 {latency:.1f}ms  平均 {avg:.1f}ms  最大 {max(self.engineLatency):.1f}ms')
+        self.latencyLabel.adjustSize()
+        self.latencyLabel.show()
+        self.latencyLabel.raise_()
+
+    #多分支分析时所有候选着法的分数一起保存
+    def saveEngineEval(self, fenInfo):
+        record = makeEvalRecord(fenInfo)
+        if not record:
+            return
+        
+        score, depth, moves, best_next = record
+        Globl.analysisStore.saveEval(fenInfo['fen'], 'engine', score, depth, moves, best_next)
+    
+    #本地分析缓存库中有足够深度的引擎结果时，直接使用，不再运行引擎
+    def loadEngineEval(self, position, params):
+        
+        fenInfo = self.makeCachedEngineInfo(position, params)
+        if not fenInfo:
+            return False
+
+        Globl.engineManager.stopThinking()
+        QTimer.singleShot(0, lambda: self.onEngineEvalLoaded(position, fenInfo))
+        
+        return True
+
+    #从本地分析缓存库生成与引擎bestmove相同格式的结果，没有足够深度的结果时返回None
+    def makeCachedEngineInfo(self, position, params):
+        if 'depth' not in params:
+            return None
+
+        fen = position['fen']
+        info = Globl.analysisStore.getEval(fen, 'engine')
+        if (not info) or (info['depth'] < params['depth']) or (not info['best_next']):
+            return None
+        
+        iccs = info['best_next'][0]
+        board = ChessBoard(fen)
+        if board.copy().move_iccs(iccs) is None:
+            return None
+
+        score = info['moves'].get(iccs, info['score'])
+        sign = -1 if board.get_move_color() == cchess.BLACK else 1
+        
+        #多分支分析保存的所有候选着法都还原出来
+        actions = OrderedDict()
+        for move_iccs, move_score in sorted(info['moves'].items(), key = lambda x: x[1] * sign, reverse = True):
+            move_it = board.copy().move_iccs(move_iccs)
+            if move_it is None:
+                continue
+            actions[move_iccs] = {'iccs': move_iccs, 'diff': (move_score - score) * sign, 
+                    'new_fen': move_it.board_done.to_fen(), 'score': move_score}
+        
+        fenInfo = {
+            'fen': fen,
+            'iccs': iccs,
+            'score': score,
+            'depth': info['depth'],
+            'cached': True,
+            'actions': actions
+        }
+        
+        return fenInfo
+
+    def onEngineEvalLoaded(self, position, fenInfo):
+        if position is not self.currPosition:
+            return
+        self.onTryEngineMove(Globl.engineManager.id, fenInfo)
+
     def onEngineMoveInfo(self, engine_id, fenInfo):
         
         #if (self.queryMode == QueryMode.EngineFirst) or (self.reviewMode == ReviewMode.ByEngine):
@@ -895,7 +1091,6 @@ class MainWindow(QMainWindow):
         if fen != self.currPosition['fen']:
             return
 
-        board = ChessBoard(fen)
         currmove = fenInfo.get('currmove', None)
         if (self.queryMode == QueryMode.EngineFirst) and currmove:
             self.boardView.showMoveHint([cchess.iccs2pos(currmove)])
@@ -907,7 +1102,7 @@ class MainWindow(QMainWindow):
         
         iccs = moves[0]
         #引擎输出的历史数据,不处理
-        if not board.is_valid_iccs_move(iccs):
+        if not Globl.pvTextCache.isValidMove(fen, iccs):
             return
         
         moveShow = [cchess.iccs2pos(x) for x in moves[:2]]
@@ -961,6 +1156,11 @@ class MainWindow(QMainWindow):
                 fen_engine = position['move'].to_engine_fen()         
             params = self.engineView.getGoParams()
             
+            #引擎不走子只做分析时，优先使用缓存的分析结果
+            if (self.engineRunColor[move_color] == 0) and self.loadEngineEval(position, params):
+                self.isRunEngine = True
+                return
+
             ok = Globl.engineManager.goFrom(fen_engine, fen, params)
             if ok:
                 self.isRunEngine = True
@@ -1036,6 +1236,7 @@ class MainWindow(QMainWindow):
                 
         self.positionList = self.positionList[:step_index + 1]
         self.currPosition = self.positionList[-1]
+        Globl.fenCache.setPinned([x['fen'] for x in self.positionList])
         
         if len(self.positionList) <= 1:
             self.isNeedSave = False
@@ -1072,9 +1273,45 @@ class MainWindow(QMainWindow):
             self.reviewList = self.positionList[:]
             self.historyView.inner.reviewByCloudBtn.setText('停止复盘')
             self.engineView.onReviewBegin(self.reviewMode)
-            self.onReviewGameStep()
+            self.startCloudReview()
         else:
             self.onReviewGameEnd(isCanceled=True)
+    
+    #云库复盘：整盘棋的局面一次全部加入查询队列，由查询队列控制并发数，结果按返回的顺序更新
+    def startCloudReview(self):
+        self.cloudReviewId += 1
+        self.reviewTotal = len(self.reviewList)
+        self.reviewDone = 0
+        
+        reviewList = self.reviewList
+        self.reviewList = []
+        for position in reviewList:
+            self.cloudQuery.startQuery(position, priority = PRIORITY_REVIEW, 
+                callback = lambda query, review_id = self.cloudReviewId: self.onCloudReviewResult(review_id, query))
+
+    def onCloudReviewResult(self, review_id, query):
+        #已经停止或者重新开始的复盘
+        if (self.reviewMode != ReviewMode.ByCloud) or (review_id != self.cloudReviewId):
+            return
+        
+        self.reviewDone += 1
+        self.applyReviewResult(query)
+        
+        self.statusBar().showMessage(f"云库复盘 {self.reviewDone}/{self.reviewTotal}")
+        if self.reviewDone >= self.reviewTotal:
+            self.onReviewGameEnd()
+    
+    #复盘结果不按局面顺序返回时，更新该局面和下一步的分差
+    def applyReviewResult(self, fenInfo):
+        index = fenInfo.get('index', len(self.positionList))
+        if (index < len(self.positionList)) and (self.positionList[index]['fen'] == fenInfo['fen']):
+            self.updateFenCache(fenInfo)
+            #下一步的分差依赖这一步的分数，结果可能先于这一步返回
+            if index + 1 < len(self.positionList):
+                next_pos = self.positionList[index + 1]
+                if next_pos['fen'] in Globl.fenCache:
+                    self.updatePrevDiff(next_pos['fen'])
+                self.historyView.inner.onUpdatePosition(next_pos)
          
     def onReviewByEngine(self):    
 
@@ -1090,9 +1327,55 @@ class MainWindow(QMainWindow):
             
             self.engineView.onReviewBegin(self.reviewMode)
             self.historyView.inner.reviewByEngineBtn.setText('停止复盘')
-            self.onReviewGameStep()
+            if self.initEnginePool():
+                self.startPoolReview()
+            else:
+                self.onReviewGameStep()
         else:
             self.onReviewGameEnd(isCanceled=True)
+    
+    #引擎池复盘：缓存中有足够深度结果的局面直接使用，其余的分给各个引擎并行分析
+    def startPoolReview(self):
+        self.engineReviewId += 1
+        self.reviewTotal = len(self.reviewList)
+        self.reviewDone = 0
+        
+        params = self.engineView.getGoParams()
+        todo = []
+        for position in self.reviewList:
+            fenInfo = self.makeCachedEngineInfo(position, params)
+            if fenInfo:
+                fenInfo['index'] = position['index']
+                fenInfo['review_id'] = self.engineReviewId
+                self.onEnginePoolResult(fenInfo)
+            else:
+                todo.append(position)
+        self.reviewList = []
+
+        if todo:
+            self.enginePool.review(todo, params, self.engineReviewId)
+        elif self.reviewMode == ReviewMode.ByEngine:
+            self.onReviewGameEnd()
+
+    def onEnginePoolResult(self, fenInfo):
+        #已经停止或者重新开始的复盘
+        if (self.reviewMode != ReviewMode.ByEngine) or (fenInfo.pop('review_id', None) != self.engineReviewId):
+            return
+        
+        fenInfo.pop('bestmove_time', None)
+        self.reviewDone += 1
+        #被将死或困毙的局面没有分析结果，只计入完成数
+        if fenInfo.get('action') not in ['dead', 'draw']:
+            self.applyReviewResult(fenInfo)
+            if not fenInfo.get('cached', False):
+                self.saveEngineEval(fenInfo)
+        
+        self.statusBar().showMessage(f"引擎复盘 {self.reviewDone}/{self.reviewTotal}")
+        if self.reviewDone >= self.reviewTotal:
+            self.enginePool.logStats()
+            speed = ' '.join(f"{x['positions']}局/{x['per_min']}每分钟" for x in self.enginePool.throughput().values())
+            self.statusBar().showMessage(f"引擎复盘 {self.reviewDone}/{self.reviewTotal}  {speed}")
+            self.onReviewGameEnd()
             
     def onReviewGameStep(self):
         if len(self.reviewList) > 0:
@@ -1103,9 +1386,7 @@ class MainWindow(QMainWindow):
             self.changePositionSignal.emit(False, True)
             QApplication.processEvents()
 
-            if self.reviewMode == ReviewMode.ByCloud:
-                self.cloudQuery.startQuery(position)
-            elif self.reviewMode == ReviewMode.ByEngine:
+            if self.reviewMode == ReviewMode.ByEngine:
                 self.runEngine(position)
         else:
             self.onReviewGameEnd()
@@ -1116,7 +1397,11 @@ class MainWindow(QMainWindow):
         self.historyView.inner.reviewByEngineBtn.setText('引擎复盘')
         self.engineView.onReviewEnd(self.reviewMode)
         
-        if not isCanceled:
+        if isCanceled:
+            self.cloudQuery.cancelQueries(PRIORITY_REVIEW)
+            if self.enginePool:
+                self.enginePool.cancel()
+        else:
             msgbox = TimerMessageBox("  复盘分析完成。  ", timeout=1)
             msgbox.exec()
         
@@ -1281,12 +1566,61 @@ class MainWindow(QMainWindow):
         dlg = ImageToBoardDialog(self)
         dlg.edit(img)
 
+    #编辑要搜索的局面，在局面搜索窗口中列出经过这个局面的对局
     def onSearchBoard(self):
         dlg = PositionEditDialog(self)
-        new_fen = dlg.edit('')
+        new_fen = dlg.edit(self.board.to_fen())
         if new_fen:
+            self.gameSearchView.show()
             self.initGame(new_fen)
 
+    def searchGames(self, position):
+        if not self.gameSearchView.isVisible():
+            return
+        if self.gameSearchView.fen == position['fen']:
+            return
+        self.gameSearchView.updateResult(Globl.gameIndex.query(position['fen']))
+
+    def onGameSearchVisible(self, visible):
+        if visible and self.positionList:
+            self.searchGames(self.currPosition)
+
+    #打开局面索引中的对局，走到经过搜索局面的分支和步数
+    def onOpenIndexedGame(self, info):
+        try:
+            if info['lib_index'] >= 0:
+                game = Game.read_from_lib(info['name'])['games'][info['lib_index']]
+            else:
+                game = Game.read_from(info['name'])
+        except Exception as e:
+            game = None
+            logging.error(f"读取棋谱文件【{info['name']}】错误：{e}")
+
+        if not game:
+            msgbox = TimerMessageBox(f"读取棋谱文件错误：{info['name']}")
+            msgbox.exec()
+            return
+
+        key = getFenKey(self.gameSearchView.fen)[0] if self.gameSearchView.fen else None
+        lines = game.dump_moves()
+        line_index = 0
+        for index, line in enumerate(lines):
+            moves = line['moves']
+            if (not moves) or (len(moves) < info['ply']):
+                continue
+            board = moves[info['ply']].board if info['ply'] < len(moves) else moves[-1].board_done
+            if getBoardKey(board)[0] == key:
+                line_index = index
+                break
+
+        self.initGame(game.init_board.to_fen())
+        if lines:
+            for move in lines[line_index]['moves']:
+                self.onMoveGo(str(move), quickMode = True)
+        self.isNeedSave = False
+        self.updateTitle(Path(info['name']).name)
+        self.onSelectHistoryPosition(info['ply'])
+
     def onSetupEngine(self):
         dlg = EngineConfigDialog(self)
         dlg.exec()
@@ -1306,6 +1640,60 @@ class MainWindow(QMainWindow):
         
         self.openFile(fileName)
         
+    #-----------------------------------------------------------
+    #棋谱目录批量导入本地库
+    def onImportGames(self):
+        if self.gameImporter and self.gameImporter.isRunning:
+            msgbox = TimerMessageBox("正在导入棋谱，请等待完成。")
+            msgbox.exec()
+            return
+
+        folder = QFileDialog.getExistingDirectory(self, "导入棋谱目录", self.lastOpenFolder)
+        if not folder:
+            return
+        
+        self.gameImporter = GameImporter(Globl.localBook, folder)
+        self.gameImporter.progress = lambda done, total, file_name: self.importProgressSignal.emit(done, total, file_name)
+        self.gameImporter.finished = lambda stats: self.importFinishedSignal.emit(stats)
+        self.importThread = ThreadRunner(self.gameImporter)
+        self.importThread.start()
+        
+    def onImportProgress(self, done, total, file_name):
+        self.statusBar().showMessage(f"导入棋谱 {done}/{total}：{Path(file_name).name}")
+
+    #-----------------------------------------------------------
+    #棋谱目录加入局面索引
+    def onIndexGames(self):
+        if self.gameIndexer and self.gameIndexer.isRunning:
+            msgbox = TimerMessageBox("正在建立局面索引，请等待完成。")
+            msgbox.exec()
+            return
+
+        folder = QFileDialog.getExistingDirectory(self, "建立棋谱局面索引", self.lastOpenFolder)
+        if not folder:
+            return
+        
+        self.gameIndexer = GameIndexer(Globl.gameIndex, folder)
+        self.gameIndexer.progress = lambda done, total, file_name: self.indexProgressSignal.emit(done, total, file_name)
+        self.gameIndexer.finished = lambda stats: self.indexFinishedSignal.emit(stats)
+        self.indexThread = ThreadRunner(self.gameIndexer)
+        self.indexThread.start()
+        
+    def onIndexProgress(self, done, total, file_name):
+        self.statusBar().showMessage(f"建立局面索引 {done}/{total}：{Path(file_name).name}")
+
+    def onIndexFinished(self, stats):
+        msg = f"建立局面索引完成：{stats['files']} 个文件，{stats['games']} 局，跳过已索引文件 {stats['skipped']} 个，失败 {stats['failed']} 个，用时 {stats['seconds']} 秒"
+        self.statusBar().showMessage(msg)
+        self.gameSearchView.fen = None
+        if self.positionList:
+            self.searchGames(self.currPosition)
+
+    def onImportFinished(self, stats):
+        Globl.bookStack.clearCache()
+        msg = f"导入棋谱完成：{stats['files']} 个文件，新增着法 {stats['new_moves']} 个，跳过已导入文件 {stats['skipped']} 个，失败 {stats['failed']} 个，用时 {stats['seconds']} 秒"
+        self.statusBar().showMessage(msg)
+        
     def onOpenEndGameFile(self):
         options = QFileDialog.Options()
         #options |= QFileDialog.DontUseNativeDialog
@@ -1403,6 +1791,10 @@ class MainWindow(QMainWindow):
             msgbox = TimerMessageBox(msg)
             msgbox.exec()
             return False    
+        
+        #保存的对局加入局面索引，着法统计随之更新
+        if Globl.gameIndex.addFile(file_name):
+            self.gameSearchView.fen = None
         return True
 
     def onUseOpenBookFile(self):
@@ -1472,6 +1864,20 @@ class MainWindow(QMainWindow):
                                    statusTip="打开棋谱（库）文件",
                                    triggered=self.onOpenFile)
         
+        self.importGamesAct = QAction(self.style().standardIcon(
+                                    QStyle.SP_DirOpenIcon),
+                                   "导入棋谱目录",
+                                   self,
+                                   statusTip="把目录中的所有棋谱导入本地库",
+                                   triggered=self.onImportGames)
+
+        self.indexGamesAct = QAction(self.style().standardIcon(
+                                    QStyle.SP_FileDialogContentsView),
+                                   "建立棋谱局面索引",
+                                   self,
+                                   statusTip="索引目录中的所有棋谱，用于搜索局面",
+                                   triggered=self.onIndexGames)
+
         self.openEndGameFileAct = QAction(self.style().standardIcon(
                                     QStyle.SP_FileDialogStart),
                                    "打开残局挑战库",
@@ -1583,6 +1989,8 @@ class MainWindow(QMainWindow):
         self.fileMenu = self.menuBar().addMenu("文件")
         self.fileMenu.addAction(self.openFileAct)
         self.fileMenu.addAction(self.saveFileAct)
+        self.fileMenu.addAction(self.importGamesAct)
+        self.fileMenu.addAction(self.indexGamesAct)
         self.fileMenu.addSeparator()
         self.fileMenu.addAction(self.openEndGameFileAct)
         self.fileMenu.addSeparator()
@@ -1603,6 +2011,7 @@ class MainWindow(QMainWindow):
         self.winMenu.addAction(self.engineView.toggleViewAction())
         #self.winMenu.addAction(self.moveDbView.toggleViewAction())
         self.winMenu.addAction(self.actionsView.toggleViewAction())
+        self.winMenu.addAction(self.gameSearchView.toggleViewAction())
         self.winMenu.addAction(self.showMoveSoundAct)
 
         self.skinMenu = self.menuBar().addMenu("皮肤")
@@ -1650,7 +2059,7 @@ class MainWindow(QMainWindow):
         self.gameBar.addAction(self.restartAct)
         self.gameBar.addAction(self.editBoardAct)
         #self.gameBar.addAction(self.captureBoardAct)
-        #self.gameBar.addAction(self.searchBoardAct)
+        self.gameBar.addAction(self.searchBoardAct)
 
         self.flipBox = QCheckBox()  #"翻转")
         self.flipBox.setIcon(QIcon(':ImgRes/up_down.png'))
@@ -1729,13 +2138,27 @@ class MainWindow(QMainWindow):
         self.writeSettings()
         Globl.engineManager.stopThinking()
         Globl.engineManager.quit()
+        if self.enginePool:
+            self.enginePool.quit()
         time.sleep(0.6)
         
-        self.openBook.close()
+        if self.gameImporter and self.gameImporter.isRunning:
+            self.gameImporter.stop()
+            self.importThread.wait()
+
+        if self.gameIndexer and self.gameIndexer.isRunning:
+            self.gameIndexer.stop()
+            self.indexThread.wait()
+
+        Globl.bookStack.close()
         #Globl.bookmarkStore.close()
         Globl.endbookStore.close()
         Globl.localBook.close()
+        Globl.analysisStore.close()
+        Globl.gameIndex.close()
         
+        Globl.fenCache.logStats()
+        self.cloudQuery.logStats()
         logging.info('应用关闭.')
 
     def readSettingsBeforeGameInit(self):
@@ -3,18 +3,20 @@
 import time
 import logging
 
-#import threading
-
 #from PySide6 import *
 from PySide6.QtCore import Signal, QObject
 #from PySide6.QtGui import *
 
 import cchess
-from cchess import ChessBoard, UcciEngine, UciEngine
+from cchess import ChessBoard
 
 from .Utils import ThreadRunner
+from .EngineCore import createEngine, makeBestResult, makePVActions
 
 #-----------------------------------------------------#
+#引擎分析信息按multipv分支合并，最多每INFO_FLUSH_INTERVAL秒发给界面一次
+INFO_FLUSH_INTERVAL = 0.05
+
 class EngineManager(QObject):
 
     readySignal = Signal(int, str, list)
@@ -30,17 +32,26 @@ class EngineManager(QObject):
 
         self.fen = None
         self.fen_engine = None
+        self.lastDepth = 0
+        
+        #当前局面解析好的棋盘，fen不变时重复使用
+        self.boardFen = None
+        self.board = None
+
+        #多分支分析：每个分支最新的info，bestmove时作为一批候选着法一起返回
+        self.multiPV = 1
+        self.pvLines = [None]
+
+        #multipv分支序号 -> 还没发给界面的最新分析信息
+        self.pendingInfo = {}
+        self.infoInterval = INFO_FLUSH_INTERVAL
+        self.lastInfoFlush = 0
         
         self.isRunning = False
         self.isReady = False
 
     def loadEngine(self, engine_path, engine_type):
-        if engine_type == 'uci':
-            engine = UciEngine('')
-        elif engine_type == 'ucci':
-            engine = UcciEngine('')
-        else:
-            raise Exception('目前只支持[uci, ucci]类型的引擎。') 
+        engine = createEngine(engine_type)
 
         if engine.load(engine_path):
             self.engine = engine
@@ -55,6 +66,11 @@ class EngineManager(QObject):
 
         logging.info(f'Engine[{self.id}] setOption: {name} = {value}')
         self.engine.set_option(name, value)
+        
+        if name == 'MultiPV':
+            self.multiPV = max(1, int(value))
+            self.pvLines = [None] * self.multiPV
+
         return True
         
     def goFrom(self, fen_engine, fen = None, params = {}):
@@ -72,6 +88,8 @@ class EngineManager(QObject):
         self.fen_engine = fen_engine
         self.fen = fen
         self.stopThinking()
+        self.pvLines = [None] * self.multiPV
+        self.lastDepth = 0
         
         logging.info(f'Engine[{self.id}] goFrom: {fen} {params}')
         return self.engine.go_from(fen_engine, params)
@@ -106,13 +124,40 @@ class EngineManager(QObject):
     def run(self):
         self.isRunning = True
         while self.isRunning:
-            try:
-                self._runOnce()
-            except Exception as e:
-                logging.error(str(e))
-            time.sleep(0.1)
+            #超时是为了能检查isRunning，有待发的分析信息时等到下次刷新的时间
+            timeout = 0.5
+            if self.pendingInfo:
+                timeout = max(0, self.lastInfoFlush + self.infoInterval - time.monotonic())
+
+            if self.engine.outEvent.wait(timeout):
+                self.engine.outEvent.clear()
+            
+                #先清除事件再处理，处理过程中新到的输出会再次触发事件
+                while not (self.engine.engine_out_queque.empty() and self.engine.move_queue.empty()):
+                    try:
+                        self._runOnce()
+                    except Exception as e:
+                        logging.error(str(e))
+            
+            if self.pendingInfo and (time.monotonic() - self.lastInfoFlush >= self.infoInterval):
+                self.flushInfo()
         #self.engine.stop_thinking()
 
+    def flushInfo(self):
+        if not self.pendingInfo:
+            return
+        pending = self.pendingInfo
+        self.pendingInfo = {}
+        self.lastInfoFlush = time.monotonic()
+        for action in pending.values():
+            self.moveInfoSignal.emit(self.id, action)
+
+    def getBoard(self):
+        if self.boardFen != self.fen:
+            self.boardFen = self.fen
+            self.board = ChessBoard(self.fen)
+        return self.board
+
     def _runOnce(self):
 
         action = self.engine.get_action()
@@ -129,51 +174,38 @@ class EngineManager(QObject):
         #move_color = cchess.get_move_color(self.fen)
         if self.fen:
             action['fen'] = self.fen
-            board = ChessBoard(self.fen)
-            move_color = board.get_move_color()
-            
+        
+        #分析信息要先于最终结果到达界面
+        if act_id in ['bestmove', 'dead', 'draw']:
+            self.flushInfo()
+
         if act_id == 'bestmove':
-            ret = {}
-            ret.update(action)
-            iccs = ret['iccs'] = ret.pop('move')
-            m = board.copy().move_iccs(iccs) 
-            
-            #引擎有时会输出以前的局面的着法，这里预先验证一下能不能走，不能走的着法都忽略掉
-            if m is None:
+            board = self.getBoard()
+            ret = makeBestResult(board, action, self.lastDepth)
+            if ret is None:
                 return
 
-            #分数换算到红方得分
-            if move_color == cchess.BLACK:
-                for key in ['score', 'mate'] :
-                    if key in ret:
-                        ret[key] = - ret[key]
-                    
-            #再处理出现mate时，score没分的情况
-            if 'score' not in ret:
-                mate_flag = 1 if ret['mate'] > 0 else -1
-                ret['score'] = 29999 * mate_flag
-            
-            
-            new_fen = m.board_done.to_fen()
-            iccs_dict = {'iccs': iccs, 'diff': 0, 'new_fen': new_fen}
-            for key in ['score', 'mate']:
-                if key in ret:
-                  iccs_dict[key] = ret[key]    
-            
-            ret['actions'] = {iccs: iccs_dict}
+            if self.multiPV > 1:
+                ret['actions'] = makePVActions(board, self.pvLines, ret['actions'][ret['iccs']])
+
+            ret['bestmove_time'] = self.engine.bestMoveTime
             self.moveBestSignal.emit(self.id, ret)
 
         elif act_id == 'info_move':
+            if 'depth' in action:
+                self.lastDepth = action['depth']
+            #同一分支只保留最新的一条，currmove单独一条
+            slot = 'currmove' if 'moves' not in action else action.get('multipv', 1)
+            self.pendingInfo[slot] = action
+            if ('moves' in action) and (1 <= slot <= len(self.pvLines)):
+                self.pvLines[slot - 1] = action
             #分数换算到红方得分
             #if move_color == cchess.BLACK:
             #    for key in ['score', 'mate']:
             #        if key in action:
             #            action[key] = -action[key]
-            self.moveInfoSignal.emit(self.id, action)
         elif act_id == 'dead':  #引擎被将死
             self.checkmateSignal.emit(self.id, action)
         elif act_id == 'draw':  #引擎认输
             self.drawSignal.emit(self.id, action)
-        
 
-#-----------------------------------------------------#
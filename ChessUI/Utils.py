@@ -1,9 +1,8 @@
 # -*- coding: utf-8 -*-
 
-import sys
+import os
 import csv
 import uuid
-import traceback
 from enum import Enum, auto
 from dataclasses import dataclass
 from collections import OrderedDict
@@ -18,7 +17,9 @@ from PySide6.QtWidgets import QMessageBox, QApplication
 #import cv2 as cv
 #from PIL import Image
 
-from cchess import ChessBoard, Move, BLACK 
+from cchess import ChessBoard, Move
+
+from .CloudParser import parseQueryAll, makeResult
 
 #-----------------------------------------------------#
 class GameMode(Enum):
@@ -184,8 +185,11 @@ class TimerMessageBox(QMessageBox):
 
      
 #-----------------------------------------------------#
+#云库地址，可以用环境变量 CHESSDB_URL 指向本地替身服务器(Tools/cloud_stub_server.py)
+CLOUD_DB_URL = os.environ.get('CHESSDB_URL', 'http://www.chessdb.cn/chessdb.php')
+
 def QueryFromCloudDB(fen, score_limit = 70):
-    url = 'http://www.chessdb.cn/chessdb.php'
+    url = CLOUD_DB_URL
     param = {"action": 'queryall'}
     param['board'] = fen
     
@@ -196,42 +200,10 @@ def QueryFromCloudDB(fen, score_limit = 70):
         print(e)
         return []
         
-    text = resp.text.rstrip('\0')
-    if text.lower() in ['', 'unknown']:
-        return []
-
-    board = ChessBoard(fen)
-    move_color = board.get_move_color()    
-    moves = []
+    moves = parseQueryAll(resp.text)
+    ret = makeResult(fen, moves, score_limit)
     
-    #数据分割
-    try:
-        steps = text.split('|')
-        for it in steps:
-            segs = it.strip().split(',')
-            items =[x.split(':') for x in segs]
-            it_dict = {key:value for key, value in items}
-            #print(it_dict)
-            moves.append(it_dict)
-    except Exception:
-        #traceback.print_exc()
-        traceback.print_exception(*sys.exc_info())
-        print('cloud query result:', text, "len:", len(text))
-    
-    #添加中文走子标记       
-    for move in moves:
-        move_it = board.copy().move_iccs(move['move'])
-        if move_it:
-            move['text'] = move_it.to_text()
-        move['score'] = -int(move['score'])  if move_color == BLACK  else  int(move['score'])
-    
-    ret =[]
-    score_base = moves[0]['score']
-    for it in moves:
-        it['diff'] =  it['score'] - score_base
-        if move_color == BLACK :
-            it['diff'] = -it['diff']
-        if  score_limit > 0 and abs(it['diff']) >  score_limit:
-                continue
-        ret.append(it)       
-    return  ret        
+    return [{'move': iccs, 'text': act['text'], 'score': act['score'], 'diff': act['diff'],
+                'rank': act['rank'], 'winrate': act['winrate'], 'note': act['note']} 
+                    for iccs, act in ret['actions'].items()]
+
@@ -15,7 +15,7 @@ from PySide6.QtWidgets import QStyle, QApplication, QMenu, QHBoxLayout, QVBoxLay
 import cchess
 from cchess import ChessBoard
 
-from .Utils import GameMode, ReviewMode, getTitle, TimerMessageBox, getFreeMem, getStepsTextFromFenMoves, loadEglib, loadCsvlib
+from .Utils import GameMode, ReviewMode, getTitle, TimerMessageBox, getFreeMem, loadEglib, loadCsvlib
 from .BoardWidgets import ChessBoardWidget, ChessBoardEditWidget
 from .SnippingWidget import SnippingWidget
 from .Dialogs import EngineConfigDialog
@@ -492,6 +492,8 @@ class EngineWidget(QDockWidget):
         vbox.addWidget(self.positionView)
 
         self.branchs = []
+        #multipv分支序号 -> 显示该分支的行
+        self.slotItems = {}
     
     def getDefaultMem(self):
         mem = getFreeMem()/2
@@ -548,35 +550,44 @@ class EngineWidget(QDockWidget):
         if "moves" not in fenInfo:
             return
 
-        iccs_str = ','.join(fenInfo["moves"])
-        fenInfo['iccs_str'] = iccs_str
-
         fen = fenInfo['fen']
         
-        ok, moves_text = getStepsTextFromFenMoves(fen, fenInfo["moves"])
+        ok, moves_text = Globl.pvTextCache.getStepsText(fen, fenInfo["moves"])
         if not ok:
             #logging.warning(f'{fen}, moves {fenInfo["moves"]}')
             return
 
+        iccs_str = ','.join(fenInfo["moves"])
+        fenInfo['iccs_str'] = iccs_str
         fenInfo['move_text'] = ','.join(moves_text)
 
-        found = False
-        for i in range(self.positionView.topLevelItemCount()):
-            it = self.positionView.topLevelItem(i)
+        #每个multipv分支对应一行
+        slot = fenInfo.get('multipv', 1)
+        it = self.slotItems.get(slot)
+        if it is not None:
             iccs_it = it.data(0, Qt.UserRole)
             if iccs_str.find(iccs_it) == 0:  #新的步骤提示比已有的长
                 self.updateNode(it, fenInfo, True)
-                found = True
-                break
+                return
             elif iccs_it.find(iccs_str) == 0:  #新的步骤提示比已有的短
                 self.updateNode(it, fenInfo, False)
-                found = True
+                return
+            elif self.isMultiPV():
+                self.updateNode(it, fenInfo, True)
+                return
 
-        if not found:
-            it = QTreeWidgetItem(self.positionView)
-            self.updateNode(it, fenInfo, True)
+        #单分支时换了着法就新加一行，新的(深度更深的)在最上面；多分支时按分支序号排列
+        it = QTreeWidgetItem()
+        if self.isMultiPV():
+            index = len([x for x in self.slotItems if x < slot])
+        else:
+            index = 0
+        self.positionView.insertTopLevelItem(index, it)
+        self.slotItems[slot] = it
+        self.updateNode(it, fenInfo, True)
 
-        self.positionView.sortItems(0, Qt.DescendingOrder)  #Qt.AscendingOrder)
+    def isMultiPV(self):
+        return self.engineManager.multiPV > 1
 
     def updateNode(self, it, fenInfo, is_new_text=True):
 
@@ -607,6 +618,7 @@ class EngineWidget(QDockWidget):
 
         self.engineManager.setOption('Threads', self.params['EngineThreads'])
         self.engineManager.setOption('Hash', self.params['EngineMemory'])
+        self.engineManager.setOption('MultiPV', self.params['EngineMultiPV'])
         
         #self.onSwitchGameMode(self.gameMode)
 
@@ -722,6 +734,7 @@ class EngineWidget(QDockWidget):
         
     def clear(self):
         self.positionView.clear()
+        self.slotItems = {}
 
     def sizeHint(self):
         return QSize(400, 100)
@@ -948,11 +961,13 @@ class BoardActionsWidget(QDockWidget):
         self.actionsView = QTreeWidget()
 
         self.actionsView.setColumnCount(1)
-        self.actionsView.setHeaderLabels(['MK', "备选着法", "得分", ''])
+        self.actionsView.setHeaderLabels(['MK', "备选着法", "得分", "局数", "红/和/黑", ''])
         self.actionsView.setColumnWidth(0, 20)
         self.actionsView.setColumnWidth(1, 80)
         self.actionsView.setColumnWidth(2, 40)
-        self.actionsView.setColumnWidth(3, 1)
+        self.actionsView.setColumnWidth(3, 40)
+        self.actionsView.setColumnWidth(4, 70)
+        self.actionsView.setColumnWidth(5, 1)
         
         self.actionsView.clicked.connect(self.onSelectIndex)
         
@@ -990,6 +1005,14 @@ class BoardActionsWidget(QDockWidget):
                 item.setText(2, str(act['score']))
             item.setTextAlignment(2, Qt.AlignRight)
             
+            #棋谱局面索引中的实战统计
+            if 'games' in act:
+                games = act['games']
+                item.setText(3, str(games['count']))
+                item.setTextAlignment(3, Qt.AlignRight)
+                item.setText(4, f"{games['red_win']}/{games['draw']}/{games['black_win']}")
+                item.setToolTip(4, f"红胜 {games['red_win']}，和 {games['draw']}，黑胜 {games['black_win']}，平均在第 {games['avg_ply'] + 1:.0f} 着走出")
+            
             item.setData(0, Qt.UserRole, act)
         self.update()
 
@@ -1362,5 +1385,97 @@ class GameLibWidget(QDockWidget):
     def sizeHint(self):
         return QSize(150, 500)
 
+#------------------------------------------------------------------#
+#棋谱局面索引的查询结果：经过当前局面的对局数、各着法的统计和对局列表
+class GameSearchWidget(QDockWidget):
+    selectMoveSignal = Signal(dict)
+    openGameSignal = Signal(dict)
+
+    def __init__(self, parent):
+        super().__init__("局面搜索", parent)
+        self.setObjectName("GameSearchWidget")
+        self.setAllowedAreas(Qt.LeftDockWidgetArea | Qt.RightDockWidgetArea)
 
+        self.parent = parent
+        self.fen = None
 
+        self.dockedWidget = QWidget(self)
+        self.setWidget(self.dockedWidget)
+
+        self.statsLabel = QLabel()
+
+        self.movesView = QTreeWidget()
+        self.movesView.setHeaderLabels(["着法", "局数", "红胜", "和", "黑胜"])
+        self.movesView.setColumnWidth(0, 80)
+        for i in range(1, 5):
+            self.movesView.setColumnWidth(i, 40)
+        self.movesView.clicked.connect(self.onSelectMove)
+
+        self.gamesView = QTreeWidget()
+        self.gamesView.setHeaderLabels(["对局", "结果", "步数", "下一着"])
+        self.gamesView.setColumnWidth(0, 160)
+        self.gamesView.setColumnWidth(1, 50)
+        self.gamesView.setColumnWidth(2, 40)
+        self.gamesView.doubleClicked.connect(self.onOpenGame)
+
+        splitter = QSplitter(Qt.Vertical)
+        splitter.addWidget(self.movesView)
+        splitter.addWidget(self.gamesView)
+
+        vbox = QVBoxLayout()
+        vbox.addWidget(self.statsLabel)
+        vbox.addWidget(splitter)
+        self.dockedWidget.setLayout(vbox)
+
+    def clear(self):
+        self.fen = None
+        self.statsLabel.setText('')
+        self.movesView.clear()
+        self.gamesView.clear()
+
+    def moveText(self, board, iccs):
+        if not iccs:
+            return ''
+        move_it = board.copy().move_iccs(iccs)
+        return move_it.to_text() if move_it else iccs
+
+    def updateResult(self, ret):
+        self.clear()
+        self.fen = ret['fen']
+        board = ChessBoard(self.fen)
+
+        stats = ret['stats']
+        self.statsLabel.setText(f"共 {stats['games']} 局  红胜 {stats['red_win']}  和 {stats['draw']}  黑胜 {stats['black_win']}")
+
+        for iccs, it in ret['moves'].items():
+            item = QTreeWidgetItem(self.movesView)
+            item.setText(0, self.moveText(board, iccs))
+            for col, name in enumerate(['count', 'red_win', 'draw', 'black_win'], 1):
+                item.setText(col, str(it[name]))
+                item.setTextAlignment(col, Qt.AlignRight)
+            item.setData(0, Qt.UserRole, {'fen': self.fen, 'iccs': iccs})
+
+        for game in ret['games']:
+            item = QTreeWidgetItem(self.gamesView)
+            title = game['title'] or Path(game['name']).stem
+            if game['red'] or game['black']:
+                title = f"{title} {game['red'] or ''} - {game['black'] or ''}"
+            item.setText(0, title)
+            item.setToolTip(0, game['name'])
+            item.setText(1, game['result'])
+            item.setText(2, f"{game['ply']}/{game['plies']}")
+            item.setText(3, self.moveText(board, game['next_iccs']))
+            item.setData(0, Qt.UserRole, game)
+
+    def onSelectMove(self, index):
+        item = self.movesView.currentItem()
+        if item:
+            self.selectMoveSignal.emit(item.data(0, Qt.UserRole))
+
+    def onOpenGame(self):
+        item = self.gamesView.currentItem()
+        if item:
+            self.openGameSignal.emit(item.data(0, Qt.UserRole))
+
+    def sizeHint(self):
+        return QSize(220, 500)
@@ -1,5 +1,8 @@
+import multiprocessing
 
 from ChessUI.App import run
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    #打包后的程序中，导入棋谱的工作进程需要
+    multiprocessing.freeze_support()
+    run()
@@ -1,50 +1,255 @@
+# -*- coding: utf-8 -*-
+#用引擎生成开局库
+#   从起始局面开始按步数一层一层(宽度优先)扩展，每个待分析局面用引擎多分支(MultiPV)分析，
+#   与最好着法的分差在 --window 以内的着法写入开局库，这些着法走出的局面再加入待分析局面
+#   多个引擎进程同时分析(--pool)，局面按规范键值(局面与镜像局面zhash的较小者)去重
+#   待分析局面保存在库中的frontier表，结果每隔 --commit-interval 秒在一个事务中写入，中断后重新运行即可继续
+#
+#结果写入勇芳格式的bhobk表(vscore为走子方得分)，生成的文件可以直接作为yfk开局库打开
+#
+#   python PikaDBMaker.py pikabook.yfk --engine ../Engine/pikafish_230408/pikafish.exe --pool 2 --depth 20 --max-step 12
 
+import sys
+import time
 import asyncio
-import tornado
+import argparse
+from pathlib import Path
+
+import cchess
+from cchess import ChessBoard, FULL_INIT_FEN, iccs_mirror
 
 from peewee import *
 from playhouse.sqlite_ext import *
 
-import cchess
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
-from cchess_utils import *
+from ChessUI.LocalDB import OpenBookDB, Bhobk, openBookYfk, getBoardKey
+
+from PikaServer import EnginePool, ServiceError
 
-PIKA_BOOK_FILE = 'pikabook.db'
 #---------------------------------------------------------
-book_db = SqliteExtDatabase(PIKA_BOOK_FILE, pragmas=(
-    ('cache_size', -1024 * 128),  # 128MB page-cache.
-    ('journal_mode', 'wal'),  # Use WAL-mode (you should always use this!).
-    ('synchronous', 0),
-    ('foreign_keys', 0)))  # Enforce foreign-key constraints.
-
-class BoardMove(Model):
-    fen = CharField(index=True)
-    deep  = IntegerField()
-    score = IntegerField()
-    mark  = CharField(null=True)
-    move  = CharField()
-    
+#待分析局面，state：
+FRONTIER_TODO = 0
+FRONTIER_DONE = 1
+FRONTIER_EMPTY = 2      #被将死、困毙或引擎认输
+FRONTIER_FAILED = 3     #引擎分析出错
+
+class Frontier(Model):
+    key = BigIntegerField(unique=True)
+    fen = CharField()
+    step = IntegerField(index=True)
+    state = IntegerField(default=FRONTIER_TODO, index=True)
+
     class Meta:
-        database = book_db
-
-#---------------------------------------------------------------------------
-def is_fen_exist_in_db(fen):
-    board = cchess.ChessBoard(fen)
-    
-    query = list(BoardMove.select().where(BoardMove.fen == fen))
-    if len(query) > 0:
-        return True
-    
-    fen_mirror = board.mirror().to_fen()
-    query = list(BoardMove.select().where(BoardMove.fen == fen))
-    if len(query) > 0:
-        return True
- 
-    return False
-    
+        database = openBookYfk
+        table_name = 'frontier'
+
+def open_db(db_file):
+    db = SqliteExtDatabase(db_file, pragmas=(
+        ('cache_size', -1024 * 64),
+        ('journal_mode', 'wal'),
+        ('synchronous', 1)))
+    openBookYfk.initialize(db)
+    openBookYfk.create_tables([Bhobk, Frontier], safe = True)
+    db.execute_sql('CREATE INDEX IF NOT EXISTS bhobk_vkey ON bhobk (vkey)')
+    return db
+
+#勇芳库的着法编码：起点 | 终点<<8
+VmoveCoord = dict(zip(OpenBookDB.s90, OpenBookDB.c90))
+
+def iccs_to_vmove(iccs):
+    return VmoveCoord[iccs[:2]] | (VmoveCoord[iccs[2:]] << 8)
+
+#---------------------------------------------------------
+class BookMaker():
+    def __init__(self, pool, params, window = 30, max_step = 12, commit_interval = 5.0, timeout = 600):
+        self.pool = pool
+        self.params = params
+        self.window = window
+        self.max_step = max_step
+        self.commit_interval = commit_interval
+        self.timeout = timeout
+
+        #从库中取出还没分给引擎的局面
+        self.queue = []
+        #正在分析和分析完还没写入库的局面
+        self.taken = set()
+        self.results = []
+        self.last_commit = time.monotonic()
+
+        self.stats = {'done': 0, 'empty': 0, 'failed': 0, 'moves': 0, 'new_positions': 0}
+        self.start_time = time.monotonic()
+
+    def seed(self, fen = FULL_INIT_FEN, step = 1):
+        key, _ = getBoardKey(ChessBoard(fen))
+        Frontier.insert(key = key, fen = fen, step = step).on_conflict_ignore().execute()
+
+    #-----------------------------------------------------
+    def load_batch(self):
+        #新加入的局面在写入后才能查到，先把已完成的结果写入
+        self.commit()
+
+        rows = (Frontier.select(Frontier.key, Frontier.fen, Frontier.step)
+                    .where((Frontier.state == FRONTIER_TODO) & (Frontier.step <= self.max_step))
+                    .order_by(Frontier.step, Frontier.id)
+                    .limit(self.pool.count * 8 + len(self.taken))
+                    .tuples())
+        self.queue = [x for x in rows if x[0] not in self.taken]
+        self.queue.reverse()
+
+    async def next_item(self):
+        while True:
+            if not self.queue:
+                self.load_batch()
+            if self.queue:
+                item = self.queue.pop()
+                self.taken.add(item[0])
+                return item
+            #库中没有待分析局面，等正在分析的局面返回新的子局面
+            if not self.taken:
+                return None
+            await asyncio.sleep(0.2)
+
+    async def worker(self):
+        while True:
+            item = await self.next_item()
+            if item is None:
+                return
+            key, fen, step = item
+            try:
+                ret = await self.pool.analyse(fen, self.params, self.timeout)
+            except ServiceError as e:
+                #引擎都退出了，这个局面留在库中下次再分析
+                print(e)
+                self.taken.discard(key)
+                return
+            self.results.append((key, fen, step, ret))
+            if time.monotonic() - self.last_commit >= self.commit_interval:
+                self.commit()
+
+    #-----------------------------------------------------
+    #一个事务写入：局面的着法，frontier的状态，保留着法的子局面
+    def commit(self):
+        self.last_commit = time.monotonic()
+        if not self.results:
+            return
+
+        results = self.results
+        self.results = []
+
+        with openBookYfk.atomic():
+            for key, fen, step, ret in results:
+                self.save_result(key, fen, step, ret)
+
+        for key, fen, step, ret in results:
+            self.taken.discard(key)
+
+        self.print_stats()
+
+    #分差在窗口内的候选着法，分数换算为走子方得分
+    def select_moves(self, ret):
+        sign = -1 if ChessBoard(ret['fen']).get_move_color() == cchess.BLACK else 1
+        moves = []
+        for iccs, act in ret['actions'].items():
+            if act.get('diff', 0) < -self.window:
+                continue
+            moves.append((iccs, act['score'] * sign, act.get('new_fen')))
+        return moves
+
+    def save_result(self, key, fen, step, ret):
+        if ret is None:
+            self.stats['failed'] += 1
+            Frontier.update(state = FRONTIER_FAILED).where(Frontier.key == key).execute()
+            return
+
+        if ret['action'] != 'bestmove':
+            self.stats['empty'] += 1
+            Frontier.update(state = FRONTIER_EMPTY).where(Frontier.key == key).execute()
+            return
+
+        moves = self.select_moves(ret)
+        _, is_mirror = getBoardKey(ChessBoard(fen))
+
+        #以前中断时可能已经写入过这个局面的着法
+        Bhobk.delete().where(Bhobk.vkey == key).execute()
+        rows = []
+        for iccs, score, new_fen in moves:
+            rows.append({'vkey': key, 'vmove': iccs_to_vmove(iccs_mirror(iccs) if is_mirror else iccs),
+                         'vscore': score, 'vwin': 0, 'vdraw': 0, 'vlost': 0, 'vvalid': 1})
+        Bhobk.insert_many(rows).execute()
+        Frontier.update(state = FRONTIER_DONE).where(Frontier.key == key).execute()
+        self.stats['done'] += 1
+        self.stats['moves'] += len(rows)
+
+        #超过最大步数的子局面也加入，以后加大 --max-step 时可以接着扩展
+        children = {}
+        for iccs, score, new_fen in moves:
+            new_board = ChessBoard(new_fen)
+            new_key, _ = getBoardKey(new_board)
+            children[new_key] = {'key': new_key, 'fen': new_fen, 'step': step + 1}
+        if children:
+            cursor = openBookYfk.execute(Frontier.insert_many(list(children.values())).on_conflict_ignore())
+            self.stats['new_positions'] += cursor.rowcount
+
+    def print_stats(self):
+        used = time.monotonic() - self.start_time
+        per_hour = (self.stats['done'] + self.stats['empty']) * 3600 / max(used, 0.1)
+        print(f"{int(used)}s 完成:{self.stats['done']} 着法:{self.stats['moves']} 无着法:{self.stats['empty']} "
+              f"失败:{self.stats['failed']} 新局面:{self.stats['new_positions']} {per_hour:.0f}局面/小时")
+
+    #-----------------------------------------------------
+    async def run(self):
+        workers = [asyncio.create_task(self.worker()) for i in range(self.pool.count)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            self.commit()
+
+        todo = Frontier.select().where((Frontier.state == FRONTIER_TODO) & (Frontier.step <= self.max_step)).count()
+        print(f'生成结束，剩余待分析局面：{todo}')
+        return self.stats
+
 #---------------------------------------------------------
-if not Path(PIKA_BOOK_FILE).is_file():
-        BoardMove.create_table()
+def make_parser():
+    parser = argparse.ArgumentParser(description = '用引擎生成开局库')
+    parser.add_argument('db_file', nargs = '?', default = 'pikabook.yfk')
+    parser.add_argument('--engine', default = '.././Engine/pikafish_230408/pikafish.exe', help = '引擎程序')
+    parser.add_argument('--type', default = 'uci', choices = ['uci', 'ucci'], help = '引擎协议')
+    parser.add_argument('--pool', type = int, default = 2, help = '引擎进程数')
+    parser.add_argument('--threads', type = int, default = 1, help = '每个引擎的线程数')
+    parser.add_argument('--hash', type = int, default = 256, help = '每个引擎的Hash(MB)')
+    parser.add_argument('--multipv', type = int, default = 5, help = '每个局面分析的候选着法数')
+    parser.add_argument('--depth', type = int, default = 20, help = '分析深度')
+    parser.add_argument('--window', type = int, default = 30, help = '保留与最好着法分差不超过window的着法')
+    parser.add_argument('--fen', default = FULL_INIT_FEN, help = '起始局面')
+    parser.add_argument('--max-step', type = int, default = 12, help = '最多扩展到第几步')
+    parser.add_argument('--commit-interval', type = float, default = 5.0, help = '写入间隔(秒)')
+    parser.add_argument('--retry-failed', action = 'store_true', help = '重新分析以前出错的局面')
+    return parser
+
+async def run_maker(args):
+    pool = EnginePool(args.engine, args.type, args.pool, args.threads, args.hash, args.multipv)
+    if not await pool.start():
+        print(f'加载引擎出错：{args.engine}')
+        return
+    try:
+        maker = BookMaker(pool, {'depth': args.depth}, args.window, args.max_step, args.commit_interval)
+        maker.seed(args.fen)
+        await maker.run()
+    finally:
+        pool.quit()
 
-engineMgr = EngineManager()
-  
\ No newline at end of file
+def main(args):
+    open_db(args.db_file)
+
+    if args.retry_failed:
+        Frontier.update(state = FRONTIER_TODO).where(Frontier.state == FRONTIER_FAILED).execute()
+
+    try:
+        asyncio.run(run_maker(args))
+    except KeyboardInterrupt:
+        print('中断，已完成的结果已写入，重新运行可继续')
+
+#---------------------------------------------------------
+if __name__ == "__main__":
+    main(make_parser().parse_args())
@@ -1,19 +1,37 @@
+# -*- coding: utf-8 -*-
+#引擎分析HTTP服务
+#   GET /querybest?fen=xxx[&depth=n][&movetime=ms]   返回json格式的分析结果
+#   GET /stats                                       服务的统计信息
+#多个引擎进程组成引擎池，请求排队等待空闲的引擎，深度和时间不超过服务设置的上限；
+#同一局面、同样参数的并发请求合并为一次分析；分析结果保存在pikabook.db中，按深度分析的请求在已有深度足够的结果时直接返回
+#
+#   python PikaServer.py --engine ../Engine/pikafish_230408/pikafish.exe --pool 2
+#   python PikaServer.py --engine ./fake_engine.py      (用替身引擎测试，见 pika_load_test.py)
 
+import sys
+import json
+import time
 import asyncio
-import tornado
+import logging
+import argparse
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import tornado.web
 
 from peewee import *
 from playhouse.sqlite_ext import *
 
-from cchess_utils import *
+import cchess
+from cchess import ChessBoard
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ChessUI.EngineCore import loadAnalysisEngine
 
 #---------------------------------------------------------
-book_db = SqliteExtDatabase('pikabook.db', pragmas=(
-    ('cache_size', -1024 * 128),  # 128MB page-cache.
-    ('journal_mode', 'wal'),  # Use WAL-mode (you should always use this!).
-    ('synchronous', 0),
-    ('foreign_keys', 0)))  # Enforce foreign-key constraints.
+book_db = Proxy()
 
 class PosMove(Model):
     fen = CharField(index=True)
@@ -21,42 +39,268 @@ class PosMove(Model):
     score = IntegerField()
     mark  = CharField(null=True)
     vmoves = JSONField()
-    
+
     class Meta:
         database = book_db
 
+def open_db(file_name):
+    db = SqliteExtDatabase(file_name, pragmas=(
+        ('cache_size', -1024 * 128),  # 128MB page-cache.
+        ('journal_mode', 'wal'),  # Use WAL-mode (you should always use this!).
+        ('synchronous', 0),
+        ('foreign_keys', 0)))  # Enforce foreign-key constraints.
+    book_db.initialize(db)
+    book_db.create_tables([PosMove], safe = True)
+
 #---------------------------------------------------------
-engineMgr = EngineManager()
-            
+#请求出错时返回给客户端的HTTP状态码和信息
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
 #---------------------------------------------------------
-class MainHandler(tornado.web.RequestHandler):
+#引擎池：每个引擎是一个同步调用的EngineCore，在专用的线程中运行，空闲的引擎放在队列中，
+#请求按到达的顺序等待空闲的引擎
+class EnginePool():
+    def __init__(self, engine_exec, engine_type, size = 2, threads = 1, hash_mb = 256, multipv = 1):
+        self.engine_exec = engine_exec
+        self.engine_type = engine_type
+        self.size = max(1, size)
+        self.threads = threads
+        self.hash_mb = hash_mb
+        self.multipv = multipv
+
+        self.executor = ThreadPoolExecutor(max_workers = self.size)
+        self.idle = asyncio.Queue()
+        self.count = 0
+
+    def load_engine(self, engine_id):
+        return loadAnalysisEngine(engine_id, self.engine_exec, self.engine_type, self.threads, self.hash_mb, self.multipv)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        engines = await asyncio.gather(*[loop.run_in_executor(self.executor, self.load_engine, i + 1) for i in range(self.size)])
+        for engine in engines:
+            if engine:
+                self.idle.put_nowait(engine)
+                self.count += 1
+        return self.count > 0
+
+    def quit(self):
+        while not self.idle.empty():
+            engine = self.idle.get_nowait()
+            if engine:
+                engine.quit()
+        self.executor.shutdown(wait = False)
+
+    async def analyse(self, fen, params, timeout):
+        loop = asyncio.get_running_loop()
+        engine = await self.idle.get()
+        #引擎都重新加载失败后队列中只有一个None，放回去让其他等待的请求也返回
+        if engine is None:
+            self.idle.put_nowait(None)
+            raise ServiceError(503, '没有可用的引擎')
+        try:
+            ret = await loop.run_in_executor(self.executor, engine.analyse, fen, params, None, timeout)
+            #超时或引擎退出，重新启动引擎，免得上一个局面的输出混到下一个局面
+            if ret is None:
+                engine_id = engine.id
+                engine.quit()
+                engine = await loop.run_in_executor(self.executor, self.load_engine, engine_id)
+            return ret
+        finally:
+            if engine:
+                self.idle.put_nowait(engine)
+            else:
+                self.count -= 1
+                logging.error(f'重新加载引擎失败，可用引擎数：{self.count}')
+                if self.count <= 0:
+                    self.idle.put_nowait(None)
+
+#---------------------------------------------------------
+class AnalysisService():
+    def __init__(self, pool, args):
+        self.pool = pool
+        self.args = args
+
+        #(fen, 参数) -> 正在进行的分析
+        self.pending = {}
+        self.latency = deque(maxlen = 10000)
+        self.stats = {'requests': 0, 'cache_hits': 0, 'coalesced': 0, 'analysed': 0,
+                      'rejected': 0, 'errors': 0, 'started': time.time()}
+
+    #深度和时间限制在服务设置的范围内，都没有时使用默认深度
+    def make_params(self, depth, movetime):
+        if movetime:
+            return {'movetime': max(1, min(movetime, self.args.max_movetime))}
+        return {'depth': max(1, min(depth or self.args.depth, self.args.max_depth))}
+
+    #只记录了深度，按时间分析的请求不用缓存的结果
+    def load_cache(self, fen, params):
+        if 'depth' not in params:
+            return None
+        it = (PosMove.select()
+                .where((PosMove.fen == fen) & (PosMove.deep >= params['depth']))
+                .order_by(-PosMove.deep)
+                .first())
+        if not it:
+            return None
+        ret = dict(it.vmoves)
+        ret['cached'] = True
+        return ret
+
+    def save_cache(self, ret):
+        if ret['status'] != 'ok':
+            return
+        PosMove.insert(fen = ret['fen'], deep = ret['depth'], score = ret['score'], mark = ret['iccs'],
+                       vmoves = {k: v for k, v in ret.items() if k not in ['cached', 'seconds']}).execute()
+
+    def make_result(self, fen, ret, seconds):
+        if ret['action'] in ['dead', 'draw']:
+            return {'fen': fen, 'status': ret['action'], 'cached': False, 'seconds': round(seconds, 3)}
+
+        result = {'fen': fen, 'status': 'ok', 'cached': False}
+        for key in ['iccs', 'score', 'mate', 'depth']:
+            if key in ret:
+                result[key] = ret[key]
+        result['pv'] = ret.get('moves', [])
+        result['seconds'] = round(seconds, 3)
+        return result
+
+    async def run_analyse(self, fen, params):
+        start_time = time.monotonic()
+        ret = await self.pool.analyse(fen, params, self.args.timeout)
+        if ret is None:
+            raise ServiceError(504, '引擎分析超时或出错')
+
+        self.stats['analysed'] += 1
+        result = self.make_result(fen, ret, time.monotonic() - start_time)
+        self.save_cache(result)
+        return result
+
+    async def query(self, fen, depth = None, movetime = None):
+        self.stats['requests'] += 1
+        try:
+            board = ChessBoard(fen)
+        except Exception:
+            board = None
+        if (not board) or (not board.get_king(cchess.RED)) or (not board.get_king(cchess.BLACK)):
+            raise ServiceError(400, f'局面格式错误：{fen}')
+        fen = board.to_fen()
+
+        params = self.make_params(depth, movetime)
+        ret = self.load_cache(fen, params)
+        if ret:
+            self.stats['cache_hits'] += 1
+            return ret
+
+        key = (fen, tuple(sorted(params.items())))
+        task = self.pending.get(key)
+        if task:
+            self.stats['coalesced'] += 1
+        else:
+            if len(self.pending) >= self.args.max_pending:
+                self.stats['rejected'] += 1
+                raise ServiceError(503, '服务繁忙，请稍后再试')
+            task = asyncio.ensure_future(self.run_analyse(fen, params))
+            self.pending[key] = task
+            task.add_done_callback(lambda t: self.pending.pop(key, None))
+
+        #合并的请求共用同一个分析任务，某个请求断开不影响其他请求
+        return await asyncio.shield(task)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['seconds'] = round(time.time() - stats.pop('started'), 1)
+        stats['pending'] = len(self.pending)
+        stats['engines'] = self.pool.count
+        stats['idle_engines'] = self.pool.idle.qsize() if self.pool.count > 0 else 0
+        if self.latency:
+            values = sorted(self.latency)
+            stats['p50_ms'] = round(values[len(values) // 2] * 1000, 1)
+            stats['p99_ms'] = round(values[min(len(values) - 1, int(len(values) * 0.99))] * 1000, 1)
+        return stats
+
+#---------------------------------------------------------
+class QueryBestHandler(tornado.web.RequestHandler):
+    def initialize(self, service):
+        self.service = service
+
+    def write_json(self, status, obj):
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(obj, ensure_ascii = False))
+
+    async def get(self):
+        start_time = time.monotonic()
+        fen = self.get_argument('fen', None, True)
+        try:
+            if not fen:
+                raise ServiceError(400, '缺少fen参数')
+            try:
+                depth = int(self.get_argument('depth', 0))
+                movetime = int(self.get_argument('movetime', 0))
+            except ValueError:
+                raise ServiceError(400, 'depth和movetime必须是整数')
+
+            ret = await self.service.query(fen, depth, movetime)
+        except ServiceError as e:
+            self.service.stats['errors'] += 1
+            self.write_json(e.status, {'fen': fen, 'status': 'error', 'error': str(e)})
+            return
+
+        self.service.latency.append(time.monotonic() - start_time)
+        self.write_json(200, ret)
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, service):
+        self.service = service
+
     def get(self):
-        global engineMgr
-        fen = self.get_argument("fen", None, True)
-        go_params = { 'depth': 3 }
-        print(fen)
-        ret = engineMgr.get_best_moves(fen, go_params)
-        print(ret)
-        self.write(str(ret))
-    
-    def put(self):
-        body = json.loads(self.request.body)
-        # do some stuff here
-        self.write("{} your ID is {}".format(body['name'], body['id']))
-        
-def make_app():
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(self.service.get_stats()))
+
+def make_app(service):
     return tornado.web.Application([
-        (r"/querybest", MainHandler),
+        (r"/querybest", QueryBestHandler, {'service': service}),
+        (r"/stats", StatsHandler, {'service': service}),
     ])
 
 #---------------------------------------------------------
-async def main():
-    ok = engineMgr.load_engine('.././Engine/pikafish_230408/pikafish.exe', 'uci')
-    print(ok)          
-    app = make_app()
-    app.listen(8000)
-    await asyncio.Event().wait()
+async def main(args):
+    open_db(args.db)
+
+    pool = EnginePool(args.engine, args.type, args.pool, args.threads, args.hash)
+    if not await pool.start():
+        print(f'加载引擎出错：{args.engine}', flush = True)
+        return
+
+    service = AnalysisService(pool, args)
+    app = make_app(service)
+    app.listen(args.port, args.host)
+    print(f'引擎分析服务：http://{args.host}:{args.port}/querybest，引擎数：{pool.count}', flush = True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        pool.quit()
 
 #---------------------------------------------------------
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = '引擎分析HTTP服务')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--engine', default = '.././Engine/pikafish_230408/pikafish.exe', help = '引擎程序')
+    parser.add_argument('--type', default = 'uci', choices = ['uci', 'ucci'], help = '引擎协议')
+    parser.add_argument('--pool', type = int, default = 2, help = '引擎进程数')
+    parser.add_argument('--threads', type = int, default = 1, help = '每个引擎的线程数')
+    parser.add_argument('--hash', type = int, default = 256, help = '每个引擎的Hash(MB)')
+    parser.add_argument('--db', default = 'pikabook.db', help = '分析结果缓存库')
+    parser.add_argument('--depth', type = int, default = 20, help = '请求没有指定深度和时间时的分析深度')
+    parser.add_argument('--max-depth', type = int, default = 30, help = '请求的最大深度')
+    parser.add_argument('--max-movetime', type = int, default = 10000, help = '请求的最长分析时间(毫秒)')
+    parser.add_argument('--max-pending', type = int, default = 256, help = '排队中的分析任务数上限，超过时返回503')
+    parser.add_argument('--timeout', type = int, default = 120, help = '单个局面最长的分析时间(秒)')
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
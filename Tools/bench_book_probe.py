@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#开局库查询速度测试
+#从初始局面开始沿着库中的着法遍历出测试局面，然后统计每秒能查询的局面数：
+#   raw  只查询着法
+#   top3 查询后读取前三个着法的中文和新局面(界面显示时的用法)
+
+import sys
+import time
+from pathlib import Path
+from collections import deque
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from cchess import FULL_INIT_FEN
+
+from ChessUI.LocalDB import LocalBook, OpenBookYfk, OpenBookPF, OpenBookBin, MasterBook
+
+#---------------------------------------------------------
+BOOK_TYPES = {
+    '.evb': OpenBookBin,
+    '.yfk': OpenBookYfk,
+    '.pfbook': OpenBookPF,
+    '.edb': MasterBook,
+    '.db': LocalBook,
+}
+
+def open_book(file_name):
+    book = BOOK_TYPES[Path(file_name).suffix.lower()]()
+    book.open(file_name)
+    return book
+
+def collect_positions(book, count):
+    positions = []
+    seen = set()
+    todo = deque([FULL_INIT_FEN])
+    while todo and len(positions) < count:
+        fen = todo.popleft()
+        if fen in seen:
+            continue
+        seen.add(fen)
+
+        ret = book.getMoves(fen)
+        if not ret:
+            continue
+        positions.append(fen)
+        for act in ret['actions'].values():
+            if act['new_fen']:
+                todo.append(act['new_fen'])
+    return positions
+
+def bench(book, positions, top = 0, rounds = 3):
+    best = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        for fen in positions:
+            ret = book.getMoves(fen)
+            for act in list(ret['actions'].values())[:top]:
+                act['text']
+                act.get('new_fen')
+        used = time.perf_counter() - start
+        best = used if best is None else min(best, used)
+    return len(positions) / best
+
+#---------------------------------------------------------
+if __name__ == '__main__':
+
+    if len(sys.argv) not in [2, 3]:
+        print(f'Usage {sys.argv[0]} book_file [positions]')
+        sys.exit(-1)
+
+    count = int(sys.argv[2]) if len(sys.argv) == 3 else 2000
+    book = open_book(sys.argv[1])
+    positions = collect_positions(book, count)
+    moves = sum(len(book.getMoves(fen)['actions']) for fen in positions)
+    print(f'{sys.argv[1]}：{len(positions)} 个局面，平均 {moves / max(len(positions), 1):.1f} 个着法')
+
+    print(f'raw : {bench(book, positions):.0f} 局面/秒')
+    print(f'top3: {bench(book, positions, 3):.0f} 局面/秒')
+
+    book.close()
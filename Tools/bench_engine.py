@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#引擎管线的性能测试，使用替身引擎(fake_engine.py)，不需要真正的引擎，Linux下也可以运行
+#   latency     引擎输出bestmove到界面收到moveBestSignal的延迟，以及goFrom到收到结果的总时间
+#   throughput  引擎大量输出info时，EngineManager每秒处理的info行数和发给界面的信号数(合并后)，
+#               同时测试不用界面的EngineCore(批量分析使用)
+#   ui          EngineWidget处理分析信息的耗时(着法转中文、更新分析列表)
+#
+#   python bench_engine.py                      全部测试
+#   python bench_engine.py latency ui -n 50     只测部分项目
+
+import os
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+#测试不需要显示窗口
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PySide6.QtCore import Qt, QEventLoop, QTimer
+from PySide6.QtWidgets import QApplication, QMainWindow
+
+from cchess import ChessBoard
+
+from ChessUI.Manager import EngineManager
+from ChessUI.EngineCore import EngineCore
+
+from fake_engine import INIT_FEN, pick_move
+
+FAKE_ENGINE = str(Path(__file__).resolve().parent / 'fake_engine.py')
+
+#---------------------------------------------------------
+def random_positions(count, max_steps, seed):
+    rand = random.Random(seed)
+    fens = {}
+    while len(fens) < count:
+        board = ChessBoard(INIT_FEN)
+        for i in range(rand.randint(1, max_steps)):
+            move = pick_move(board, rand)
+            if not move:
+                break
+            board = board.move_iccs(move).board_done
+        fens[board.to_fen()] = None
+    return list(fens)
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def print_values(title, values, unit = 'ms'):
+    print(f'  {title}: avg {sum(values) / len(values):.2f}  p50 {percentile(values, 0.5):.2f}  '
+          f'p99 {percentile(values, 0.99):.2f}  max {max(values):.2f} {unit}')
+
+#---------------------------------------------------------
+#启动界面使用的EngineManager，等到引擎就绪后设置选项
+def start_manager(options, engine_type):
+    manager = EngineManager(None, 1)
+    if not manager.loadEngine(FAKE_ENGINE, engine_type):
+        raise Exception(f'加载引擎出错：{FAKE_ENGINE}')
+
+    loop = QEventLoop()
+    manager.readySignal.connect(lambda engine_id, name, engine_options: loop.quit())
+    manager.start()
+    loop.exec()
+
+    for name, value in options.items():
+        manager.setOption(name, value)
+    return manager
+
+def stop_manager(manager):
+    manager.quit()
+    manager.thread.wait()
+
+#依次分析各局面，每个局面收到结果后再发下一个，on_info在收到分析信息时调用
+def run_positions(manager, fens, params, on_info = None):
+    loop = QEventLoop()
+    results = []
+    state = {'index': 0, 'go_time': 0, 'sent_time': 0, 'infos': 0}
+
+    def go_next():
+        if state['index'] >= len(fens):
+            loop.quit()
+            return
+        fen = fens[state['index']]
+        state['infos'] = 0
+        state['go_time'] = time.perf_counter()
+        manager.goFrom(fen, fen, params)
+        #goFrom中会先停止上一次分析，go命令在返回前才发给引擎
+        state['sent_time'] = time.perf_counter()
+
+    def on_done(engine_id, ret):
+        now = time.perf_counter()
+        if ret.get('fen') != fens[state['index']]:
+            return
+        bestmove_time = ret.get('bestmove_time')
+        results.append({
+            'signal_ms': (now - bestmove_time) * 1000 if bestmove_time else None,
+            'go_ms': (now - state['go_time']) * 1000,
+            'goFrom_ms': (state['sent_time'] - state['go_time']) * 1000,
+            'think_ms': (now - state['sent_time']) * 1000,
+            'infos': state['infos'],
+        })
+        state['index'] += 1
+        QTimer.singleShot(0, go_next)
+
+    def on_move_info(engine_id, info):
+        state['infos'] += 1
+        if on_info:
+            on_info(info)
+
+    manager.moveBestSignal.connect(on_done)
+    manager.checkmateSignal.connect(on_done)
+    manager.moveInfoSignal.connect(on_move_info)
+    QTimer.singleShot(0, go_next)
+    loop.exec()
+    manager.moveBestSignal.disconnect(on_done)
+    manager.checkmateSignal.disconnect(on_done)
+    manager.moveInfoSignal.disconnect(on_move_info)
+
+    return results
+
+#---------------------------------------------------------
+def bench_latency(args, fens):
+    print(f'latency: {len(fens)}个局面, FakeDelay {args.delay}ms')
+    manager = start_manager({'FakeDelay': args.delay, 'FakeDepth': 8}, args.type)
+    results = run_positions(manager, fens, {'depth': 8})
+    stop_manager(manager)
+
+    print_values('bestmove→moveBestSignal', [x['signal_ms'] for x in results if x['signal_ms'] is not None])
+    print_values('goFrom调用(停止上一次分析)', [x['goFrom_ms'] for x in results])
+    print_values('go命令→moveBestSignal', [x['think_ms'] for x in results])
+    print_values('goFrom→moveBestSignal', [x['go_ms'] for x in results])
+
+def bench_throughput(args, fens):
+    fens = fens[:max(1, len(fens) // 10)]
+    depth, per_depth, multipv = 20, args.info_per_depth, 3
+    lines = depth * per_depth * multipv
+    options = {'FakeDelay': 0, 'FakeDepth': depth, 'FakeInfoPerDepth': per_depth, 'MultiPV': multipv}
+    print(f'throughput: {len(fens)}个局面, 每个局面 {lines} 行info')
+
+    manager = start_manager(options, args.type)
+    results = run_positions(manager, fens, {'depth': depth})
+    stop_manager(manager)
+
+    seconds = sum(x['think_ms'] for x in results) / 1000
+    signals = sum(x['infos'] for x in results)
+    print(f'  EngineManager: {lines * len(results) / seconds:.0f} 行/秒，'
+          f'界面信号 {signals / len(results):.1f} 个/局面 (合并前 {lines} 行)')
+
+    engine = EngineCore(1)
+    if not engine.loadEngine(FAKE_ENGINE, args.type):
+        raise Exception(f'加载引擎出错：{FAKE_ENGINE}')
+    for name, value in options.items():
+        engine.setOption(name, value)
+    start = time.perf_counter()
+    for fen in fens:
+        engine.analyse(fen, {'depth': depth})
+    seconds = time.perf_counter() - start
+    engine.quit()
+    print(f'  EngineCore: {lines * len(fens) / seconds:.0f} 行/秒')
+
+#EngineWidget需要的主窗口配置
+class BenchWindow(QMainWindow):
+    def __init__(self, engine_type):
+        super().__init__()
+        self.config = {'MainEngine': {'engine_exec': FAKE_ENGINE, 'engine_type': engine_type}}
+
+def bench_ui(args, fens):
+    from ChessUI.Widgets import EngineWidget
+
+    multipv = 3
+    print(f'ui: {len(fens)}个局面, MultiPV {multipv}, PV长度 {args.pv_length}')
+    manager = start_manager({'FakeDelay': args.delay, 'FakeDepth': 20, 'FakePVLength': args.pv_length, 'MultiPV': multipv}, args.type)
+
+    window = BenchWindow(args.type)
+    widget = EngineWidget(window, manager)
+    widget.analysisBox.setChecked(True)
+    window.addDockWidget(Qt.RightDockWidgetArea, widget)
+    window.show()
+
+    costs = []
+    last = {'fen': None}
+    def on_info(info):
+        start = time.perf_counter()
+        #换局面时清空分析列表，和界面中的用法一样
+        if info['fen'] != last['fen']:
+            last['fen'] = info['fen']
+            widget.clear()
+        widget.onEngineMoveInfo(info)
+        QApplication.processEvents()
+        costs.append((time.perf_counter() - start) * 1000)
+
+    results = run_positions(manager, fens, {'depth': 20}, on_info)
+    stop_manager(manager)
+
+    print_values('onEngineMoveInfo+重绘', costs)
+    total = sum(x['think_ms'] for x in results)
+    print(f'  界面更新占用 {sum(costs) / total * 100:.1f}% 的分析时间')
+
+BENCHES = {
+    'latency': bench_latency,
+    'throughput': bench_throughput,
+    'ui': bench_ui,
+}
+
+#---------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = '引擎管线的性能测试')
+    parser.add_argument('benches', nargs = '*', help = f"要运行的测试：{' '.join(BENCHES)}，不指定时全部运行")
+    parser.add_argument('-t', '--type', default = 'uci', choices = ['uci', 'ucci'], help = '替身引擎使用的协议')
+    parser.add_argument('-n', '--positions', type = int, default = 100, help = '测试局面数')
+    parser.add_argument('--delay', type = int, default = 20, help = '替身引擎每个局面的分析时间(毫秒)')
+    parser.add_argument('--info-per-depth', type = int, default = 100, help = 'throughput测试时每个深度输出的info次数')
+    parser.add_argument('--pv-length', type = int, default = 12, help = 'ui测试时PV的步数')
+    parser.add_argument('--seed', type = int, default = 1)
+    args = parser.parse_args()
+    for name in args.benches:
+        if name not in BENCHES:
+            parser.error(f"未知的测试：{name}，可选：{' '.join(BENCHES)}")
+    benches = args.benches or list(BENCHES)
+
+    app = QApplication(sys.argv)
+    fens = random_positions(args.positions, 40, args.seed)
+    for name in benches:
+        BENCHES[name](args, fens)
+
+    #PySide6跨线程发送dict参数的信号后，解释器退出回收对象时可能崩溃，结果已经输出，直接退出
+    sys.stdout.flush()
+    os._exit(0)
@@ -2,12 +2,16 @@
 import os 
 import sys
 import time
-import traceback
 from pathlib import Path
 from collections import OrderedDict
 import requests
 
 import cchess
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from ChessUI.Utils import CLOUD_DB_URL
+from ChessUI.CloudParser import parseQueryAll
+
 #from tinydb import TinyDB, Query
 
 #from peewee import *
@@ -81,7 +85,7 @@ class EngineManager():
 
 #-----------------------------------------------------#
 def QueryFromCloudDB(fen, score_limit = 0):
-    url = 'http://www.chessdb.cn/chessdb.php'
+    url = CLOUD_DB_URL
     param = {"action": 'queryall'}
     param['board'] = fen
     
@@ -107,26 +111,5 @@ def QueryFromCloudDB(fen, score_limit = 0):
     if resp.status_code != 200:
         print(resp.text)
         return {}
-    text = resp.text.rstrip('\0')
-    if text.lower() in ['', 'unknown']:
-        return {}
-
-    board = cchess.ChessBoard(fen)
-    move_color = board.get_move_color()    
-    moves = {}
-    
-    #数据分割
-    try:
-        steps = text.split('|')
-        for it in steps:
-            segs = it.strip().split(',')
-            items =[x.split(':') for x in segs]
-            it = {key:value for key, value in items}
-            #print(it_dict)
-            moves[it['move']] = {'score': int(it['score'])}
-    except Exception as e:
-        #traceback.print_exc()
-        traceback.print_exception(*sys.exc_info())
-        print('cloud query result:', text, "len:", len(text))
-    
-    return  moves        
+    #分数为走子方得分
+    return {m.move: {'score': m.score} for m in parseQueryAll(resp.text)}
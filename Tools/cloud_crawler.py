@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+#云库开局库爬取
+#   并发：asyncio + requests线程池，--concurrency 同时进行的查询数，--rate 每秒最多发出的查询数
+#   待查局面(frontier)保存在库中的frontier表，按规范键值(局面与镜像局面zhash的较小者)去重
+#   结果每隔 --commit-interval 秒在一个事务中写入，中断后重新运行即可接着爬，最多丢失几秒的结果
+#   剪枝规则可替换：--rule 规则名 或 --rule 模块名:函数名，规则函数为 rule(fen, step, moves) -> 保留的moves
+#       moves 为 ChessUI.CloudParser.CloudMove 列表，分数为走子方得分，按分数从高到低排列
+#
+#结果保存在 PosMove 表中(与 make_db_from_cloud_db.py 生成的 openbook.db 格式相同)
+
+import sys
+import time
+import asyncio
+import argparse
+import importlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cchess import ChessBoard, FULL_INIT_FEN
+
+from peewee import *
+from playhouse.sqlite_ext import *
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ChessUI.Utils import CLOUD_DB_URL
+from ChessUI.LocalDB import getBoardKey
+from ChessUI.CloudParser import parseQueryAll
+
+#---------------------------------------------------------
+book_db = Proxy()
+
+class PosMove(Model):
+    fen = CharField(unique=True, index=True)
+    vkey = BigIntegerField(unique=True)
+    step  = IntegerField()
+    score = IntegerField()
+    mark  = CharField(null=True)
+    vmoves = JSONField()
+
+    class Meta:
+        database = book_db
+
+#待查局面，state：
+FRONTIER_TODO = 0
+FRONTIER_DONE = 1
+FRONTIER_EMPTY = 2      #云库中没有或剪枝后没有着法
+FRONTIER_FAILED = 3     #多次查询失败
+
+class Frontier(Model):
+    key = BigIntegerField(unique=True)
+    fen = CharField()
+    step = IntegerField(index=True)
+    state = IntegerField(default=FRONTIER_TODO, index=True)
+
+    class Meta:
+        database = book_db
+        table_name = 'frontier'
+
+def open_db(db_file):
+    db = SqliteExtDatabase(db_file, pragmas=(
+        ('cache_size', -1024 * 64),
+        ('journal_mode', 'wal'),
+        ('synchronous', 1)))
+    book_db.initialize(db)
+    book_db.create_tables([PosMove, Frontier], safe = True)
+    return db
+
+#---------------------------------------------------------
+#剪枝规则
+def rule_clean_moves(fen, step, moves):
+    score_best = moves[0].score
+    ret = []
+    for i, m in enumerate(moves):
+        diff = abs(m.score - score_best)
+
+        if step == 1:
+            if m.score < 0:
+                continue
+        elif step >= 2 and (m.score < -65):
+            continue
+        elif i > 3 and score_best < 0:
+            continue
+        elif i > 3 and diff > 50:
+            continue
+        elif i >= 7 and diff > 30:
+            continue
+        elif step > 6 and diff > 50:
+            continue
+        elif score_best < 0 and diff > 30:
+            continue
+        elif score_best > 10 and m.score < -score_best:
+            continue
+        elif diff > 60:
+            continue
+
+        ret.append(m)
+    return ret
+
+#保留与最好着法分差不超过diff的前top个着法
+def make_rule_top(top, diff):
+    def rule_top(fen, step, moves):
+        score_best = moves[0].score
+        return [m for m in moves[:top] if score_best - m.score <= diff]
+    return rule_top
+
+def rule_all(fen, step, moves):
+    return moves
+
+def load_rule(name, args):
+    if name == 'clean_moves':
+        return rule_clean_moves
+    if name == 'top':
+        return make_rule_top(args.top, args.diff)
+    if name == 'all':
+        return rule_all
+    if ':' in name:
+        module_name, func_name = name.split(':', 1)
+        return getattr(importlib.import_module(module_name), func_name)
+    raise Exception(f'未知的剪枝规则：{name}')
+
+#---------------------------------------------------------
+#令牌桶限速
+class RateLimiter():
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = max(rate, 1.0)
+        self.last = time.monotonic()
+
+    async def wait(self):
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return
+            await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+#---------------------------------------------------------
+class CloudCrawler():
+    def __init__(self, rule, url = CLOUD_DB_URL, concurrency = 8, rate = 5.0, max_step = 20,
+                    commit_interval = 2.0, max_try = 5):
+        self.rule = rule
+        self.url = url
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.max_step = max_step
+        self.commit_interval = commit_interval
+        self.max_try = max_try
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPoolExecutor(max_workers = concurrency)
+
+        #从库中取出还没分给查询协程的局面
+        self.queue = []
+        #正在查询和查询完还没写入库的局面
+        self.taken = set()
+        self.results = []
+        self.last_commit = time.monotonic()
+
+        self.stats = {'queries': 0, 'done': 0, 'empty': 0, 'failed': 0, 'retries': 0, 'new_positions': 0}
+        self.start_time = time.monotonic()
+
+    def seed(self, fen = FULL_INIT_FEN, step = 1):
+        key, _ = getBoardKey(ChessBoard(fen))
+        Frontier.insert(key = key, fen = fen, step = step).on_conflict_ignore().execute()
+
+    def seed_many(self, fens, step):
+        rows = {}
+        for fen in fens:
+            key, _ = getBoardKey(ChessBoard(fen))
+            rows[key] = {'key': key, 'fen': fen, 'step': step}
+        with book_db.atomic():
+            for batch in chunked(list(rows.values()), 500):
+                Frontier.insert_many(batch).on_conflict_ignore().execute()
+
+    #-----------------------------------------------------
+    def query(self, fen):
+        resp = self.session.get(self.url, params = {'action': 'queryall', 'board': fen}, timeout = 10)
+        resp.raise_for_status()
+        return resp.text
+
+    async def fetch(self, fen):
+        loop = asyncio.get_running_loop()
+        for try_count in range(self.max_try):
+            await self.limiter.wait()
+            self.stats['queries'] += 1
+            try:
+                text = await loop.run_in_executor(self.pool, self.query, fen)
+                return parseQueryAll(text)
+            except Exception as e:
+                self.stats['retries'] += 1
+                print(f'查询失败({try_count + 1})：{fen} {e}')
+                await asyncio.sleep(2 ** try_count)
+        return None
+
+    #-----------------------------------------------------
+    def load_batch(self):
+        #新加入的局面在写入后才能查到，先把已完成的结果写入
+        self.commit()
+
+        rows = (Frontier.select(Frontier.key, Frontier.fen, Frontier.step)
+                    .where((Frontier.state == FRONTIER_TODO) & (Frontier.step <= self.max_step))
+                    .order_by(Frontier.step, Frontier.id)
+                    .limit(self.concurrency * 8 + len(self.taken))
+                    .tuples())
+        rows = [x for x in rows if x[0] not in self.taken]
+
+        #库中已有的局面(比如以前的版本爬过的)直接标记为已完成
+        fens = [x[1] for x in rows]
+        exists = set()
+        for batch in chunked(fens, 500):
+            exists.update(x[0] for x in PosMove.select(PosMove.fen).where(PosMove.fen.in_(batch)).tuples())
+        if exists:
+            Frontier.update(state = FRONTIER_DONE).where(Frontier.fen.in_(list(exists))).execute()
+
+        self.queue = [x for x in rows if x[1] not in exists]
+        self.queue.reverse()
+
+    async def next_item(self):
+        while True:
+            if not self.queue:
+                self.load_batch()
+            if self.queue:
+                item = self.queue.pop()
+                self.taken.add(item[0])
+                return item
+            #库中没有待查局面，等正在查询的局面返回新的子局面
+            if not self.taken:
+                return None
+            await asyncio.sleep(0.2)
+
+    async def worker(self):
+        while True:
+            item = await self.next_item()
+            if item is None:
+                return
+            key, fen, step = item
+            moves = await self.fetch(fen)
+            self.results.append((key, fen, step, moves))
+            if time.monotonic() - self.last_commit >= self.commit_interval:
+                self.commit()
+
+    #-----------------------------------------------------
+    #一个事务写入：局面的着法，frontier的状态，剪枝后保留着法的子局面
+    def commit(self):
+        self.last_commit = time.monotonic()
+        if not self.results:
+            return
+
+        results = self.results
+        self.results = []
+
+        with book_db.atomic():
+            for key, fen, step, moves in results:
+                self.save_result(key, fen, step, moves)
+
+        for key, fen, step, moves in results:
+            self.taken.discard(key)
+
+        self.print_stats()
+
+    def save_result(self, key, fen, step, moves):
+        if moves is None:
+            self.stats['failed'] += 1
+            Frontier.update(state = FRONTIER_FAILED).where(Frontier.key == key).execute()
+            return
+
+        kept = self.rule(fen, step, moves) if moves else []
+        if not kept:
+            self.stats['empty'] += 1
+            Frontier.update(state = FRONTIER_EMPTY).where(Frontier.key == key).execute()
+            return
+
+        self.stats['done'] += 1
+        PosMove.insert(fen = fen, vkey = key, step = step, score = moves[0].score,
+                vmoves = {m.move: m.score for m in kept}).on_conflict_ignore().execute()
+        Frontier.update(state = FRONTIER_DONE).where(Frontier.key == key).execute()
+
+        board = ChessBoard(fen)
+        children = {}
+        for m in kept:
+            move_it = board.copy().move_iccs(m.move)
+            if move_it is None:
+                continue
+            new_board = move_it.board_done
+            new_key, _ = getBoardKey(new_board)
+            children[new_key] = {'key': new_key, 'fen': new_board.to_fen(), 'step': step + 1}
+        if children:
+            cursor = book_db.execute(Frontier.insert_many(list(children.values())).on_conflict_ignore())
+            self.stats['new_positions'] += cursor.rowcount
+
+    def print_stats(self):
+        used = time.monotonic() - self.start_time
+        qps = self.stats['queries'] / max(used, 0.1)
+        print(f"{int(used)}s 完成:{self.stats['done']} 无着法:{self.stats['empty']} 失败:{self.stats['failed']} "
+              f"重试:{self.stats['retries']} 新局面:{self.stats['new_positions']} {qps:.1f}次/秒")
+
+    #-----------------------------------------------------
+    async def run(self):
+        workers = [asyncio.create_task(self.worker()) for i in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            self.commit()
+            self.pool.shutdown(wait = False)
+
+        todo = Frontier.select().where((Frontier.state == FRONTIER_TODO) & (Frontier.step <= self.max_step)).count()
+        print(f'爬取结束，剩余待查局面：{todo}')
+        return self.stats
+
+#---------------------------------------------------------
+def make_parser():
+    parser = argparse.ArgumentParser(description = '云库开局库爬取')
+    parser.add_argument('db_file', nargs = '?', default = 'openbook.db')
+    parser.add_argument('--url', default = CLOUD_DB_URL)
+    parser.add_argument('--fen', default = FULL_INIT_FEN, help = '起始局面')
+    parser.add_argument('--concurrency', type = int, default = 8)
+    parser.add_argument('--rate', type = float, default = 5.0, help = '每秒最多查询次数，0为不限')
+    parser.add_argument('--max-step', type = int, default = 20, help = '最多爬到第几步')
+    parser.add_argument('--commit-interval', type = float, default = 2.0, help = '写入间隔(秒)')
+    parser.add_argument('--rule', default = 'clean_moves', help = 'clean_moves, top, all 或 模块名:函数名')
+    parser.add_argument('--top', type = int, default = 5, help = 'top规则保留的着法数')
+    parser.add_argument('--diff', type = int, default = 30, help = 'top规则保留的最大分差')
+    parser.add_argument('--retry-failed', action = 'store_true', help = '重新查询以前失败的局面')
+    return parser
+
+def main(args):
+    open_db(args.db_file)
+
+    if args.retry_failed:
+        Frontier.update(state = FRONTIER_TODO).where(Frontier.state == FRONTIER_FAILED).execute()
+
+    crawler = CloudCrawler(load_rule(args.rule, args), args.url, args.concurrency, args.rate,
+                    args.max_step, args.commit_interval)
+    crawler.seed(args.fen)
+
+    try:
+        asyncio.run(crawler.run())
+    except KeyboardInterrupt:
+        print('中断，已完成的结果已写入，重新运行可继续')
+
+#---------------------------------------------------------
+if __name__ == "__main__":
+    main(make_parser().parse_args())
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#本地云库替身服务器，支持 chessdb.php?action=queryall&board=fen 查询，用于离线测试和压测
+#数据来源：
+#   --archive file.db   录制的云库应答(sqlite)，可以和 --upstream 一起使用，查不到时转发到真正的云库并录下来
+#   --book file         本地开局库(evb/yfk/pfbook/edb/localbook.db)，按库里的着法生成应答
+#故障注入：
+#   --latency ms --jitter ms   每个应答的延迟
+#   --error-rate x             按比例返回 HTTP 500
+#   --unknown-rate x           按比例返回 unknown
+#统计：GET /stats
+#
+#客户端用环境变量 CHESSDB_URL=http://127.0.0.1:8100/chessdb.php 或 Evolution.ini 的 [CloudDB] url 指向本服务器
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from pathlib import Path
+
+import requests
+import tornado.web
+
+from peewee import *
+from playhouse.sqlite_ext import *
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ChessUI.LocalDB import LocalBook, OpenBookYfk, OpenBookPF, OpenBookBin, MasterBook
+
+#---------------------------------------------------------
+archive_db = Proxy()
+
+class CloudRecord(Model):
+    fen = CharField(unique=True, index=True)
+    resp = TextField()
+    updated = IntegerField(default=0)
+
+    class Meta:
+        database = archive_db
+        table_name = 'cloud_record'
+
+#---------------------------------------------------------
+BOOK_TYPES = {
+    '.evb': OpenBookBin,
+    '.yfk': OpenBookYfk,
+    '.pfbook': OpenBookPF,
+    '.edb': MasterBook,
+    '.db': LocalBook,
+}
+
+def open_book(file_name):
+    book = BOOK_TYPES[Path(file_name).suffix.lower()]()
+    book.open(file_name)
+    return book
+
+#云库的分数是走子方得分，按分数从高到低排列
+def book_to_resp(ret):
+    if not ret or not ret['actions']:
+        return None
+    acts = sorted(ret['actions'].values(), key = lambda x: x.get('score') or 0, reverse = True)
+    items = []
+    for rank, act in enumerate(acts):
+        items.append(f"move:{act['iccs']},score:{act.get('score') or 0},rank:{rank},note:? (book),winrate:50.00")
+    return '|'.join(items)
+
+#---------------------------------------------------------
+class StubBackend():
+    def __init__(self, args):
+        self.args = args
+        self.book = open_book(args.book) if args.book else None
+        self.stats = {'queries': 0, 'archive_hits': 0, 'book_hits': 0, 'upstream': 0,
+                      'unknown': 0, 'errors': 0, 'started': time.time()}
+
+        if args.archive:
+            db = SqliteExtDatabase(args.archive, pragmas=(('journal_mode', 'wal'),))
+            archive_db.initialize(db)
+            archive_db.create_tables([CloudRecord], safe = True)
+
+    def query_archive(self, fen):
+        if not self.args.archive:
+            return None
+        rec = CloudRecord.get_or_none(CloudRecord.fen == fen)
+        return rec.resp if rec else None
+
+    def save_archive(self, fen, resp):
+        if not self.args.archive:
+            return
+        CloudRecord.insert(fen = fen, resp = resp, updated = int(time.time()))\
+                    .on_conflict_replace().execute()
+
+    def query_upstream(self, fen):
+        resp = requests.get(self.args.upstream, params = {'action': 'queryall', 'board': fen}, timeout = 10)
+        return resp.text.rstrip('\0')
+
+    async def query(self, fen):
+        self.stats['queries'] += 1
+
+        resp = self.query_archive(fen)
+        if resp is not None:
+            self.stats['archive_hits'] += 1
+            return resp
+
+        if self.book:
+            resp = book_to_resp(self.book.getMoves(fen))
+            if resp is not None:
+                self.stats['book_hits'] += 1
+                return resp
+
+        if self.args.upstream:
+            loop = asyncio.get_running_loop()
+            resp = await loop.run_in_executor(None, self.query_upstream, fen)
+            self.stats['upstream'] += 1
+            self.save_archive(fen, resp)
+            return resp
+
+        return 'unknown'
+
+#---------------------------------------------------------
+class QueryHandler(tornado.web.RequestHandler):
+    def initialize(self, backend):
+        self.backend = backend
+
+    async def get(self):
+        args = self.backend.args
+
+        delay = args.latency + random.uniform(-args.jitter, args.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        if random.random() < args.error_rate:
+            self.backend.stats['errors'] += 1
+            self.set_status(500)
+            self.finish('error')
+            return
+
+        action = self.get_argument('action', '')
+        fen = self.get_argument('board', '')
+        if (action != 'queryall') or (not fen):
+            self.finish('invalid board')
+            return
+
+        if random.random() < args.unknown_rate:
+            resp = 'unknown'
+        else:
+            resp = await self.backend.query(fen)
+
+        if resp.lower() in ['', 'unknown']:
+            self.backend.stats['unknown'] += 1
+
+        #云库的应答以\0结尾
+        self.finish(resp + '\0')
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, backend):
+        self.backend = backend
+
+    def get(self):
+        stats = dict(self.backend.stats)
+        stats['seconds'] = round(time.time() - stats.pop('started'), 1)
+        stats['qps'] = round(stats['queries'] / max(stats['seconds'], 0.1), 1)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(stats))
+
+def make_app(backend):
+    return tornado.web.Application([
+        (r"/chessdb.php", QueryHandler, {'backend': backend}),
+        (r"/stats", StatsHandler, {'backend': backend}),
+    ])
+
+#---------------------------------------------------------
+async def main(args):
+    backend = StubBackend(args)
+    app = make_app(backend)
+    app.listen(args.port, args.host)
+    print(f'云库替身服务器：http://{args.host}:{args.port}/chessdb.php')
+    await asyncio.Event().wait()
+
+#---------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = '本地云库替身服务器')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8100)
+    parser.add_argument('--archive', help = '录制的应答库(sqlite)')
+    parser.add_argument('--upstream', help = '查不到时转发的云库地址，例如 http://www.chessdb.cn/chessdb.php')
+    parser.add_argument('--book', help = '本地开局库文件')
+    parser.add_argument('--latency', type = float, default = 0, help = '应答延迟(毫秒)')
+    parser.add_argument('--jitter', type = float, default = 0, help = '延迟的随机波动(毫秒)')
+    parser.add_argument('--error-rate', type = float, default = 0, help = '返回HTTP 500的比例')
+    parser.add_argument('--unknown-rate', type = float, default = 0, help = '返回unknown的比例')
+    args = parser.parse_args()
+
+    if args.upstream and not args.archive:
+        print('使用 --upstream 录制时需要同时指定 --archive')
+        sys.exit(-1)
+
+    asyncio.run(main(args))
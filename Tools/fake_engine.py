@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#测试用的替身引擎，支持uci/ucci协议，在没有真正引擎的环境(如Linux)下做压测、性能测试和回归测试
+#着法、分数和PV由局面决定(同一局面同样的设置总是同样的输出)，只走合法着法，没有着法时输出 nobestmove
+#
+#行为用 setoption 设置，启动时的默认值取环境变量 FAKE_ENGINE_<名字大写>，如 FAKE_ENGINE_FAKEDELAY=50：
+#   FakeDelay         go之后到输出bestmove的毫秒数(go movetime时用movetime)，默认20
+#   FakeDepth         go没有指定深度时的搜索深度，默认10
+#   FakeInfoRate      每秒输出的info行数，0为把所有info行平均分布在FakeDelay内，默认0
+#   FakeInfoPerDepth  每个深度重复输出info的次数(模拟引擎同一深度的多次更新)，默认1
+#   FakePVLength      PV的步数，默认8
+#   FakeMate          不为0时最好的分支输出 N步杀(负数为被杀)，默认0
+#   FakeSeed          改变着法和分数的选择，默认0
+#   MultiPV           分支数，默认1
+#go infinite 一直输出到收到 stop，stop 后立即输出 bestmove
+
+import os
+import sys
+import time
+import random
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from cchess import ChessBoard, pos2iccs
+
+INIT_FEN = 'rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR w'
+
+#(名字, 默认值, 最小值, 最大值)
+OPTIONS = [
+    ('FakeDelay', 20, 0, 1000000),
+    ('FakeDepth', 10, 1, 99),
+    ('FakeInfoRate', 0, 0, 1000000),
+    ('FakeInfoPerDepth', 1, 1, 10000),
+    ('FakePVLength', 8, 1, 100),
+    ('FakeMate', 0, -100, 100),
+    ('FakeSeed', 0, 0, 1000000),
+    ('MultiPV', 1, 1, 100),
+]
+
+#---------------------------------------------------------
+def legal_moves(board):
+    moves = []
+    for move_from, move_to in board.create_moves():
+        if not board.is_checked_move(move_from, move_to):
+            moves.append(pos2iccs(move_from, move_to))
+    return moves
+
+#随机取一个合法着法，不必先生成全部合法着法
+def pick_move(board, rand):
+    moves = list(board.create_moves())
+    rand.shuffle(moves)
+    for move_from, move_to in moves:
+        if not board.is_checked_move(move_from, move_to):
+            return pos2iccs(move_from, move_to)
+    return None
+
+def position_board(args):
+    #position fen xxx moves a0a1 ... / position startpos moves ...
+    fen_part, _, moves_part = ' '.join(args).partition(' moves ')
+    fen_part = fen_part.strip()
+    if fen_part.startswith('fen '):
+        board = ChessBoard(fen_part[4:])
+    else:
+        board = ChessBoard(INIT_FEN)
+    for iccs in moves_part.split():
+        move_it = board.move_iccs(iccs)
+        if not move_it:
+            break
+        board = move_it.board_done
+    return board
+
+def parse_go(args):
+    params = {'infinite': 'infinite' in args}
+    for key, value in zip(args, args[1:]):
+        if value.isdigit():
+            params[key] = int(value)
+    return params
+
+#---------------------------------------------------------
+class FakeEngine():
+    def __init__(self):
+        self.protocol = 'uci'
+        self.board = ChessBoard(INIT_FEN)
+        self.options = {}
+        for name, default, min_value, max_value in OPTIONS:
+            self.options[name] = int(os.environ.get(f'FAKE_ENGINE_{name.upper()}', default))
+
+        self.out_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.search = None
+        #fen -> 各分支的PV
+        self.pv_cache = {}
+
+    def send(self, line):
+        with self.out_lock:
+            sys.stdout.write(line + '\n')
+            sys.stdout.flush()
+
+    def on_init(self, protocol):
+        self.protocol = protocol
+        self.send('id name FakeEngine')
+        self.send('id author Evolution')
+        for name, default, min_value, max_value in OPTIONS:
+            self.send(f'option name {name} type spin default {default} min {min_value} max {max_value}')
+        self.send(f'{protocol}ok')
+
+    def on_setoption(self, args):
+        #uci: setoption name xxx value yyy，ucci: setoption xxx yyy
+        if args and args[0] == 'name':
+            args = args[1:]
+        if len(args) < 2:
+            return
+        name, value = args[0], args[-1]
+        if name in self.options and value.lstrip('-').isdigit():
+            self.options[name] = int(value)
+
+    #-----------------------------------------------------#
+    #候选着法按固定的顺序排列，每个分支从候选着法开始按局面固定地走FakePVLength步
+    def make_pv_lines(self):
+        fen = self.board.to_fen()
+        key = (fen, self.options['MultiPV'], self.options['FakePVLength'], self.options['FakeSeed'])
+        if key in self.pv_cache:
+            return self.pv_cache[key]
+
+        seed = self.board.zhash() + self.options['FakeSeed']
+        moves = legal_moves(self.board)
+        random.Random(seed).shuffle(moves)
+
+        lines = []
+        for iccs in moves[:max(1, self.options['MultiPV'])]:
+            rand = random.Random(f'{seed}{iccs}')
+            pv = [iccs]
+            board = self.board.copy().move_iccs(iccs).board_done
+            while len(pv) < self.options['FakePVLength']:
+                move = pick_move(board, rand)
+                if not move:
+                    break
+                pv.append(move)
+                board = board.move_iccs(move).board_done
+            lines.append(pv)
+
+        if len(self.pv_cache) > 10000:
+            self.pv_cache = {}
+        self.pv_cache[key] = lines
+        return lines
+
+    def score_text(self, index, depth):
+        mate = self.options['FakeMate']
+        if mate and (index == 0):
+            if self.protocol == 'uci':
+                return f'score mate {mate}'
+            #ucci没有mate，用接近杀棋的分数表示
+            return f'score {(30000 - abs(mate)) * (1 if mate > 0 else -1)}'
+
+        #分数在[-200, 200]之间，随深度小幅波动
+        score = (self.board.zhash() + self.options['FakeSeed']) % 401 - 200 - index * 15 + depth % 3
+        if self.protocol == 'uci':
+            return f'score cp {score}'
+        return f'score {score}'
+
+    def info_line(self, index, depth, pv, elapsed):
+        nodes = depth * 1000 * (index + 1)
+        if self.protocol == 'uci':
+            ms = max(1, int(elapsed * 1000))
+            return (f'info depth {depth} seldepth {depth + 2} multipv {index + 1} {self.score_text(index, depth)} '
+                    f'nodes {nodes} nps {nodes * 1000 // ms} time {ms} pv {" ".join(pv)}')
+        return f'info depth {depth} {self.score_text(index, depth)} pv {" ".join(pv)}'
+
+    def run_search(self, params):
+        start = time.perf_counter()
+        lines = self.make_pv_lines()
+        if not lines:
+            self.send('nobestmove')
+            return
+
+        infinite = params['infinite']
+        depth_max = 99 if infinite else params.get('depth', self.options['FakeDepth'])
+        delay = params.get('movetime', self.options['FakeDelay']) / 1000
+        per_depth = max(1, self.options['FakeInfoPerDepth'])
+
+        if self.options['FakeInfoRate'] > 0:
+            interval = 1 / self.options['FakeInfoRate']
+        else:
+            interval = delay / (max(1, min(depth_max, self.options['FakeDepth'])) * per_depth * len(lines))
+
+        count = 0
+        for depth in range(1, depth_max + 1):
+            for i in range(per_depth):
+                for index, pv in enumerate(lines):
+                    if self.stop_event.is_set():
+                        break
+                    #按输出速度控制，不累积误差
+                    wait = start + count * interval - time.perf_counter()
+                    if (wait > 0) and self.stop_event.wait(wait):
+                        break
+                    self.send(self.info_line(index, depth, pv[:depth], time.perf_counter() - start))
+                    count += 1
+
+        if infinite:
+            self.stop_event.wait()
+        else:
+            wait = start + delay - time.perf_counter()
+            if wait > 0:
+                self.stop_event.wait(wait)
+
+        self.send(f'bestmove {lines[0][0]}')
+
+    def on_go(self, args):
+        self.on_stop()
+        self.stop_event.clear()
+        self.search = threading.Thread(target = self.run_search, args = (parse_go(args),), daemon = True)
+        self.search.start()
+
+    def on_stop(self):
+        if self.search:
+            self.stop_event.set()
+            self.search.join()
+            self.search = None
+
+    def run(self):
+        for line in sys.stdin:
+            items = line.split()
+            if not items:
+                continue
+            cmd, args = items[0], items[1:]
+            if cmd in ['uci', 'ucci']:
+                self.on_init(cmd)
+            elif cmd == 'isready':
+                self.send('readyok')
+            elif cmd == 'setoption':
+                self.on_setoption(args)
+            elif cmd == 'position':
+                self.on_stop()
+                self.board = position_board(args)
+            elif cmd == 'go':
+                self.on_go(args)
+            elif cmd == 'stop':
+                self.on_stop()
+            elif cmd == 'quit':
+                break
+        self.on_stop()
+
+#---------------------------------------------------------
+if __name__ == "__main__":
+    FakeEngine().run()
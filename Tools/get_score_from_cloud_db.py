@@ -7,6 +7,10 @@ import requests
 
 from cchess import *
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from ChessUI.Utils import CLOUD_DB_URL
+from ChessUI.CloudParser import parseQueryAll
+
 from peewee import *
 from playhouse.sqlite_ext import *
 
@@ -28,9 +32,8 @@ class PosMove(Model):
         database = book_db
 
 #-----------------------------------------------------#
-
 def QueryFromCloudDB(fen):
-    url = 'http://www.chessdb.cn/chessdb.php'
+    url = CLOUD_DB_URL
     param = {"action": 'queryall'}
     param['board'] = fen
     
@@ -44,31 +47,9 @@ def QueryFromCloudDB(fen):
     text = resp.text.rstrip('\0')
     if len(text) < 20:
         print(text)
-    if text.lower() in ['', 'unknown']:
-        return []
-    board = ChessBoard(fen)
-    move_color = board.get_move_color()    
-    moves = []
-    
-    #数据分割
-    try:
-        steps = text.split('|')
-        for it in steps:
-            segs = it.strip().split(',')
-            items =[x.split(':') for x in segs]
-            it_dict = {key:value for key, value in items}
-            #print(it_dict)
-            moves.append(it_dict)
-    except Exception as e:
-        #traceback.print_exc()
-        traceback.print_exception(*sys.exc_info())
-        print('cloud query result:', text, "len:", len(text))
-        return  None
-        
-    for move in moves:
-        move['score'] = int(move['score'])
     
-    return moves
+    #分数为走子方得分，按分数从高到低排列
+    return [m._asdict() for m in parseQueryAll(text)]
     
 #---------------------------------------------------------------------------
 def get_pos_moves(fen):
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#将旧格式的evbook表转换为规范键值格式
+#旧格式：key 为保存时局面的zhash，查询时要分别查局面和镜像局面两次
+#新格式：key 为局面与镜像局面zhash的较小者，mirror 标记iccs是否为规范局面的镜像方向，
+#       并建立 (key, score, iccs, mirror, mark) 索引，每个局面只需一次索引查询
+#
+#旧数据只有zhash没有fen，无法直接算出镜像局面的zhash，所以从初始局面开始沿着库中的着法遍历，
+#遍历不到的记录保留在 evbook_old 表中，转换完成后会打印其数量
+
+import sys
+from pathlib import Path
+from collections import deque
+
+from cchess import ChessBoard, FULL_INIT_FEN, iccs_mirror
+
+from peewee import *
+from playhouse.sqlite_ext import *
+
+#---------------------------------------------------------
+def board_key(board):
+    zhash = board.zhash()
+    zhash_mirror = board.mirror().zhash()
+    if zhash_mirror < zhash:
+        return (zhash, zhash_mirror, zhash_mirror, True)
+    return (zhash, zhash_mirror, zhash, False)
+
+#---------------------------------------------------------
+def load_old_records(db):
+    by_key = {}
+    cursor = db.execute_sql('SELECT id, key, step, score, iccs, mark, memo FROM evbook')
+    for row in cursor.fetchall():
+        by_key.setdefault(row[1], []).append(row)
+    return by_key
+
+def convert_records(by_key, init_fen = FULL_INIT_FEN):
+    new_rows = []
+    done = set()
+    seen = set()
+    todo = deque([init_fen])
+
+    while todo:
+        fen = todo.popleft()
+        board = ChessBoard(fen)
+        zhash, zhash_mirror, key, is_mirror = board_key(board)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        sources = [(zhash, False)]
+        if zhash_mirror != zhash:
+            sources.append((zhash_mirror, True))
+
+        for old_key, from_mirror in sources:
+            for row_id, _, step, score, iccs, mark, memo in by_key.get(old_key, []):
+                if row_id in done:
+                    continue
+                done.add(row_id)
+
+                new_rows.append({
+                    'key': key,
+                    'mirror': (from_mirror != is_mirror),
+                    'step': step,
+                    'score': score,
+                    'iccs': iccs,
+                    'mark': mark,
+                    'memo': memo,
+                })
+
+                iccs_here = iccs_mirror(iccs) if from_mirror else iccs
+                move = board.copy().move_iccs(iccs_here)
+                if move is None:
+                    print(f'非法着法：{fen} {iccs_here}')
+                    continue
+                todo.append(move.board_done.to_fen())
+
+    return (new_rows, done)
+
+#---------------------------------------------------------
+def migrate(db_file):
+    db = SqliteExtDatabase(db_file, pragmas=(
+        ('cache_size', -1024 * 64),
+        ('journal_mode', 'wal')))
+
+    columns = [x.name for x in db.get_columns('evbook')]
+    if 'mirror' in columns:
+        print(f'{db_file} 已经是新格式，不需要转换。')
+        return True
+
+    by_key = load_old_records(db)
+    total = sum(len(x) for x in by_key.values())
+    print(f'读取旧记录 {total} 条')
+
+    new_rows, done = convert_records(by_key)
+
+    with db.atomic():
+        db.execute_sql('ALTER TABLE evbook RENAME TO evbook_old')
+        db.execute_sql('''CREATE TABLE evbook (
+                            id INTEGER NOT NULL PRIMARY KEY,
+                            key INTEGER NOT NULL,
+                            mirror INTEGER NOT NULL DEFAULT 0,
+                            step INTEGER NOT NULL,
+                            score INTEGER,
+                            iccs VARCHAR(255) NOT NULL,
+                            mark VARCHAR(255),
+                            memo JSON)''')
+        for i in range(0, len(new_rows), 500):
+            batch = new_rows[i: i + 500]
+            db.execute_sql('INSERT INTO evbook (key, mirror, step, score, iccs, mark, memo) VALUES ' +
+                            ','.join(['(?, ?, ?, ?, ?, ?, ?)'] * len(batch)),
+                            [v for it in batch for v in (it['key'], it['mirror'], it['step'],
+                                                        it['score'], it['iccs'], it['mark'], it['memo'])])
+        db.execute_sql('CREATE INDEX evbook_key_score_iccs_mirror_mark ON evbook (key, score, iccs, mirror, mark)')
+
+        #遍历到的旧记录删除，剩下的留在evbook_old中备查
+        ids = list(done)
+        for i in range(0, len(ids), 500):
+            batch = ids[i: i + 500]
+            db.execute_sql(f'DELETE FROM evbook_old WHERE id IN ({",".join(["?"] * len(batch))})', batch)
+
+    orphans = total - len(done)
+    print(f'转换完成：{len(new_rows)} 条，未能从初始局面遍历到的记录 {orphans} 条保留在 evbook_old 表中')
+    if orphans == 0:
+        db.execute_sql('DROP TABLE evbook_old')
+
+    db.close()
+    return True
+
+#---------------------------------------------------------
+if __name__ == '__main__':
+
+    if len(sys.argv) != 2:
+        print(f'Usage {sys.argv[0]} evbook_db_file')
+        sys.exit(-1)
+
+    db_file = Path(sys.argv[1])
+    if not db_file.is_file():
+        print(f'文件不存在：{db_file}')
+        sys.exit(-1)
+
+    migrate(db_file)
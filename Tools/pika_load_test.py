@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#引擎分析服务(PikaServer.py)的压测：并发发送 /querybest 请求，统计延迟的p50/p90/p99和每秒请求数
+#局面从 --fens 文件读取(每行一个fen)，或从开局随机走若干步生成；--repeat 为重复局面的比例，用来测试请求合并和结果缓存
+#
+#   python pika_load_test.py --spawn                      启动用替身引擎(fake_engine.py)的服务，压测完后关闭
+#   python pika_load_test.py --url http://127.0.0.1:8000  压测已经运行的服务
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from urllib.parse import urlencode
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+from cchess import ChessBoard
+
+INIT_FEN = 'rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR w'
+TOOLS_PATH = Path(__file__).resolve().parent
+
+#---------------------------------------------------------
+def random_positions(count, max_steps, seed):
+    rand = random.Random(seed)
+    fens = {}
+    while len(fens) < count:
+        board = ChessBoard(INIT_FEN)
+        for i in range(rand.randint(1, max_steps)):
+            #随机取走后不被将军的着法，不必先生成全部合法着法
+            moves = list(board.create_moves())
+            rand.shuffle(moves)
+            move = next((x for x in moves if not board.is_checked_move(*x)), None)
+            if not move:
+                break
+            board = board.move(*move).board_done
+        fens[board.to_fen()] = None
+    return list(fens)
+
+def load_positions(args):
+    if args.fens:
+        with open(args.fens, 'r', encoding = 'utf-8') as f:
+            return [x.strip() for x in f if x.strip() and not x.startswith('#')]
+    return random_positions(args.positions, args.steps, args.seed)
+
+#请求序列：按 --repeat 的比例重复已经发过的局面
+def make_requests(fens, count, repeat, seed):
+    rand = random.Random(seed)
+    sent = []
+    todo = list(fens)
+    rand.shuffle(todo)
+    for i in range(count):
+        if sent and ((rand.random() < repeat) or not todo):
+            sent.append(rand.choice(sent))
+        else:
+            sent.append(todo.pop())
+    return sent
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+#---------------------------------------------------------
+async def run_load(args, fens):
+    client = AsyncHTTPClient(max_clients = args.concurrency)
+    params = {'depth': args.depth} if not args.movetime else {'movetime': args.movetime}
+
+    requests = make_requests(fens, args.requests, args.repeat, args.seed)
+    latency = []
+    status = {}
+    queue = asyncio.Queue()
+    for fen in requests:
+        queue.put_nowait(fen)
+
+    async def worker():
+        while not queue.empty():
+            fen = queue.get_nowait()
+            url = f"{args.url}/querybest?{urlencode(dict(params, fen = fen))}"
+            start = time.perf_counter()
+            try:
+                resp = await client.fetch(url, request_timeout = args.timeout)
+                code = resp.code
+            except HTTPClientError as e:
+                code = e.code
+            except Exception:
+                code = 'error'
+            latency.append(time.perf_counter() - start)
+            status[code] = status.get(code, 0) + 1
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[worker() for i in range(args.concurrency)])
+    used = time.perf_counter() - start_time
+
+    latency.sort()
+    print(f'请求数：{len(requests)}，不同局面：{len(set(requests))}，并发：{args.concurrency}，参数：{params}')
+    print(f'用时：{used:.2f}秒，每秒请求数：{len(requests) / used:.1f}，状态：{status}')
+    print('延迟(毫秒)：p50 {:.1f}  p90 {:.1f}  p99 {:.1f}  max {:.1f}'.format(
+        *[percentile(latency, p) * 1000 for p in [0.5, 0.9, 0.99]], latency[-1] * 1000))
+
+    resp = await client.fetch(f'{args.url}/stats')
+    print(f'服务统计：{json.loads(resp.body)}')
+
+#---------------------------------------------------------
+#启动用替身引擎的服务，结果缓存库放在临时目录中，每次都从空库开始
+def spawn_server(args, tmp_dir):
+    port = args.url.rsplit(':', 1)[-1].strip('/')
+    cmd = [sys.executable, str(TOOLS_PATH / 'PikaServer.py'), '--port', port,
+           '--engine', str(TOOLS_PATH / 'fake_engine.py'), '--pool', str(args.pool),
+           '--db', str(Path(tmp_dir, 'pikabook.db'))]
+    server = subprocess.Popen(cmd, stdout = subprocess.PIPE, text = True)
+    #服务启动完成时会输出一行
+    print(server.stdout.readline().strip())
+    return server
+
+#---------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = '引擎分析服务压测')
+    parser.add_argument('--url', default = 'http://127.0.0.1:8000')
+    parser.add_argument('--spawn', action = 'store_true', help = '启动使用替身引擎的服务')
+    parser.add_argument('--pool', type = int, default = 4, help = '--spawn时服务的引擎进程数')
+    parser.add_argument('--fens', help = '局面文件，每行一个fen')
+    parser.add_argument('--positions', type = int, default = 200, help = '随机生成的局面数')
+    parser.add_argument('--steps', type = int, default = 30, help = '随机生成局面时最多走的步数')
+    parser.add_argument('--requests', type = int, default = 1000, help = '请求总数')
+    parser.add_argument('--concurrency', type = int, default = 32, help = '并发请求数')
+    parser.add_argument('--repeat', type = float, default = 0.3, help = '重复局面请求的比例')
+    parser.add_argument('--depth', type = int, default = 10)
+    parser.add_argument('--movetime', type = int, default = 0, help = '毫秒，指定后不再使用--depth')
+    parser.add_argument('--timeout', type = float, default = 120, help = '单个请求的超时(秒)')
+    parser.add_argument('--seed', type = int, default = 1)
+    args = parser.parse_args()
+
+    fens = load_positions(args)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        server = spawn_server(args, tmp_dir) if args.spawn else None
+        try:
+            asyncio.run(run_load(args, fens))
+        finally:
+            if server:
+                server.terminate()
+                server.wait()